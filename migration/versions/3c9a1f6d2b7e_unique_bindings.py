@@ -0,0 +1,40 @@
+"""add unique index on bindings
+
+Revision ID: 3c9a1f6d2b7e
+Revises: 1ff5c08b2ac
+Create Date: 2026-10-18 10:12:41.118305
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "3c9a1f6d2b7e"
+down_revision = "1ff5c08b2ac"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Concurrent guardians may have recorded the same binding more than
+    # once; keep the oldest row of each so the unique index can be built.
+    op.execute(
+        sa.text(
+            "DELETE FROM bindings WHERE id NOT IN ("
+            "SELECT MIN(id) FROM bindings "
+            "GROUP BY queue_name, exchange, routing_key)"
+        )
+    )
+    op.create_index(
+        "ix_bindings_queue_name_exchange_routing_key",
+        "bindings",
+        ["queue_name", "exchange", "routing_key"],
+        unique=True,
+    )
+    op.create_index("ix_bindings_queue_name", "bindings", ["queue_name"])
+
+
+def downgrade():
+    op.drop_index("ix_bindings_queue_name", "bindings")
+    op.drop_index("ix_bindings_queue_name_exchange_routing_key", "bindings")
@@ -0,0 +1,49 @@
+"""create queue size history tables
+
+Revision ID: 7a41c3e9d0b5
+Revises: 5d2e8b4f1a93
+Create Date: 2026-10-18 16:21:08.304117
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "7a41c3e9d0b5"
+down_revision = "5d2e8b4f1a93"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "queue_size_samples",
+        sa.Column("queue_name", sa.String(length=255), nullable=False),
+        sa.Column("sampled_at", sa.Integer(), nullable=False),
+        sa.Column("size", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("queue_name", "sampled_at"),
+    )
+    op.create_index(
+        "ix_queue_size_samples_sampled_at", "queue_size_samples", ["sampled_at"]
+    )
+    op.create_table(
+        "queue_size_rollups",
+        sa.Column("queue_name", sa.String(length=255), nullable=False),
+        sa.Column("period_start", sa.Integer(), nullable=False),
+        sa.Column("min_size", sa.Integer(), nullable=False),
+        sa.Column("max_size", sa.Integer(), nullable=False),
+        sa.Column("avg_size", sa.Float(), nullable=False),
+        sa.Column("samples", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("queue_name", "period_start"),
+    )
+    op.create_index(
+        "ix_queue_size_rollups_period_start", "queue_size_rollups", ["period_start"]
+    )
+
+
+def downgrade():
+    op.drop_index("ix_queue_size_rollups_period_start", "queue_size_rollups")
+    op.drop_index("ix_queue_size_samples_sampled_at", "queue_size_samples")
+    op.drop_table("queue_size_rollups")
+    op.drop_table("queue_size_samples")
@@ -0,0 +1,28 @@
+"""add threshold overrides on queues and accounts
+
+Revision ID: 8c5f2d7a4e16
+Revises: 7a41c3e9d0b5
+Create Date: 2026-10-18 17:42:31.518204
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "8c5f2d7a4e16"
+down_revision = "7a41c3e9d0b5"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ("queues", "pulse_users"):
+        op.add_column(table, sa.Column("warn_queue_size", sa.Integer, nullable=True))
+        op.add_column(table, sa.Column("del_queue_size", sa.Integer, nullable=True))
+
+
+def downgrade():
+    for table in ("pulse_users", "queues"):
+        op.drop_column(table, "del_queue_size")
+        op.drop_column(table, "warn_queue_size")
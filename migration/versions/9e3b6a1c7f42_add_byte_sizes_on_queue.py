@@ -0,0 +1,30 @@
+"""add byte sizes on queue
+
+Revision ID: 9e3b6a1c7f42
+Revises: 8c5f2d7a4e16
+Create Date: 2026-10-18 18:55:12.730461
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "9e3b6a1c7f42"
+down_revision = "8c5f2d7a4e16"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("queues", sa.Column("message_bytes", sa.BigInteger, nullable=True))
+    op.add_column(
+        "queues", sa.Column("message_bytes_ram", sa.BigInteger, nullable=True)
+    )
+    op.add_column("queues", sa.Column("memory", sa.BigInteger, nullable=True))
+
+
+def downgrade():
+    op.drop_column("queues", "memory")
+    op.drop_column("queues", "message_bytes_ram")
+    op.drop_column("queues", "message_bytes")
@@ -0,0 +1,222 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Columnar view of a snapshot of the queues, so that the guardian can
+evaluate its thresholds on all the queues at once.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from pulseguardian.rows import QueueRows
+
+# Indices of the queues changing state: ``overgrown`` ones are to be deleted,
+# ``overgrowing`` ones warned about and ``recovered`` ones back to normal.
+Transitions = namedtuple("Transitions", ["overgrown", "overgrowing", "recovered"])
+
+# Columns of the queues' stored states, as parallel arrays.
+StoredState = namedtuple(
+    "StoredState",
+    ["owner_ids", "sizes", "durable", "warned", "unbounded", "message_bytes"],
+)
+
+# Factor of the warning horizon beyond which a warned queue's predicted time
+# left must be for it to recover, so that queues with a noisy growth estimate
+# aren't warned and recovered on alternate cycles.
+RECOVERY_MARGIN = 2
+
+
+class QueueColumns(object):
+    """The queues of a snapshot and their stored state, as parallel arrays.
+
+    :param queues: The queues' :class:`QueueRecord` records; their
+                   ``messages`` must not be None.
+    :param rows: The queues' stored :class:`QueueState` records, in the same
+                 order.
+    :param warn_sizes: Warning threshold, for all the queues or per queue.
+    :param del_sizes: Deletion threshold, for all the queues or per queue.
+    :param forecasts: :class:`Forecast` records of the growing queues, by
+                      name, whose ``time_left`` is until their deletion
+                      threshold.
+    :param warn_bytes: Warning threshold in bytes of messages, 0 for none.
+    :param del_bytes: Deletion threshold in bytes of messages, 0 for none.
+    :param stored: The rows' :class:`StoredState`, if already built.
+    """
+
+    def __init__(
+        self,
+        queues,
+        rows,
+        warn_sizes,
+        del_sizes,
+        forecasts=None,
+        warn_bytes=0,
+        del_bytes=0,
+        stored=None,
+    ):
+        n = len(queues)
+        self.queues = queues
+        self.rows = rows
+        self.sizes = np.fromiter((q.messages for q in queues), np.int64, n)
+        self.durable = np.fromiter((bool(q.durable) for q in queues), bool, n)
+        if stored is None:
+            stored = StoredColumns().update([q.name for q in queues], rows)
+        # -1 for queues whose size was never stored.
+        self.stored_sizes = stored.sizes
+        self.stored_durable = stored.durable
+        self.warned = stored.warned
+        self.unbounded = stored.unbounded
+        # 0 for queues whose bytes are unknown, and -1 if never stored.
+        self.bytes = np.fromiter((q.message_bytes or 0 for q in queues), np.int64, n)
+        self.stored_bytes = stored.message_bytes
+        self.warn_sizes = np.broadcast_to(np.asarray(warn_sizes, np.int64), (n,))
+        self.del_sizes = np.broadcast_to(np.asarray(del_sizes, np.int64), (n,))
+        self.warn_bytes = warn_bytes or np.iinfo(np.int64).max
+        self.del_bytes = del_bytes or np.iinfo(np.int64).max
+        # Infinite for the queues that aren't growing.
+        self.time_left = np.full(n, np.inf)
+        if forecasts:
+            for i, queue_data in enumerate(queues):
+                growth = forecasts.get(queue_data.name)
+                if growth is not None:
+                    self.time_left[i] = growth.time_left
+
+    def __len__(self):
+        return len(self.queues)
+
+    def thresholds(self, i):
+        """Return the ``(warning, deletion)`` thresholds of a queue."""
+        return int(self.warn_sizes[i]), int(self.del_sizes[i])
+
+    def size_changed(self):
+        """Return the indices of the queues whose size isn't the stored one."""
+        return np.flatnonzero(self.sizes != self.stored_sizes)
+
+    def bytes_changed(self):
+        """Return the indices of the queues whose bytes of messages are known
+        and aren't the stored ones.
+        """
+        known = np.fromiter(
+            (q.message_bytes is not None for q in self.queues), bool, len(self)
+        )
+        return np.flatnonzero(known & (self.bytes != self.stored_bytes))
+
+    def durable_changed(self):
+        """Return the indices of the queues whose durability isn't the stored
+        one.
+        """
+        return np.flatnonzero(self.durable != self.stored_durable)
+
+    def transitions(self, horizon=0):
+        """Return the :class:`Transitions` of the queues.
+
+        Bounded queues over either deletion threshold are overgrown.  The
+        others are overgrowing if over either warning threshold, or predicted
+        to reach their deletion threshold within ``horizon`` seconds, and
+        not warned yet.  They are recovered if warned but under their
+        warning thresholds, and not predicted to reach their deletion
+        threshold within :data:`RECOVERY_MARGIN` times ``horizon``.
+        """
+        overgrown = (
+            (self.sizes > self.del_sizes) | (self.bytes > self.del_bytes)
+        ) & ~self.unbounded
+        over_warn = self._over_warn()
+        if horizon:
+            predicted = ~self.unbounded & (self.time_left <= horizon)
+            still_predicted = ~self.unbounded & (
+                self.time_left <= RECOVERY_MARGIN * horizon
+            )
+        else:
+            predicted = still_predicted = np.zeros(len(self), bool)
+        kept = ~overgrown
+        overgrowing = kept & (over_warn | predicted) & ~self.warned
+        recovered = kept & ~over_warn & ~still_predicted & self.warned
+        return Transitions(
+            np.flatnonzero(overgrown),
+            np.flatnonzero(overgrowing),
+            np.flatnonzero(recovered),
+        )
+
+    def largest(self, count, exclude=()):
+        """Return the indices of the ``count`` biggest bounded queues over
+        either warning threshold, not in ``exclude``, biggest first.  Queues
+        are compared by bytes of messages, then by number of messages.
+        """
+        candidates = np.setdiff1d(
+            np.flatnonzero(self._over_warn() & ~self.unbounded), exclude
+        )
+        order = np.lexsort((self.sizes[candidates], self.bytes[candidates]))
+        return candidates[order[::-1][:count]]
+
+    def _over_warn(self):
+        return (self.sizes > self.warn_sizes) | (self.bytes > self.warn_bytes)
+
+
+class StoredColumns(QueueRows):
+    """The queues' stored :class:`QueueState` records as arrays, kept from
+    one cycle to the next.
+
+    Records are immutable, so only those that aren't the very objects given
+    for the same queues at the previous update are read again.
+    """
+
+    def __init__(self):
+        super().__init__(
+            {
+                # The records, kept so that their ids aren't reused.
+                "records": (object, None, None),
+                "ids": (np.int64, 0, None),
+                "owner_ids": (np.int64, -1, None),
+                "sizes": (np.int64, -1, None),
+                "durable": (bool, False, None),
+                "warned": (bool, False, None),
+                "unbounded": (bool, False, None),
+                "message_bytes": (np.int64, -1, None),
+            }
+        )
+
+    def update(self, names, rows):
+        """Update the columns with the named queues' records, and return
+        their :class:`StoredState`, in the order of ``names``.
+        """
+        found = self.rows(names)
+        ids = np.fromiter(map(id, rows), np.int64, len(rows))
+        changed = np.flatnonzero(self.ids[found] != ids)
+        if len(changed):
+            records = [rows[i] for i in changed]
+            n = len(records)
+            at = found[changed]
+            self.records[at] = np.fromiter(records, object, n)
+            self.ids[at] = ids[changed]
+            self.owner_ids[at] = np.fromiter(
+                (-1 if row.owner_id is None else row.owner_id for row in records),
+                np.int64,
+                n,
+            )
+            self.sizes[at] = np.fromiter(
+                (-1 if row.size is None else row.size for row in records),
+                np.int64,
+                n,
+            )
+            self.durable[at] = np.fromiter(
+                (bool(row.durable) for row in records), bool, n
+            )
+            self.warned[at] = np.fromiter(
+                (bool(row.warned) for row in records), bool, n
+            )
+            self.unbounded[at] = np.fromiter(
+                (bool(row.unbounded) for row in records), bool, n
+            )
+            self.message_bytes[at] = np.fromiter(
+                (
+                    -1 if row.message_bytes is None else row.message_bytes
+                    for row in records
+                ),
+                np.int64,
+                n,
+            )
+        return StoredState(
+            *(getattr(self, column)[found] for column in StoredState._fields)
+        )
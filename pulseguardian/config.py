@@ -38,6 +38,23 @@ email_from = os.getenv("EMAIL_FROM", "Mozilla A-Team <auto-tools@mozilla.com>")
 email_smtp_server = os.getenv("EMAIL_SMTP_SERVER", "smtp.mozilla.org")
 email_smtp_port = int(os.getenv("EMAIL_SMTP_PORT", 25))
 email_ssl = bool(int(os.getenv("EMAIL_SSL", 0)))
+# Timeout, in seconds, of SMTP connections and commands.
+email_smtp_timeout = float(os.getenv("EMAIL_SMTP_TIMEOUT", 30))
+# Send each queue owner a single digest of their queues' warnings, deletions
+# and recoveries per guard cycle, or per EMAIL_DIGEST_WINDOW seconds if set.
+email_digest = bool(int(os.getenv("EMAIL_DIGEST", 0)))
+email_digest_window = float(os.getenv("EMAIL_DIGEST_WINDOW", 0))
+# Interval, in seconds, between deliveries of the email outbox, and maximum
+# number of emails sent per delivery.
+email_outbox_interval = float(os.getenv("EMAIL_OUTBOX_INTERVAL", 5))
+email_outbox_batch_size = int(os.getenv("EMAIL_OUTBOX_BATCH_SIZE", 50))
+# Number of attempts at sending an email before giving up, and delay, in
+# seconds, before the first retry; the delay doubles with every attempt.
+email_max_attempts = int(os.getenv("EMAIL_MAX_ATTEMPTS", 8))
+email_retry_delay = float(os.getenv("EMAIL_RETRY_DELAY", 30))
+email_retry_max_delay = float(os.getenv("EMAIL_RETRY_MAX_DELAY", 3600))
+# Number of days sent and failed emails are kept in the outbox, 0 for ever.
+email_outbox_retention = float(os.getenv("EMAIL_OUTBOX_RETENTION", 7))
 
 # Database
 database_url = os.getenv("DATABASE_URL", "postgresql://root@localhost/pulseguardian")
@@ -58,6 +75,16 @@ rabbit_user = os.getenv("RABBIT_USER", "guest")
 # Password of the RabbitMQ user.
 rabbit_password = os.getenv("RABBIT_PASSWORD", "guest")
 
+# Maximum number of pooled keep-alive connections to the management API.
+rabbit_pool_size = int(os.getenv("RABBIT_POOL_SIZE", 10))
+# Timeouts, in seconds, for connecting to and reading from the management API.
+rabbit_connect_timeout = float(os.getenv("RABBIT_CONNECT_TIMEOUT", 5))
+rabbit_read_timeout = float(os.getenv("RABBIT_READ_TIMEOUT", 60))
+# Number of queues per page, and of pages fetched concurrently, when paging
+# through the queues of a vhost.  The management plugin caps pages at 500.
+rabbit_page_size = int(os.getenv("RABBIT_PAGE_SIZE", 500))
+rabbit_page_workers = int(os.getenv("RABBIT_PAGE_WORKERS", 4))
+
 # reserved users
 reserved_users_regex = os.getenv("RESERVED_USERS_REGEX", None)
 reserved_users_message = os.getenv("RESERVED_USERS_MESSAGE", None)
@@ -65,8 +92,69 @@ reserved_users_message = os.getenv("RESERVED_USERS_MESSAGE", None)
 # PulseGuardian
 warn_queue_size = int(os.getenv("WARN_QUEUE_SIZE", 2000))
 del_queue_size = int(os.getenv("DEL_QUEUE_SIZE", 8000))
+# Same thresholds, in bytes of message bodies, for queues of few but large
+# messages.  0, the default, disables them.
+warn_queue_bytes = int(os.getenv("WARN_QUEUE_BYTES", 0))
+del_queue_bytes = int(os.getenv("DEL_QUEUE_BYTES", 0))
+# Number of overgrown queues deleted concurrently.
+delete_workers = int(os.getenv("DELETE_WORKERS", 4))
+# Rate, in deletions per second, and burst of overgrown queue deletions; the
+# queues over the limit are deleted on later cycles.  0 disables the limit.
+delete_rate = float(os.getenv("DELETE_RATE", 2))
+delete_burst = int(os.getenv("DELETE_BURST", 20))
 polling_interval = int(os.getenv("POLLING_INTERVAL", 5))
 polling_max_interval = int(os.getenv("POLLING_MAX_INTERVAL", 300))
+# Interval, in seconds, between full sweeps of the queues.  In between, only
+# the queues growing towards a threshold are checked, one by one.
+sweep_interval = int(os.getenv("SWEEP_INTERVAL", polling_interval))
+# Time, in seconds, allowed to fetch both the queues and the bindings of a
+# guard cycle before giving up and backing off.
+snapshot_deadline = float(os.getenv("SNAPSHOT_DEADLINE", 30))
+# Interval, in seconds, between reloads of the guardian's in-memory copy of
+# the database, which picks up changes made from the web app.
+state_resync_interval = int(os.getenv("STATE_RESYNC_INTERVAL", 300))
+# Write the guardian's database changes from a background thread every
+# WRITE_BEHIND_INTERVAL seconds, instead of at the end of each guard cycle.
+write_behind = bool(int(os.getenv("WRITE_BEHIND", 0)))
+write_behind_interval = float(os.getenv("WRITE_BEHIND_INTERVAL", 5))
+# Number of guard cycles whose changes may wait to be written before the
+# guard loop blocks.
+write_behind_max_pending = int(os.getenv("WRITE_BEHIND_MAX_PENDING", 20))
+# Time, in seconds, after which a guard loop blocked on pending changes
+# fails its cycle instead.
+write_behind_submit_timeout = float(os.getenv("WRITE_BEHIND_SUBMIT_TIMEOUT", 60))
+# Number of failed writes in a row after which admins are emailed, and each
+# guard cycle's changes are written on their own, dropping those that fail.
+write_behind_max_failures = int(os.getenv("WRITE_BEHIND_MAX_FAILURES", 3))
+# Record the history of the queues' sizes, off by default.  Raw samples are
+# kept for HISTORY_RAW_RETENTION seconds, and the minimum, maximum and
+# average sizes over each HISTORY_ROLLUP_INTERVAL seconds for
+# HISTORY_ROLLUP_RETENTION seconds.
+size_history = bool(int(os.getenv("SIZE_HISTORY", 0)))
+history_raw_retention = int(os.getenv("HISTORY_RAW_RETENTION", 3600))
+history_rollup_interval = int(os.getenv("HISTORY_ROLLUP_INTERVAL", 300))
+history_rollup_retention = int(os.getenv("HISTORY_ROLLUP_RETENTION", 7 * 86400))
+# Number of latest sizes of each queue kept in the guardian's memory, each
+# costing 16 bytes per queue.
+recent_sizes_capacity = int(os.getenv("RECENT_SIZES_CAPACITY", 60))
+# Warn the owners of queues predicted, from their recent growth, to reach
+# DEL_QUEUE_SIZE within WARN_HORIZON seconds, even if they are still under
+# WARN_QUEUE_SIZE.  0 disables these early warnings.
+warn_horizon = int(os.getenv("WARN_HORIZON", 600))
+# Period, in seconds, of stored size samples the web app estimates the queues'
+# growth from.
+growth_window = int(os.getenv("GROWTH_WINDOW", 300))
+# Poll the cluster's nodes every sweep for their pressure on their memory and
+# disk limits, 1 being where RabbitMQ raises an alarm and blocks publishers.
+# From PRESSURE_HIGH, deletion thresholds are multiplied by PRESSURE_FACTOR;
+# from PRESSURE_EMERGENCY, or once an alarm is raised, up to
+# EMERGENCY_DELETIONS of the biggest bounded queues over their warning
+# threshold are also deleted every cycle.
+broker_pressure = bool(int(os.getenv("BROKER_PRESSURE", 1)))
+pressure_high = float(os.getenv("PRESSURE_HIGH", 0.8))
+pressure_emergency = float(os.getenv("PRESSURE_EMERGENCY", 0.95))
+pressure_factor = float(os.getenv("PRESSURE_FACTOR", 0.5))
+emergency_deletions = int(os.getenv("EMERGENCY_DELETIONS", 5))
 fake_account = os.getenv("FAKE_ACCOUNT", None)
 
 # Only used if at least one log path is specified above.
@@ -8,9 +8,11 @@ import sys
 from pulseguardian import config, management as pulse_management
 from pulseguardian.model.base import db_session, init_db
 from pulseguardian.model.binding import Binding
+from pulseguardian.model.outbox import OutboxEmail
 from pulseguardian.model.user import User
 from pulseguardian.model.pulse_user import RabbitMQAccount
 from pulseguardian.model.queue import Queue
+from pulseguardian.model.queue_size import QueueSizeRollup, QueueSizeSample
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -37,6 +39,11 @@ def init_and_clear_db():
         db_session.delete(rabbitmq_account)
     for user in User.get_all():
         db_session.delete(user)
+    for email in OutboxEmail.get_all():
+        db_session.delete(email)
+    for tbl in (QueueSizeSample, QueueSizeRollup):
+        for row in tbl.get_all():
+            db_session.delete(row)
 
     db_session.commit()
 
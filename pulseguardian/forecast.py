@@ -0,0 +1,132 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Estimation of the queues' growth, and of the time left before they reach
+the deletion size.
+
+Growth rates are the least-squares slopes of the queues' recent sizes over
+time, computed for all the queues at once on ``(queues, samples)`` arrays.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+from sqlalchemy import select
+
+from pulseguardian.model.base import db_session
+from pulseguardian.model.queue_size import QueueSizeSample
+
+# Minimum number of samples to estimate a queue's growth from, and minimum
+# time, in seconds, they must span, so that a single burst isn't taken for
+# sustained growth.
+MIN_SAMPLES = 3
+MIN_SPAN = 60
+# Maximum number of queue names per IN clause.
+CHUNK_SIZE = 1000
+
+# Growth of a queue: ``rate`` is in messages per second, and ``time_left`` is
+# the estimated time, in seconds, before the queue exceeds the limit.
+Forecast = namedtuple("Forecast", ["rate", "time_left"])
+
+
+def growth_rates(times, sizes, counts):
+    """Return the least-squares slope of each row of sizes over times.
+
+    ``times`` and ``sizes`` are ``(queues, samples)`` arrays of which only
+    the first ``counts[i]`` samples of row ``i`` are used, in any order.
+    Rows with fewer than :data:`MIN_SAMPLES` samples, or spanning less than
+    :data:`MIN_SPAN` seconds, get a rate of 0.
+    """
+    counts = np.asarray(counts)
+    mask = np.arange(times.shape[1]) < counts[:, None]
+    n = np.maximum(counts, 1)
+    # Times relative to the first sample of each row, to keep precision.
+    t = np.where(mask, times - times[:, :1], 0).astype(float)
+    y = np.where(mask, sizes, 0).astype(float)
+    dt = np.where(mask, t - (t.sum(axis=1) / n)[:, None], 0.0)
+    dy = y - (y.sum(axis=1) / n)[:, None]
+    var = (dt * dt).sum(axis=1)
+    cov = (dt * dy).sum(axis=1)
+    rates = np.divide(cov, var, out=np.zeros_like(cov), where=var > 0)
+    first = np.where(mask, t, np.inf).min(axis=1)
+    last = np.where(mask, t, -np.inf).max(axis=1)
+    rates[(counts < MIN_SAMPLES) | (last - first < MIN_SPAN)] = 0.0
+    return rates
+
+
+def _forecasts(names, times, sizes, counts, current, limit):
+    """Return the forecasts of the growing queues, by name."""
+    rates = growth_rates(times, sizes, counts)
+    current = np.asarray(current, dtype=float)
+    growing = rates > 0
+    time_left = np.divide(
+        np.maximum(limit - current, 0),
+        rates,
+        out=np.zeros_like(rates),
+        where=growing,
+    )
+    return {
+        names[i]: Forecast(float(rates[i]), float(time_left[i]))
+        for i in np.flatnonzero(growing)
+    }
+
+
+def forecast(recent, names, limit):
+    """Estimate the growth of the named queues from their recent sizes in
+    ``recent`` (a :class:`RecentSizes`), and their time left before
+    exceeding ``limit`` messages, for all the queues or per queue.
+
+    Returns a dict of :class:`Forecast` records by queue name, for the
+    growing queues only.  Queues whose size didn't change over their
+    recent samples aren't growing, and are skipped.
+    """
+    names = list(names)
+    limits = np.broadcast_to(np.asarray(limit), (len(names),))
+    rows = recent.find(names)
+    kept = np.flatnonzero(recent.varying(rows))
+    if not len(kept):
+        return {}
+    times, sizes, counts, current = recent.window(rows[kept])
+    return _forecasts(
+        [names[i] for i in kept], times, sizes, counts, current, limits[kept]
+    )
+
+
+def forecast_history(names, limit, since):
+    """Estimate the growth of the named queues from their stored size
+    samples taken since a UNIX time; see :func:`forecast`.
+    """
+    names = list(names)
+    limits = dict(zip(names, np.broadcast_to(np.asarray(limit), (len(names),))))
+    samples = {}
+    for i in range(0, len(names), CHUNK_SIZE):
+        for name, sampled_at, size in db_session.execute(
+            select(
+                QueueSizeSample.queue_name,
+                QueueSizeSample.sampled_at,
+                QueueSizeSample.size,
+            )
+            .where(
+                QueueSizeSample.queue_name.in_(names[i : i + CHUNK_SIZE]),
+                QueueSizeSample.sampled_at >= since,
+            )
+            .order_by(QueueSizeSample.queue_name, QueueSizeSample.sampled_at)
+        ):
+            samples.setdefault(name, []).append((sampled_at, size))
+    if not samples:
+        return {}
+
+    names = sorted(samples)
+    width = max(len(rows) for rows in samples.values())
+    times = np.zeros((len(names), width), dtype=np.int64)
+    sizes = np.zeros((len(names), width), dtype=np.int64)
+    for i, name in enumerate(names):
+        rows = np.array(samples[name], dtype=np.int64)
+        times[i, : len(rows)] = rows[:, 0]
+        sizes[i, : len(rows)] = rows[:, 1]
+    counts = [len(samples[name]) for name in names]
+    current = [samples[name][-1][1] for name in names]
+    return _forecasts(
+        names, times, sizes, counts, current, np.array([limits[n] for n in names])
+    )
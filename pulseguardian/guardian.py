@@ -5,18 +5,58 @@
 import re
 import requests
 import socket
+import threading
 import time
 import traceback
-
-from sqlalchemy import delete, select
-
-from pulseguardian import config, management as pulse_management, mozdef
+from collections import namedtuple
+from concurrent import futures
+
+import numpy as np
+from sqlalchemy import select
+
+from pulseguardian import (
+    config,
+    forecast,
+    management as pulse_management,
+    mozdef,
+    outbox,
+    pressure,
+)
+from pulseguardian.columns import QueueColumns, StoredColumns
+from pulseguardian.history import RecentSizes, SizeHistory
 from pulseguardian.model.base import init_db, db_session
 from pulseguardian.model.binding import Binding
 from pulseguardian.model.pulse_user import RabbitMQAccount
-from pulseguardian.model.queue import Queue
 from pulseguardian.model.user import User
+from pulseguardian.ratelimit import TokenBucket
+from pulseguardian.scheduler import QueueScheduler
 from pulseguardian.sendemail import sendemail
+from pulseguardian.state import GuardianState, QueueState
+from pulseguardian.unit_of_work import UnitOfWork, WriteBehindWriter
+
+# Queue names start with the name of the account owning them.
+QUEUE_OWNER_RE = re.compile("queue/([^/]+)/")
+
+
+# Kinds of queue events.
+WARNING = "warning"
+DELETION = "deletion"
+RECOVERY = "recovery"
+# Deletion of a queue under the threshold, to relieve the broker.
+SHED = "shed"
+
+# A queue that got overgrowing, deleted, or back to normal, as given to
+# callbacks and emails, with the queue's growth if it is growing and its
+# deletion threshold if it isn't the guardian's.
+QueueEvent = namedtuple(
+    "QueueEvent",
+    ["kind", "queue", "unbounded", "forecast", "del_size"],
+    defaults=[None, None],
+)
+
+
+class SnapshotTimeout(Exception):
+    """Fetching the broker's queues and bindings exceeded the deadline."""
 
 
 class PulseGuardian(object):
@@ -29,8 +69,17 @@ class PulseGuardian(object):
     :param emails: Sends emails to queue owners if True.
     :param warn_queue_size: Warning threshold.
     :param del_queue_size: Deletion threshold.
+    :param warn_queue_bytes: Warning threshold in bytes of messages, 0 for
+                             none.
+    :param del_queue_bytes: Deletion threshold in bytes of messages, 0 for
+                            none.
     :param on_warn: Callback called with a queue's name when it's warned.
     :param on_delete: Callback called with a queue's name when it's deleted.
+    :param write_behind: Write database changes from a background thread
+                         instead of at the end of each guard cycle.
+    :param digest: Collect the events of each queue owner into a single
+                   email per guard cycle, or per
+                   ``config.email_digest_window`` seconds.
     """
 
     def __init__(
@@ -40,8 +89,14 @@ class PulseGuardian(object):
         del_queue_size=config.del_queue_size,
         on_warn=None,
         on_delete=None,
+        write_behind=False,
+        digest=config.email_digest,
+        warn_queue_bytes=config.warn_queue_bytes,
+        del_queue_bytes=config.del_queue_bytes,
     ):
-        if del_queue_size < warn_queue_size:
+        if del_queue_size < warn_queue_size or (
+            warn_queue_bytes and del_queue_bytes and del_queue_bytes < warn_queue_bytes
+        ):
             raise ValueError(
                 "Deletion threshold can't be smaller than the warning threshold."
             )
@@ -49,11 +104,67 @@ class PulseGuardian(object):
         self.emails = emails
         self.warn_queue_size = warn_queue_size
         self.del_queue_size = del_queue_size
+        self.warn_queue_bytes = warn_queue_bytes
+        self.del_queue_bytes = del_queue_bytes
         self.on_warn = on_warn
         self.on_delete = on_delete
+        self.digest = digest
+        # Email address -> (time of the first event, events).
+        self._digests = {}
+        self._digests_lock = threading.Lock()
         self._polling_interval = config.polling_interval
         self._connection_error_notified = False
         self._unknown_error_notified = False
+        # Sends the emails queued in the outbox while guarding.
+        self._outbox_worker = outbox.OutboxWorker() if emails else None
+        # In-memory copy of the stored state, see load_state().
+        self._state = None
+        self._writer = None
+        # Units of work dropped by the writer, as of the last commit.
+        self._dropped_writes = 0
+        if write_behind:
+            self._writer = WriteBehindWriter(
+                config.write_behind_interval,
+                config.write_behind_max_pending,
+                max_failures=config.write_behind_max_failures,
+                submit_timeout=config.write_behind_submit_timeout,
+                on_failure=self.notify_write_failure,
+            )
+        # Fetches abandoned after a deadline keep a worker busy until their
+        # read timeout, hence the spare workers.
+        self._fetch_executor = futures.ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix="guardian-fetch"
+        )
+        self._delete_executor = futures.ThreadPoolExecutor(
+            max_workers=config.delete_workers, thread_name_prefix="guardian-delete"
+        )
+        self.delete_limiter = TokenBucket(config.delete_rate, config.delete_burst)
+        # Growing queues are checked on their own between full sweeps.
+        self.scheduler = QueueScheduler(
+            (warn_queue_size, del_queue_size),
+            config.polling_interval,
+            config.sweep_interval,
+        )
+        self._next_sweep = 0
+        # Stored queues missing from the last snapshot, which was incomplete;
+        # they are taken for deleted if missing from the next one too.
+        self._unseen_queues = set()
+        self.recent_sizes = RecentSizes(config.recent_sizes_capacity)
+        # The stored state of the queues as arrays, kept between cycles.
+        self.stored_columns = StoredColumns()
+        self.warn_horizon = config.warn_horizon
+        # Pressure of the broker's nodes, as of the last sweep; see
+        # check_pressure().
+        self.pressure = pressure.NO_PRESSURE
+        self.pressure_factor = config.pressure_factor
+        self.emergency_deletions = config.emergency_deletions
+        self.history = None
+        if config.size_history:
+            self.history = SizeHistory(
+                config.history_raw_retention,
+                config.history_rollup_interval,
+                config.history_rollup_retention,
+            )
 
     def _increase_interval(self):
         if self._polling_interval < config.polling_max_interval:
@@ -64,9 +175,23 @@ class PulseGuardian(object):
         self._connection_error_notified = False
         self._unknown_error_notified = False
 
-    def _sendemail(self, to_users, subject, text_data):
-        to_addrs = [user.email for user in to_users if user.email]
-        if to_addrs:
+    def _sendemail(self, to_addrs, subject, text_data):
+        to_addrs = [addr for addr in to_addrs if addr]
+        if not to_addrs:
+            return
+
+        try:
+            outbox.enqueue(to_addrs, subject, text_data)
+        except Exception:
+            # The database may be what is failing; don't lose the email,
+            # notifying admins of the failure in particular.
+            db_session.rollback()
+            mozdef.log(
+                mozdef.ERROR,
+                mozdef.OTHER,
+                "Failed to queue email; sending it now.",
+                details={"subject": subject, "message": traceback.format_exc()},
+            )
             sendemail(
                 subject=subject,
                 from_addr=config.email_from,
@@ -79,233 +204,833 @@ class PulseGuardian(object):
                 use_ssl=config.email_ssl,
             )
 
-    def get_queue_bindings(self, all_bindings, queue_name):
-        """Extract the bindigns for just the named queue"""
-        return [
-            x
-            for x in all_bindings
-            if x["destination_type"] == "queue" and x["destination"] == queue_name
-        ]
+    def index_bindings(self, all_bindings):
+        """Group bindings, either ``/api/bindings`` items or
+        :class:`BindingRecord` records, by destination in a single pass.
 
-    def clear_deleted_queues(self, queues, all_bindings):
-        db_queues = Queue.get_all()
+        Returns a dict mapping ``(destination_type, destination)`` to a list of
+        ``(source, routing_key)`` tuples.  The index is meant to be built once
+        per guard cycle and shared by everything that needs a queue's
+        bindings.
+        """
+        index = {}
+        for b in all_bindings:
+            b = pulse_management.BindingRecord.from_json(b)
+            key = (b.destination_type, b.destination)
+            index.setdefault(key, []).append((b.source, b.routing_key))
+        return index
+
+    def get_queue_bindings(self, binding_index, queue_name):
+        """Extract the ``(source, routing_key)`` bindings for just the named
+        queue from an index built by :meth:`index_bindings`.
+        """
+        return binding_index.get(("queue", queue_name), ())
+
+    def _alive_bindings(self, binding_index, queue_names):
+        """Return the live bindings of the named queues, as a set of
+        ``(queue_name, exchange, routing_key)`` triples.
+        """
+        return {
+            (queue_name, source, routing_key)
+            for queue_name in queue_names
+            for source, routing_key in self.get_queue_bindings(
+                binding_index, queue_name
+            )
+        }
+
+    def clear_deleted_queues(self, queues, bindings, uow=None, keep=()):
+        """Remove queues and bindings from the database that no longer exist
+        on RabbitMQ.
+
+        ``queues`` are ``/api/queues`` items or :class:`QueueRecord` records;
+        ``bindings`` is either a ``/api/bindings`` payload or an index of it
+        built by :meth:`index_bindings`.  Queues named in ``keep`` are kept,
+        with their bindings, even if missing from ``queues``.  Changes are
+        added to ``uow``, a :class:`UnitOfWork`, if given; otherwise they
+        are committed right away.
+        """
+        commit = uow is None
+        if commit:
+            uow = UnitOfWork()
+        if not isinstance(bindings, dict):
+            bindings = self.index_bindings(bindings)
+        state = self._get_state()
+        db_queues_names = set(state.queues)
 
         # Filter queues that are in the database but no longer on RabbitMQ.
-        alive_queues_names = {q["name"] for q in queues}
-        deleted_queues = [q for q in db_queues if q.name not in alive_queues_names]
+        alive_queues_names = {
+            pulse_management.QueueRecord.from_json(q).name for q in queues
+        }
+        deleted_names = sorted(db_queues_names - alive_queues_names - set(keep))
 
         # Batch delete stale queues and their bindings.
-        if deleted_queues:
-            deleted_names = [q.name for q in deleted_queues]
-            mozdef.log(
+        if deleted_names:
+            uow.log(
                 mozdef.NOTICE,
                 mozdef.OTHER,
                 "Queues no longer exist.",
                 details={"count": len(deleted_names), "queuenames": deleted_names},
                 tags=["queue"],
             )
-            db_session.execute(
-                delete(Binding).where(Binding.queue_name.in_(deleted_names))
-            )
-            db_session.execute(
-                delete(Queue).where(Queue.name.in_(deleted_names))
-            )
+            for name in deleted_names:
+                uow.delete_queue(name)
 
         # Clean up bindings on queues that are not deleted.
-        for queue_name in alive_queues_names:
-            bindings = self.get_queue_bindings(all_bindings, queue_name)
-            self.clear_deleted_bindings(queue_name, bindings)
+        self.clear_deleted_bindings(
+            bindings, db_queues_names & alive_queues_names, uow, state
+        )
 
-        db_session.commit()
+        if commit:
+            self._commit(uow)
 
-    def clear_deleted_bindings(self, queue_name, queue_bindings):
-        db_bindings = db_session.execute(
-            select(Binding).where(Binding.queue_name == queue_name)
-        ).scalars()
+    def clear_deleted_bindings(self, binding_index, queue_names, uow, state):
+        """Bring the stored bindings of the named queues in line with
+        RabbitMQ.
 
-        # Filter bindings that are in the database but no longer on RabbitMQ.
-        alive_bindings_names = {
-            Binding.as_string(b["source"], b["routing_key"]) for b in queue_bindings
-        }
-        deleted_bindings = {
-            b for b in db_bindings if b.name not in alive_bindings_names
+        Stored and live bindings are compared as sets of
+        ``(queue_name, exchange, routing_key)`` triples: stale ones are
+        removed and missing ones are added.
+        """
+        alive_bindings = self._alive_bindings(binding_index, queue_names)
+        stored_bindings = {
+            binding for binding in state.bindings if binding[0] in queue_names
         }
 
-        # Delete those bindings.
-        for binding in deleted_bindings:
-            mozdef.log(
+        # Filter bindings that are in the database but no longer on RabbitMQ.
+        deleted_bindings = stored_bindings - alive_bindings
+        for queue_name, exchange, routing_key in sorted(deleted_bindings):
+            uow.log(
                 mozdef.NOTICE,
                 mozdef.OTHER,
                 "Binding no longer exists.",
                 details={
                     "queuename": queue_name,
-                    "binding": binding.name,
+                    "binding": Binding.as_string(exchange, routing_key),
                 },
                 tags=["queue"],
             )
-            db_session.delete(binding)
 
-    def update_queue_information(self, queue_data, all_bindings):
-        if "messages" not in queue_data:
-            # FIXME: We should do something here, probably delete the queue,
-            # as it's in a weird state.  More investigation is required.
-            # See bug 1066338.
-            return None
+        uow.delete_bindings(deleted_bindings)
+        uow.add_bindings(alive_bindings - stored_bindings)
+
+    def load_state(self):
+        """Load the stored queues, bindings and owners in memory.
 
-        q_size, q_name, q_durable = (
-            queue_data["messages"],
-            queue_data["name"],
-            queue_data["durable"],
+        Until the next call, the guardian reads this copy, which it keeps up
+        to date with its own changes, instead of the database.  Changes made
+        by others, e.g. from the web app, are only seen once it is reloaded.
+        """
+        self._state = self._load_state()
+        mozdef.log(
+            mozdef.DEBUG,
+            mozdef.OTHER,
+            "Loaded guardian state.",
+            details={
+                "queues": len(self._state.queues),
+                "bindings": len(self._state.bindings),
+            },
+        )
+
+    def _load_state(self):
+        # The changes that aren't written yet are taken before reading the
+        # database, so that those flushed in between are in either; applying
+        # written changes again is harmless.
+        pending = self._writer.pending() if self._writer is not None else None
+        state = GuardianState.load()
+        state.load_thresholds(self.warn_queue_size, self.del_queue_size)
+        if pending is not None:
+            state.apply(pending)
+        return state
+
+    def check_accounts(self):
+        """Reload the RabbitMQ accounts of the in-memory state if some were
+        created or deleted since it was loaded, e.g. from the web app.
+        """
+        if self._state is None or not self._state.accounts_changed():
+            return
+        self._state.load_accounts()
+        mozdef.log(
+            mozdef.DEBUG,
+            mozdef.OTHER,
+            "Reloaded RabbitMQ accounts.",
+            details={"accounts": len(self._state.account_ids)},
+        )
+
+    def _get_state(self):
+        """Return the in-memory state if loaded, otherwise read it from the
+        database.
+        """
+        if self._state is not None:
+            return self._state
+        return self._load_state()
+
+    def _thresholds(self, names, owner_ids, state):
+        """Return the effective warning and deletion thresholds of the named
+        queues, given their owners' ids (-1 for none), as arrays: each
+        queue's own overrides, else its owner's, else the guardian's.
+        Deletion thresholds are tightened while the broker is under pressure.
+        """
+        n = len(names)
+        warn_sizes = np.full(n, self.warn_queue_size, np.int64)
+        del_sizes = np.full(n, self.del_queue_size, np.int64)
+        if state.account_thresholds:
+            account_ids = np.array(sorted(state.account_thresholds), np.int64)
+            overrides = np.array(
+                [state.account_thresholds[i] for i in account_ids.tolist()], np.int64
+            )
+            found = np.searchsorted(account_ids, owner_ids).clip(
+                max=len(account_ids) - 1
+            )
+            owned = np.flatnonzero(account_ids[found] == owner_ids)
+            warn_sizes[owned] = overrides[found[owned], 0]
+            del_sizes[owned] = overrides[found[owned], 1]
+        if state.thresholds:
+            positions = dict(zip(names, range(n)))
+            for name, (warn_size, del_size) in state.thresholds.items():
+                i = positions.get(name)
+                if i is not None:
+                    warn_sizes[i], del_sizes[i] = warn_size, del_size
+        if self.pressure.level != pressure.NORMAL:
+            del_sizes = np.maximum(
+                (del_sizes * self.pressure_factor).astype(np.int64), 1
+            )
+        return warn_sizes, del_sizes
+
+    def _del_queue_bytes(self):
+        """Return the deletion threshold in bytes, tightened like the
+        others while the broker is under pressure.
+        """
+        if self.del_queue_bytes and self.pressure.level != pressure.NORMAL:
+            return max(int(self.del_queue_bytes * self.pressure_factor), 1)
+        return self.del_queue_bytes
+
+    def _commit(self, uow):
+        """Apply a unit of work to the in-memory state, then commit it or
+        hand it to the write-behind flusher thread.
+        """
+        if self._state is not None:
+            self._state.apply(uow)
+
+        if self._writer is None:
+            try:
+                uow.commit()
+            except Exception:
+                # The in-memory state is ahead of the database; reload it.
+                self._state = None
+                raise
+            return
+
+        try:
+            self._writer.submit(uow)
+        except Exception:
+            self._state = None
+            raise
+        finally:
+            # End the cycle's read transaction.
+            db_session.rollback()
+        stats = self._writer.stats()
+        if stats["dropped"] > self._dropped_writes:
+            # Changes applied to the in-memory state were never written.
+            self._dropped_writes = stats["dropped"]
+            self._state = None
+        mozdef.log(
+            mozdef.DEBUG,
+            mozdef.OTHER,
+            "Write-behind status.",
+            details=stats,
         )
-        queue = Queue.get_by(name=q_name)
-
-        # If the queue doesn't exist in the db, create it.
-        if queue is None:
-            log_details = {
-                "queuename": q_name,
-                "queuesize": q_size,
-                "queuedurable": q_durable,
-            }
-            m = re.match("queue/([^/]+)/", q_name)
-            if not m:
-                log_details["valid"] = False
-                owner = None
-            elif config.reserved_users_regex and re.match(
-                config.reserved_users_regex, m.group(1)
-            ):
-                # Ignore this queue entirely as we will see it again on the
-                # next iteration.
-                return None
-            else:
-                log_details["valid"] = True
-                owner_name = m.group(1)
-                owner = RabbitMQAccount.get_by(username=owner_name)
-                log_details["ownername"] = owner_name
-                log_details["newowner"] = not owner
-
-                # If the queue belongs to a pulse user that isn't in the
-                # pulseguardian database, add the user to the DB, owned by an
-                # admin.
-                if owner is None:
-                    # RabbitMQAccount needs at least one owner as well, but
-                    # since we have no way of knowing who really owns it, find
-                    # the first admin, and set it to that.
-                    user = db_session.execute(
-                        select(User).where(User.admin == True).limit(1)
-                    ).scalar_one_or_none()
-                    owner = RabbitMQAccount.new_user(owner_name, owners=user)
 
+    def _queue_owner_name(self, queue_name):
+        """Return the name of the RabbitMQ account owning a queue, as given by
+        the ``queue/<owner>/...`` naming convention, or None.
+        """
+        m = QUEUE_OWNER_RE.match(queue_name)
+        return m.group(1) if m else None
+
+    def _is_reserved(self, owner_name):
+        return bool(
+            config.reserved_users_regex
+            and re.match(config.reserved_users_regex, owner_name)
+        )
+
+    def _create_missing_owners(self, queues, state):
+        """Create, in a single batch, the accounts owning the given queues
+        that aren't in the pulseguardian database.
+
+        Those accounts are owned by an admin, as we have no way of knowing
+        who really owns them.  Accounts created since the state was loaded,
+        e.g. from the web app, are looked up first rather than created
+        again.  Returns the names of the created accounts; if creating them
+        fails, the queues of the missing owners are skipped until the next
+        cycle.
+        """
+        owner_names = set()
+        for queue_data in queues:
+            owner_name = self._queue_owner_name(queue_data.name)
+            if (
+                owner_name
+                and owner_name not in state.account_ids
+                and not self._is_reserved(owner_name)
+            ):
+                owner_names.add(owner_name)
+        if not owner_names:
+            return owner_names
+        owner_names -= state.find_accounts(owner_names)
+        if not owner_names:
+            return owner_names
+
+        admin = state.fallback_admin()
+        try:
+            account_ids = RabbitMQAccount.new_users(
+                sorted(owner_names),
+                owners=db_session.get(User, admin[0]) if admin else None,
+            )
+        except Exception:
             mozdef.log(
-                mozdef.NOTICE,
+                mozdef.ERROR,
                 mozdef.OTHER,
-                "New queue.",
-                details=log_details,
-                tags=["queue"],
+                "Failed to create queue owners.",
+                details={
+                    "ownernames": sorted(owner_names),
+                    "message": traceback.format_exc(),
+                },
             )
-            queue = Queue(name=q_name, owner=owner)
+            return set()
+        state.add_accounts(account_ids, [admin[1]] if admin else [])
+        return owner_names
+
+    def _new_queue_owner(self, queue_data, uow, state, new_owners):
+        """Find the id of the RabbitMQ account owning a queue seen for the
+        first time.  ``new_owners`` are the names of the accounts just
+        created by :meth:`_create_missing_owners`.
+
+        Returns a ``(known, owner_id)`` tuple.  ``known`` is False if the
+        queue belongs to a reserved user, or to an account that couldn't be
+        created, and should be ignored for now.
+        """
+        q_name = queue_data.name
+        log_details = {
+            "queuename": q_name,
+            "queuesize": queue_data.messages,
+            "queuedurable": queue_data.durable,
+        }
+        owner_name = self._queue_owner_name(q_name)
+        if owner_name is None:
+            log_details["valid"] = False
+            owner_id = None
+        elif self._is_reserved(owner_name) or owner_name not in state.account_ids:
+            # Ignore this queue entirely as we will see it again on the
+            # next iteration.
+            return False, None
+        else:
+            log_details["valid"] = True
+            owner_id = state.account_ids.get(owner_name)
+            log_details["ownername"] = owner_name
+            log_details["newowner"] = owner_name in new_owners
 
-        # add the queue bindings to the db.
-        bindings = self.get_queue_bindings(all_bindings, queue.name)
-        for binding in bindings:
-            db_binding = db_session.execute(
-                select(Binding).where(
-                    Binding.exchange == binding["source"],
-                    Binding.routing_key == binding["routing_key"],
-                    Binding.queue_name == queue.name,
-                )
-            ).scalar_one_or_none()
-
-            if not db_binding:
-                # need to create the binding in the DB
-                binding = Binding(
-                    exchange=binding["source"],
-                    routing_key=binding["routing_key"],
-                    queue_name=queue.name,
-                )
-                db_session.add(binding)
+        uow.log(
+            mozdef.NOTICE,
+            mozdef.OTHER,
+            "New queue.",
+            details=log_details,
+            tags=["queue"],
+        )
+        return True, owner_id
 
-        # Update the saved queue size.
-        queue.size = q_size
-        queue.durable = q_durable
-        db_session.add(queue)
-        db_session.commit()
-        return queue
+    def _add_missing_bindings(self, binding_index, queue_names, uow, state):
+        """Record the bindings of the named queues that aren't stored yet."""
+        uow.add_bindings(
+            self._alive_bindings(binding_index, queue_names) - state.bindings
+        )
 
-    def monitor_queues(self, queues, all_bindings):
-        for queue_data in queues:
-            # Updating the queue's information in the database (owner, size).
-            queue = self.update_queue_information(queue_data, all_bindings)
-            if not queue:
-                continue
+    def _owner_emails(self, owner_id, state):
+        """Return the email addresses of the users owning a RabbitMQ
+        account.
+        """
+        if not owner_id:
+            return []
+        emails = state.owner_emails.get(owner_id)
+        if emails is None:
+            # The account was created since the state was loaded.
+            owner = db_session.get(RabbitMQAccount, owner_id)
+            emails = [user.email for user in owner.owners] if owner else []
+            state.owner_emails[owner_id] = emails
+        return emails
+
+    def _delete_overgrown_queues(self, overgrown, uow, state, shed=()):
+        """Delete overgrown queues from RabbitMQ, ``config.delete_workers``
+        at a time, and record each successful deletion in ``uow``.
+
+        ``overgrown`` is a list of ``(queue_data, owner_id, thresholds)``
+        triples, as given by :meth:`QueueColumns.thresholds`, of which those
+        named in ``shed`` are deleted to relieve the broker.  Deletions are
+        logged, and their owners notified, as soon as RabbitMQ has deleted
+        the queues, since they are gone even if the database can't be
+        updated.
+        Returns the names of the queues that couldn't be deleted; they are
+        kept, and deleted on a later cycle if still overgrown.
+        """
+        deletions = [
+            (
+                self._delete_executor.submit(
+                    pulse_management.delete_queue,
+                    vhost=queue_data.vhost,
+                    queue=queue_data.name,
+                ),
+                queue_data,
+                owner_id,
+                thresholds,
+            )
+            for queue_data, owner_id, thresholds in overgrown
+        ]
 
-            # If a queue is over the deletion size and ``unbounded`` is
-            # False (the default), then delete it regardless of it having
-            # an owner or not
-            # If ``unbounded`` is True, then let it grow indefinitely.
-            if queue.size > self.del_queue_size and not queue.unbounded:
+        failed = []
+        # Results are recorded in submission order, from this thread only.
+        for future, queue_data, owner_id, thresholds in deletions:
+            q_name = queue_data.name
+            details = self._queue_details_dict(
+                q_name,
+                queue_data.messages,
+                thresholds=thresholds,
+                queue_bytes=queue_data.message_bytes,
+            )
+            try:
+                future.result()
+            except Exception:
                 mozdef.log(
-                    mozdef.NOTICE,
+                    mozdef.ERROR,
                     mozdef.OTHER,
-                    "Deleting queue.",
-                    details=self._queue_details_dict(queue),
+                    "Failed to delete queue.",
+                    details=dict(details, message=traceback.format_exc()),
                     tags=["queue"],
                 )
-                if queue.owner and queue.owner.owners:
-                    self.deletion_email(queue.owner.owners, queue_data)
-                if self.on_delete:
-                    self.on_delete(queue.name)
-                pulse_management.delete_queue(
-                    vhost=queue_data["vhost"], queue=queue.name
-                )
-                db_session.delete(queue)
-                db_session.commit()
-                continue
-
-            if queue.owner is None or not queue.owner.owners:
+                failed.append(q_name)
                 continue
 
-            if queue.size > self.warn_queue_size and not queue.warned:
-                mozdef.log(
-                    mozdef.NOTICE,
-                    mozdef.OTHER,
-                    "Queue-size warning.",
-                    details=self._queue_details_dict(queue),
-                    tags=["queue"],
+            uow.delete_queue(q_name)
+            self.recent_sizes.forget([q_name])
+            mozdef.log(
+                mozdef.NOTICE,
+                mozdef.OTHER,
+                "Deleting queue.",
+                details=details,
+                tags=["queue"],
+            )
+            try:
+                self._notify(
+                    QueueEvent(
+                        SHED if q_name in shed else DELETION,
+                        queue_data,
+                        False,
+                        del_size=thresholds[1],
+                    ),
+                    self._owner_emails(owner_id, state),
                 )
-                queue.warned = True
-                if self.on_warn:
-                    self.on_warn(queue.name)
-                self.warning_email(queue.owner.owners, queue_data, queue.unbounded)
-            elif queue.size <= self.warn_queue_size and queue.warned:
-                # A previously warned queue got out of the warning threshold;
-                # its owner should not be warned again.
+            except Exception:
+                # The queue is gone; a failing email or callback shouldn't
+                # prevent recording it.
                 mozdef.log(
-                    mozdef.NOTICE,
+                    mozdef.ERROR,
                     mozdef.OTHER,
-                    "Queue-size recovered.",
-                    details=self._queue_details_dict(queue),
+                    "Failed to notify of queue deletion.",
+                    details=dict(details, message=traceback.format_exc()),
                     tags=["queue"],
                 )
-                queue.warned = False
-                self.back_to_normal_email(queue.owner.owners, queue_data)
+        return failed
+
+    def monitor_queues(self, queues, bindings, uow=None):
+        """Reconcile the database with a snapshot of RabbitMQ's queues, then
+        warn the owners of overgrowing queues and delete overgrown ones.
+
+        The stored state of every queue is diffed in memory against
+        ``queues``, so that only new, changed and deleted queues are written
+        to the database, as a few bulk statements in a single transaction.
+        Emails, callbacks and logs only happen once that transaction is
+        committed, except for deletions, which can't be undone.
+
+        ``queues`` are ``/api/queues`` items or :class:`QueueRecord` records;
+        ``bindings`` is either a ``/api/bindings`` payload or an index of it
+        built by :meth:`index_bindings`.  Changes are added to ``uow``, a
+        :class:`UnitOfWork`, if given; otherwise they are committed right
+        away.
+        """
+        commit = uow is None
+        if commit:
+            uow = UnitOfWork()
+        if not isinstance(bindings, dict):
+            bindings = self.index_bindings(bindings)
+        state = self._get_state()
+        db_queues = state.queues
+
+        # FIXME: Queues without a size are in a weird state; we should do
+        # something about them, probably delete them.  More investigation is
+        # required.  See bug 1066338.
+        queues = [
+            queue_data
+            for queue_data in map(pulse_management.QueueRecord.from_json, queues)
+            if queue_data.messages is not None
+        ]
+        names = [queue_data.name for queue_data in queues]
+        sizes = np.fromiter(
+            (queue_data.messages for queue_data in queues), np.int64, len(queues)
+        )
+        self.recent_sizes.record_all(names, sizes)
+        if self.history is not None:
+            self.history.record_all(uow, names, sizes)
+
+        # Queues not in the db yet are created, with their owners if needed.
+        rows = list(map(db_queues.get, names))
+        new = [i for i, row in enumerate(rows) if row is None]
+        new_owners = self._create_missing_owners((queues[i] for i in new), state)
+        for i in new:
+            queue_data = queues[i]
+            known, owner_id = self._new_queue_owner(queue_data, uow, state, new_owners)
+            if not known:
+                continue
+            uow.add_queue(
+                name=queue_data.name,
+                owner_id=owner_id,
+                size=queue_data.messages,
+                durable=queue_data.durable,
+                warned=None,
+                message_bytes=queue_data.message_bytes,
+                message_bytes_ram=queue_data.message_bytes_ram,
+                memory=queue_data.memory,
+            )
+            rows[i] = QueueState(
+                queue_data.name,
+                owner_id,
+                queue_data.messages,
+                queue_data.durable,
+                None,
+                False,
+                queue_data.message_bytes,
+            )
+        tracked = queues
+        if new:
+            kept = [i for i, row in enumerate(rows) if row is not None]
+            tracked = [queues[i] for i in kept]
+            names = [names[i] for i in kept]
+            rows = [rows[i] for i in kept]
+            sizes = sizes[kept]
+
+        # Sizes, changes and thresholds are evaluated on all the queues at
+        # once; only the queues whose state changes are then handled one by
+        # one.  Growth is estimated from the queues' recent sizes, including
+        # the current ones.  Thresholds are looked up in the state's
+        # precomputed tables, without querying the database.
+        stored = self.stored_columns.update(names, rows)
+        warn_sizes, del_sizes = self._thresholds(names, stored.owner_ids, state)
+        self.scheduler.observe_all(
+            names,
+            [queue_data.vhost for queue_data in tracked],
+            sizes,
+            (warn_sizes, del_sizes),
+        )
+        forecasts = forecast.forecast(self.recent_sizes, names, del_sizes)
+        columns = QueueColumns(
+            tracked,
+            rows,
+            warn_sizes,
+            del_sizes,
+            forecasts,
+            self.warn_queue_bytes,
+            self._del_queue_bytes(),
+            stored,
+        )
+        for i in columns.size_changed():
+            uow.update_queue(tracked[i].name, size=tracked[i].messages)
+        for i in columns.durable_changed():
+            uow.update_queue(tracked[i].name, durable=tracked[i].durable)
+        # The memory figures are only written along with the bytes of
+        # messages, as they fluctuate on their own.
+        for i in columns.bytes_changed():
+            uow.update_queue(
+                tracked[i].name,
+                message_bytes=tracked[i].message_bytes,
+                message_bytes_ram=tracked[i].message_bytes_ram,
+                memory=tracked[i].memory,
+            )
 
-            # Commit any changes to the queue.
-            db_session.add(queue)
-            db_session.commit()
+        transitions = columns.transitions(self.warn_horizon)
+        # If a queue is over the deletion size and ``unbounded`` is False
+        # (the default), then delete it regardless of it having an owner or
+        # not.  If ``unbounded`` is True, then let it grow indefinitely.
+        overgrown = [
+            (tracked[i], rows[i].owner_id, columns.thresholds(i))
+            for i in transitions.overgrown
+        ]
+        shed = []
+        if self.pressure.level == pressure.EMERGENCY:
+            shed = self._shed_queues(columns, transitions.overgrown)
+            overgrown.extend(shed)
+        overgrown_names = {item[0].name for item in overgrown}
+        kept_names = [name for name in names if name not in overgrown_names]
+
+        # Queues about to be deleted, such as shed ones, are neither warned
+        # about nor recovered; their owners only get the deletion email.
+        for i in transitions.overgrowing:
+            queue_data, row = tracked[i], rows[i]
+            if queue_data.name in overgrown_names:
+                continue
+            owner_emails = self._owner_emails(row.owner_id, state)
+            if not owner_emails:
+                continue
+            growth = forecasts.get(queue_data.name)
+            uow.log(
+                mozdef.NOTICE,
+                mozdef.OTHER,
+                "Queue-size warning.",
+                details=self._queue_details_dict(
+                    queue_data.name,
+                    queue_data.messages,
+                    growth,
+                    columns.thresholds(i),
+                    queue_data.message_bytes,
+                ),
+                tags=["queue"],
+            )
+            uow.update_queue(queue_data.name, warned=True)
+            uow.after_commit(
+                self._notify,
+                QueueEvent(
+                    WARNING,
+                    queue_data,
+                    row.unbounded,
+                    growth,
+                    int(columns.del_sizes[i]),
+                ),
+                owner_emails,
+            )
 
-    def warning_email(self, users, queue_data, is_unbounded):
-        subject = 'Pulse warning: queue "{0}" is overgrowing'.format(queue_data["name"])
+        # Previously warned queues that got out of the warning threshold;
+        # their owners should not be warned again.
+        for i in transitions.recovered:
+            queue_data, row = tracked[i], rows[i]
+            if queue_data.name in overgrown_names:
+                continue
+            owner_emails = self._owner_emails(row.owner_id, state)
+            if not owner_emails:
+                continue
+            uow.log(
+                mozdef.NOTICE,
+                mozdef.OTHER,
+                "Queue-size recovered.",
+                details=self._queue_details_dict(
+                    queue_data.name,
+                    queue_data.messages,
+                    thresholds=columns.thresholds(i),
+                    queue_bytes=queue_data.message_bytes,
+                ),
+                tags=["queue"],
+            )
+            uow.update_queue(queue_data.name, warned=False)
+            uow.after_commit(
+                self._notify,
+                QueueEvent(RECOVERY, queue_data, row.unbounded),
+                owner_emails,
+            )
+
+        # The biggest queues go first, by bytes of messages in an emergency;
+        # the deletion rate limit defers the others to later cycles.
+        if self.pressure.level == pressure.EMERGENCY:
+            overgrown.sort(
+                key=lambda item: (item[0].message_bytes or 0, item[0].messages),
+                reverse=True,
+            )
+        else:
+            overgrown.sort(key=lambda item: item[0].messages, reverse=True)
+        allowed = self.delete_limiter.take(len(overgrown))
+        deferred = [item[0].name for item in overgrown[allowed:]]
+        if deferred:
+            kept_names.extend(deferred)
+            mozdef.log(
+                mozdef.WARNING,
+                mozdef.OTHER,
+                "Queue deletions deferred by the rate limit.",
+                details={
+                    "queuenames": deferred,
+                    "limiter": self.delete_limiter.stats(),
+                },
+                tags=["queue"],
+            )
+
+        # Deletions run concurrently; queues failing to be deleted are kept.
+        kept_names.extend(
+            self._delete_overgrown_queues(
+                overgrown[:allowed],
+                uow,
+                state,
+                shed={queue_data.name for queue_data, _, _ in shed},
+            )
+        )
+
+        self._add_missing_bindings(bindings, kept_names, uow, state)
+        if self.history is not None:
+            self.history.prune(uow)
+
+        if commit:
+            self._commit(uow)
+
+    def _shed_queues(self, columns, overgrown):
+        """Pick the biggest queues to delete, besides the overgrown ones,
+        while the broker is about to block publishers.
+
+        Returns up to ``emergency_deletions`` ``(queue_data, owner_id,
+        thresholds)`` triples of bounded queues over their warning
+        threshold, biggest first.
+        """
+        shed = []
+        for i in columns.largest(self.emergency_deletions, exclude=overgrown):
+            queue_data = columns.queues[i]
+            mozdef.log(
+                mozdef.WARNING,
+                mozdef.OTHER,
+                "Shedding queue under broker pressure.",
+                details=dict(
+                    self._queue_details_dict(
+                        queue_data.name,
+                        queue_data.messages,
+                        thresholds=columns.thresholds(i),
+                        queue_bytes=queue_data.message_bytes,
+                    ),
+                    pressure=self._pressure_details(),
+                ),
+                tags=["queue", "pressure"],
+            )
+            shed.append((queue_data, columns.rows[i].owner_id, columns.thresholds(i)))
+        return shed
+
+    def check_pressure(self):
+        """Poll the cluster's nodes and update the broker's pressure.
+
+        Level changes are logged.  If the nodes can't be polled, the last
+        known pressure is kept.
+        """
+        try:
+            nodes = pulse_management.nodes()
+        except (requests.RequestException, pulse_management.PulseManagementException):
+            mozdef.log(
+                mozdef.WARNING,
+                mozdef.OTHER,
+                "Failed to check the broker's pressure.",
+                details={
+                    "message": traceback.format_exc(),
+                    "pressure": self._pressure_details(),
+                },
+                tags=["management", "pressure"],
+            )
+            return self.pressure
+
+        previous, self.pressure = self.pressure, pressure.assess(
+            nodes, config.pressure_high, config.pressure_emergency
+        )
+        details = self._pressure_details()
+        if self.pressure.level == previous.level:
+            mozdef.log(mozdef.DEBUG, mozdef.OTHER, "Broker pressure.", details=details)
+            return self.pressure
+
+        details["previouslevel"] = previous.level
+        if self.pressure.level != pressure.NORMAL:
+            details["thresholdfactor"] = self.pressure_factor
+        if self.pressure.level == pressure.EMERGENCY:
+            details["emergencydeletions"] = self.emergency_deletions
+        mozdef.log(
+            {
+                pressure.NORMAL: mozdef.NOTICE,
+                pressure.HIGH: mozdef.WARNING,
+                pressure.EMERGENCY: mozdef.CRITICAL,
+            }[self.pressure.level],
+            mozdef.OTHER,
+            "Broker pressure level changed.",
+            details=details,
+            tags=["pressure"],
+        )
+        return self.pressure
+
+    def _pressure_details(self):
+        return {
+            "level": self.pressure.level,
+            "score": round(self.pressure.score, 3),
+            "node": self.pressure.node,
+            "alarms": list(self.pressure.alarms),
+        }
+
+    def _notify(self, event, owner_emails):
+        """Run the callback of a queue event and email the queue's owners,
+        or add the event to their digests.
+        """
+        callback = {
+            WARNING: self.on_warn,
+            DELETION: self.on_delete,
+            SHED: self.on_delete,
+        }.get(event.kind)
+        if callback:
+            callback(event.queue.name)
+
+        if not (self.emails and owner_emails):
+            return
+        if not self.digest:
+            self._event_email(owner_emails, event)
+            return
+        with self._digests_lock:
+            now = time.monotonic()
+            for addr in owner_emails:
+                self._digests.setdefault(addr, (now, []))[1].append(event)
+
+    def flush_digests(self, force=False):
+        """Email the digests collected for more than
+        ``config.email_digest_window`` seconds, or all of them if ``force``.
+        """
+        with self._digests_lock:
+            now = time.monotonic()
+            due = {
+                addr: events
+                for addr, (since, events) in self._digests.items()
+                if force or now - since >= config.email_digest_window
+            }
+            for addr in due:
+                del self._digests[addr]
+
+        for addr, events in sorted(due.items()):
+            if len(events) == 1:
+                self._event_email([addr], events[0])
+            else:
+                self.digest_email([addr], events)
+
+    def _event_email(self, to_addrs, event):
+        if event.kind == WARNING:
+            self.warning_email(
+                to_addrs, event.queue, event.unbounded, event.forecast, event.del_size
+            )
+        elif event.kind == DELETION:
+            self.deletion_email(to_addrs, event.queue, event.del_size)
+        elif event.kind == SHED:
+            self.shed_email(to_addrs, event.queue)
+        else:
+            self.back_to_normal_email(to_addrs, event.queue)
+
+    def warning_email(
+        self, to_addrs, queue_data, is_unbounded, growth=None, del_size=None
+    ):
+        subject = 'Pulse warning: queue "{0}" is overgrowing'.format(queue_data.name)
         if is_unbounded:
             auto_delete_msg = """\
 This queue is unbounded and will not be automatically deleted.
 """.strip()
         else:
             auto_delete_msg = """\
-The queue will be automatically deleted when it exceeds {0} messages.
-""".format(self.del_queue_size).strip()
+The queue will be automatically deleted when it exceeds {0}.
+""".format(self._max_size(del_size)).strip()
+            if growth:
+                auto_delete_msg += """
+At its current rate of {0},
+that will happen in {1}.""".format(
+                    self._format_rate(growth), self._format_time_left(growth)
+                )
         body = """\
 Warning: your queue "{0}" is overgrowing ({1} ready messages,
-{2} total messages).
+{2} total messages{4}).
 
 {3}
 
@@ -314,41 +1039,150 @@ durable queues.
 
 Check messages in the queue at: https://pulseguardian.mozilla.org/queues
 """.format(
-            queue_data["name"],
-            queue_data["messages_ready"],
-            queue_data["messages"],
+            queue_data.name,
+            queue_data.messages_ready,
+            queue_data.messages,
             auto_delete_msg,
+            self._bytes_note(queue_data),
         )
 
-        if self.emails and users:
-            self._sendemail(subject=subject, to_users=users, text_data=body)
+        if self.emails and to_addrs:
+            self._sendemail(subject=subject, to_addrs=to_addrs, text_data=body)
+
+    def deletion_email(self, to_addrs, queue_data, del_size=None):
+        subject = 'Pulse warning: queue "{0}" has been deleted'.format(queue_data.name)
+        body = """\
+Your queue "{0}" been deleted after exceeding its maximum size.  Upon deletion
+there were {1} messages{2} in the queue, out of a maximum {3}.
 
-    def deletion_email(self, users, queue_data):
-        subject = 'Pulse warning: queue "{0}" has been deleted'.format(
-            queue_data["name"]
+Make sure your clients are running correctly and are cleaning up unused
+durable queues.
+""".format(
+            queue_data.name,
+            queue_data.messages,
+            self._bytes_note(queue_data),
+            self._max_size(del_size),
         )
+
+        if self.emails and to_addrs:
+            self._sendemail(subject=subject, to_addrs=to_addrs, text_data=body)
+
+    def shed_email(self, to_addrs, queue_data):
+        subject = 'Pulse warning: queue "{0}" has been deleted'.format(queue_data.name)
         body = """\
-Your queue "{0}" been deleted after exceeding the maximum number of unread
-messages.  Upon deletion there were {1} messages in the queue, out of a maximum
-{2} messages.
+Your queue "{0}" has been deleted to relieve the Pulse broker, which was
+about to run out of memory or disk space.  It was one of the biggest queues,
+with {1} messages{2} upon deletion.
 
 Make sure your clients are running correctly and are cleaning up unused
 durable queues.
-""".format(queue_data["name"], queue_data["messages"], self.del_queue_size)
+""".format(queue_data.name, queue_data.messages, self._bytes_note(queue_data))
 
-        if self.emails and users:
-            self._sendemail(subject=subject, to_users=users, text_data=body)
+        if self.emails and to_addrs:
+            self._sendemail(subject=subject, to_addrs=to_addrs, text_data=body)
 
-    def back_to_normal_email(self, users, queue_data):
-        subject = 'Pulse warning: queue "{0}" is back to normal'.format(
-            queue_data["name"]
+    def back_to_normal_email(self, to_addrs, queue_data):
+        subject = 'Pulse warning: queue "{0}" is back to normal'.format(queue_data.name)
+        body = """\
+your queue "{0}" is now back to normal ({1} ready messages, {2} total messages{3}).
+""".format(
+            queue_data.name,
+            queue_data.messages_ready,
+            queue_data.messages,
+            self._bytes_note(queue_data),
         )
+
+        if self.emails and to_addrs:
+            self._sendemail(subject=subject, to_addrs=to_addrs, text_data=body)
+
+    def digest_email(self, to_addrs, events):
+        names = {event.queue.name for event in events}
+        subject = "Pulse warning: {0} of your queues need attention".format(len(names))
+
+        sections = []
+        deleted = [e for e in events if e.kind == DELETION]
+        if deleted:
+            sections.append(
+                "Deleted after exceeding their maximum size:\n{0}".format(
+                    "\n".join(
+                        '  "{0}": {1} messages{2}, out of a maximum {3}'.format(
+                            e.queue.name,
+                            e.queue.messages,
+                            self._bytes_note(e.queue),
+                            self._max_size(e.del_size),
+                        )
+                        for e in deleted
+                    ),
+                )
+            )
+        shed = [e.queue for e in events if e.kind == SHED]
+        if shed:
+            sections.append(
+                "Deleted to relieve the broker, about to run out of memory or "
+                "disk space:\n{0}".format(
+                    "\n".join(
+                        '  "{0}": {1} messages{2}'.format(
+                            q.name, q.messages, self._bytes_note(q)
+                        )
+                        for q in shed
+                    )
+                )
+            )
+        warned = [e for e in events if e.kind == WARNING]
+        if warned:
+            sections.append(
+                "Overgrowing:\n{0}".format(
+                    "\n".join(
+                        '  "{0}": {1} ready messages, {2} total messages{3}{4}'.format(
+                            e.queue.name,
+                            e.queue.messages_ready,
+                            e.queue.messages,
+                            self._bytes_note(e.queue),
+                            self._digest_note(e),
+                        )
+                        for e in warned
+                    )
+                )
+            )
+        recovered = [e.queue for e in events if e.kind == RECOVERY]
+        if recovered:
+            sections.append(
+                "Back to normal:\n{0}".format(
+                    "\n".join(
+                        '  "{0}": {1} ready messages, {2} total messages{3}'.format(
+                            q.name, q.messages_ready, q.messages, self._bytes_note(q)
+                        )
+                        for q in recovered
+                    )
+                )
+            )
+
         body = """\
-your queue "{0}" is now back to normal ({1} ready messages, {2} total messages).
-""".format(queue_data["name"], queue_data["messages_ready"], queue_data["messages"])
+The following queues of yours changed state.
+
+{0}
 
-        if self.emails and users:
-            self._sendemail(subject=subject, to_users=users, text_data=body)
+Overgrowing queues that aren't unbounded are automatically deleted when they
+exceed their maximum size, {1} unless set otherwise.
+
+Make sure your clients are running correctly and are cleaning up unused
+durable queues.
+
+Check messages in the queue at: https://pulseguardian.mozilla.org/queues
+""".format("\n\n".join(sections), self._max_size())
+
+        if self.emails and to_addrs:
+            self._sendemail(subject=subject, to_addrs=to_addrs, text_data=body)
+
+    def _digest_note(self, event):
+        if event.unbounded:
+            return " (unbounded)"
+        if event.forecast:
+            return ", deleted in {0} at {1}".format(
+                self._format_time_left(event.forecast),
+                self._format_rate(event.forecast),
+            )
+        return ""
 
     def notify_connection_error(self):
         """Log and email to admin(s) that a connection error occurred.
@@ -378,12 +1212,12 @@ Error:
         )
 
         if self.emails and not self._connection_error_notified:
-            admins = list(
-                db_session.execute(select(User).where(User.admin == True)).scalars()
-            )
+            admins = db_session.execute(
+                select(User.email).where(User.admin == True)
+            ).scalars()
             subject = "PulseGuardian error: Can't connect to Pulse"
 
-            self._sendemail(subject=subject, to_users=admins, text_data=errmsg)
+            self._sendemail(subject=subject, to_addrs=list(admins), text_data=errmsg)
             self._connection_error_notified = True
 
     def notify_unknown_error(self):
@@ -413,83 +1247,306 @@ Error:
         )
 
         if self.emails and not self._unknown_error_notified:
-            admins = list(
-                db_session.execute(select(User).where(User.admin == True)).scalars()
-            )
+            admins = db_session.execute(
+                select(User.email).where(User.admin == True)
+            ).scalars()
             subject = "PulseGuardian error: Unknown error"
 
-            self._sendemail(subject=subject, to_users=admins, text_data=errmsg)
+            self._sendemail(subject=subject, to_addrs=list(admins), text_data=errmsg)
             self._unknown_error_notified = True
 
-    def guard(self):
+    def notify_write_failure(self, failures, message):
+        """Email admins that the write-behind flushes keep failing.
+
+        Called from the flusher thread.
+        """
+        if not self.emails:
+            return
+        admins = db_session.execute(
+            select(User.email).where(User.admin == True)
+        ).scalars()
+        errmsg = """Database writes failed {0} times in a row.
+
+The pending changes of each guard cycle are now written on their own, and
+those that still fail are dropped.  Admins are notified again if writes
+keep failing after a successful one.
+
+Error:
+{1}
+""".format(failures, message)
+        self._sendemail(
+            subject="PulseGuardian error: Database writes failing",
+            to_addrs=list(admins),
+            text_data=errmsg,
+        )
+
+    def fetch_snapshot(self):
+        """Fetch the monitored vhost's queues and bindings in parallel.
+
+        Queues are paged through with only the fields the guardian needs
+        (see :class:`pulse_management.QueueSnapshot`) and bindings are
+        streamed.  Returns a list of :class:`QueueRecord` records,
+        an index of the bindings (see :meth:`index_bindings`) and whether
+        the queue list is known to be complete.  Raises
+        :class:`SnapshotTimeout` if both aren't fetched within
+        ``config.snapshot_deadline`` seconds.  Fetches abandoned that way,
+        or because the other one failed, are cancelled between pages and
+        chunks, so that they don't hold up the workers of the next cycles.
+        """
+        cancel = threading.Event()
+        snapshot = pulse_management.QueueSnapshot(
+            vhost=config.rabbit_vhost, cancel=cancel
+        )
+        queues_future = self._fetch_executor.submit(list, snapshot)
+        # Bindings are indexed as they are decoded from the response.
+        bindings_future = self._fetch_executor.submit(
+            self.index_bindings,
+            pulse_management.iter_bindings(config.rabbit_vhost, cancel),
+        )
+        pending = {queues_future, bindings_future}
+
+        done, not_done = futures.wait(
+            pending,
+            timeout=config.snapshot_deadline,
+            return_when=futures.FIRST_EXCEPTION,
+        )
+        if not_done:
+            cancel.set()
+        for future in not_done:
+            future.cancel()
+        for future in done:
+            if future.exception() is not None:
+                raise future.exception()
+        if not_done:
+            raise SnapshotTimeout(
+                "Fetching queues and bindings took more than {} seconds.".format(
+                    config.snapshot_deadline
+                )
+            )
+
+        return queues_future.result(), bindings_future.result(), snapshot.consistent
+
+    def sweep(self):
+        """Run a full guard cycle over all the queues of the vhost."""
+        queues, bindings, complete = self.fetch_snapshot()
+        uow = UnitOfWork()
+        if config.broker_pressure:
+            self.check_pressure()
+
+        # Load the stored state at startup, then periodically to pick up
+        # changes made from the web app.  Threshold overrides are cheap to
+        # read, and reloaded every cycle, as are the accounts if any were
+        # created or deleted.
+        if self._state is None or self._state.age > config.state_resync_interval:
+            self.load_state()
+        else:
+            self._state.load_thresholds(self.warn_queue_size, self.del_queue_size)
+            self.check_accounts()
+
         mozdef.log(
-            mozdef.NOTICE,
-            mozdef.STARTUP,
-            "PulseGuardian started.",
+            mozdef.DEBUG,
+            mozdef.OTHER,
+            "Fetched queue and binding data.",
         )
 
-        while True:
+        if queues:
             mozdef.log(
                 mozdef.DEBUG,
                 mozdef.OTHER,
-                "Guard loop starting.",
+                "Monitoring queues.",
             )
+            self.monitor_queues(queues, bindings, uow)
 
-            try:
-                queues = pulse_management.queues(vhost=config.rabbit_vhost)
-                bindings = pulse_management.bindings(vhost=config.rabbit_vhost)
+        names = {pulse_management.QueueRecord.from_json(q).name for q in queues}
+        if complete:
+            self._unseen_queues = set()
+        else:
+            # Some queues may be missing from the snapshot; only those also
+            # missing from the previous one are taken for deleted ones.
+            unseen = set(self._get_state().queues) - names
+            self._unseen_queues = unseen - self._unseen_queues
+            mozdef.log(
+                mozdef.NOTICE,
+                mozdef.OTHER,
+                "Queues changed while being fetched.",
+                details={"unseen": len(self._unseen_queues)},
+            )
+        mozdef.log(
+            mozdef.DEBUG,
+            mozdef.OTHER,
+            "Clearing deleted queues.",
+        )
+        self.clear_deleted_queues(queues, bindings, uow, keep=self._unseen_queues)
+        names |= self._unseen_queues
+        self.scheduler.retain(names)
+        self.recent_sizes.retain(names)
+        self.stored_columns.retain(names)
+        if self.history is not None:
+            self.history.retain(names)
+
+        # Write the whole cycle's changes in a single transaction, now or
+        # from the write-behind thread.
+        self._commit(uow)
+        self.flush_digests()
+
+    def check_growing_queues(self):
+        """Re-read the queues that the scheduler deems due for a check, one
+        by one, and act on them.  Runs between full sweeps.
+        """
+        due = self.scheduler.pop_due()
+        if not due:
+            return
+
+        mozdef.log(
+            mozdef.DEBUG,
+            mozdef.OTHER,
+            "Checking growing queues.",
+            details={"queuenames": [name for name, _ in due]},
+        )
+        # Queues gone since the last sweep are cleared by the next one.
+        queues = [
+            queue_data
+            for queue_data in self._fetch_executor.map(
+                lambda item: pulse_management.queue(vhost=item[1], queue=item[0]),
+                due,
+            )
+            if queue_data and "error" not in queue_data
+        ]
+        uow = UnitOfWork()
+        self.monitor_queues(queues, {}, uow)
+        self._commit(uow)
+        self.flush_digests()
 
+    def guard(self):
+        mozdef.log(
+            mozdef.NOTICE,
+            mozdef.STARTUP,
+            "PulseGuardian started.",
+        )
+
+        if self._writer is not None:
+            self._writer.start()
+        if self._outbox_worker is not None:
+            self._outbox_worker.start()
+
+        try:
+            while True:
                 mozdef.log(
                     mozdef.DEBUG,
                     mozdef.OTHER,
-                    "Fetched queue and binding data.",
+                    "Guard loop starting.",
                 )
 
-                if queues:
+                try:
+                    if time.monotonic() >= self._next_sweep:
+                        self.sweep()
+                        self._next_sweep = time.monotonic() + config.sweep_interval
+                    else:
+                        self.check_growing_queues()
+
+                    if (
+                        self._connection_error_notified
+                        or self._unknown_error_notified
+                        or self._polling_interval != config.polling_interval
+                    ):
+                        self._reset_notification_error_params()
+                except SnapshotTimeout as e:
                     mozdef.log(
-                        mozdef.DEBUG,
+                        mozdef.WARNING,
                         mozdef.OTHER,
-                        "Monitoring queues.",
+                        "Timed out fetching queue and binding data.",
+                        details={
+                            "managementurl": config.rabbit_management_url,
+                            "message": str(e),
+                        },
+                        tags=["management"],
                     )
-                    self.monitor_queues(queues, bindings)
+                    self._increase_interval()
+                except (requests.ConnectionError, requests.Timeout, socket.error):
+                    self.notify_connection_error()
+                    self._increase_interval()
+                except KeyboardInterrupt:
+                    break
+                except Exception:
+                    self.notify_unknown_error()
+                    self._increase_interval()
 
                 mozdef.log(
                     mozdef.DEBUG,
                     mozdef.OTHER,
-                    "Clearing deleted queues.",
+                    "Sleeping for {} seconds".format(self._polling_interval),
                 )
-                self.clear_deleted_queues(queues, bindings)
-
-                if self._connection_error_notified or self._unknown_error_notified:
-                    self._reset_notification_error_params()
-            except (requests.ConnectionError, socket.error):
-                self.notify_connection_error()
-                self._increase_interval()
-            except KeyboardInterrupt:
-                break
-            except Exception:
-                self.notify_unknown_error()
-                self._increase_interval()
-
-            mozdef.log(
-                mozdef.DEBUG,
-                mozdef.OTHER,
-                "Sleeping for {} seconds".format(self._polling_interval),
-            )
-            time.sleep(self._polling_interval)
-
-    def _queue_details_dict(self, queue):
-        return {
-            "queuename": queue.name,
-            "queuesize": queue.size,
-            "warningthreshold": self.warn_queue_size,
-            "deletionthreshold": self.del_queue_size,
+                time.sleep(self._polling_interval)
+        finally:
+            if self._writer is not None:
+                # Write what is still pending before exiting.
+                self._writer.stop()
+            self.flush_digests(force=True)
+            if self._outbox_worker is not None:
+                self._outbox_worker.stop()
+
+    def _queue_details_dict(
+        self, queue_name, queue_size, growth=None, thresholds=None, queue_bytes=None
+    ):
+        warn_size, del_size = thresholds or (self.warn_queue_size, self.del_queue_size)
+        details = {
+            "queuename": queue_name,
+            "queuesize": queue_size,
+            "warningthreshold": warn_size,
+            "deletionthreshold": del_size,
         }
+        if queue_bytes is not None:
+            details["queuebytes"] = queue_bytes
+        if self.warn_queue_bytes:
+            details["warningbytes"] = self.warn_queue_bytes
+        if self.del_queue_bytes:
+            details["deletionbytes"] = self._del_queue_bytes()
+        if self.pressure.level != pressure.NORMAL:
+            details["brokerpressure"] = self.pressure.level
+        if growth:
+            details["growthrate"] = round(growth.rate, 2)
+            details["timetodeletion"] = round(growth.time_left)
+        return details
+
+    def _max_size(self, del_size=None):
+        """Describe a queue's deletion thresholds, for emails."""
+        max_size = "{0} messages".format(del_size or self.del_queue_size)
+        if self.del_queue_bytes:
+            max_size += " or {0}".format(self._format_bytes(self._del_queue_bytes()))
+        return max_size
+
+    @classmethod
+    def _bytes_note(cls, queue_data):
+        if queue_data.message_bytes is None:
+            return ""
+        return ", {0}".format(cls._format_bytes(queue_data.message_bytes))
+
+    @staticmethod
+    def _format_bytes(size):
+        if size < 1024:
+            return "{0} bytes".format(size)
+        for unit in ("KB", "MB", "GB"):
+            size /= 1024
+            if size < 1024 or unit == "GB":
+                return "{0:.1f} {1}".format(size, unit)
+
+    @staticmethod
+    def _format_rate(growth):
+        return "{0:.1f} messages per second".format(growth.rate)
+
+    @staticmethod
+    def _format_time_left(growth):
+        minutes = int(growth.time_left // 60)
+        if minutes < 1:
+            return "less than a minute"
+        return "about {0} minute{1}".format(minutes, "s" if minutes > 1 else "")
 
 
 if __name__ == "__main__":
     # Initialize the database if necessary.
     init_db()
 
-    pulse_guardian = PulseGuardian(emails=config.email_enabled)
+    pulse_guardian = PulseGuardian(
+        emails=config.email_enabled, write_behind=config.write_behind
+    )
     pulse_guardian.guard()
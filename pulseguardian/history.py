@@ -0,0 +1,278 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""History of the queues' sizes, as observed by the guardian.
+
+Raw samples (:class:`QueueSizeSample`) are only stored when a queue's size
+changes, or once per rollup period for steady queues, so that the thousands
+of idle queues cost next to nothing; they are kept for a short window.
+Rollups (:class:`QueueSizeRollup`) hold the minimum, maximum and average
+size of every observation of a queue over each rollup period, computed in
+memory, and are kept much longer.
+
+The latest sizes of each queue are also kept in memory, in
+:class:`RecentSizes`, for decisions that can't wait on the database.
+"""
+
+import time
+
+import numpy as np
+from sqlalchemy import select
+
+from pulseguardian.model.base import db_session
+from pulseguardian.model.queue_size import QueueSizeRollup, QueueSizeSample
+from pulseguardian.rows import QueueRows
+
+
+class SizeHistory(QueueRows):
+    """Records the queues' sizes in a guard cycle's :class:`UnitOfWork`.
+    The rollup periods of the queues no longer tracked are dropped
+    unfinished.
+
+    :param raw_retention: Time, in seconds, raw samples are kept.
+    :param rollup_interval: Duration, in seconds, of the rollup periods.
+    :param rollup_retention: Time, in seconds, rollups are kept.
+    :param clock: Function returning the current UNIX time.
+    """
+
+    def __init__(
+        self, raw_retention, rollup_interval, rollup_retention, clock=time.time
+    ):
+        # Per queue, the time and size of its last sample (time -1 if none),
+        # then the start (-1 if none), minimum, maximum, total and count of
+        # the observations of its current rollup period.
+        super().__init__(
+            {
+                "last_times": (np.int64, -1, None),
+                "last_sizes": (np.int64, 0, None),
+                "period_starts": (np.int64, -1, None),
+                "min_sizes": (np.int64, 0, None),
+                "max_sizes": (np.int64, 0, None),
+                "totals": (np.int64, 0, None),
+                "counts": (np.int64, 0, None),
+            }
+        )
+        self.raw_retention = raw_retention
+        self.rollup_interval = rollup_interval
+        self.rollup_retention = rollup_retention
+        self._clock = clock
+        # Rollup periods started before the guardian may already be stored.
+        self._started = clock()
+        self._next_prune = 0
+
+    def record(self, uow, name, size):
+        """Record an observation of a queue's size."""
+        self.record_all(uow, [name], [size])
+
+    def record_all(self, uow, names, sizes):
+        """Record an observation of the sizes of the named queues, all
+        distinct.  Only the queues with a sample or rollup to store are
+        handled one by one.
+        """
+        now = int(self._clock())
+        rows = self.rows(names)
+        sizes = np.asarray(sizes, np.int64)
+        last_times = self.last_times[rows]
+        sampled = (last_times < 0) | (
+            (now > last_times)
+            & (
+                (sizes != self.last_sizes[rows])
+                | (now - last_times >= self.rollup_interval)
+            )
+        )
+        for i in np.flatnonzero(sampled):
+            uow.add_size_sample(names[i], now, int(sizes[i]))
+        self.last_times[rows[sampled]] = now
+        self.last_sizes[rows[sampled]] = sizes[sampled]
+
+        period_start = now - now % self.rollup_interval
+        starts = self.period_starts[rows]
+        for i in np.flatnonzero((starts >= 0) & (starts != period_start)):
+            self._close(uow, names[i], rows[i])
+        new = starts != period_start
+        started, continued = rows[new], rows[~new]
+        self.period_starts[started] = period_start
+        for column in (self.min_sizes, self.max_sizes, self.totals):
+            column[started] = sizes[new]
+        self.counts[started] = 1
+        sizes = sizes[~new]
+        self.min_sizes[continued] = np.minimum(self.min_sizes[continued], sizes)
+        self.max_sizes[continued] = np.maximum(self.max_sizes[continued], sizes)
+        self.totals[continued] += sizes
+        self.counts[continued] += 1
+
+    def _close(self, uow, name, row):
+        period_start = int(self.period_starts[row])
+        if period_start >= self._started:
+            uow.add_size_rollup(
+                queue_name=name,
+                period_start=period_start,
+                min_size=int(self.min_sizes[row]),
+                max_size=int(self.max_sizes[row]),
+                avg_size=int(self.totals[row]) / int(self.counts[row]),
+                samples=int(self.counts[row]),
+            )
+
+    def prune(self, uow):
+        """Delete the samples and rollups past their retention, once per
+        rollup period.
+        """
+        now = int(self._clock())
+        if now < self._next_prune:
+            return
+        self._next_prune = now + self.rollup_interval
+        uow.prune_size_history(now - self.raw_retention, now - self.rollup_retention)
+
+
+class SizeRing(object):
+    """A queue's latest ``(time, size)`` samples in :class:`RecentSizes`,
+    times being UNIX timestamps in seconds.
+
+    ``times`` and ``sizes`` are the queue's rows, of ``capacity`` slots
+    filled from the first one, then overwritten oldest first.
+    """
+
+    __slots__ = ("times", "sizes", "start", "count")
+
+    def __init__(self, times, sizes, appended):
+        self.times = times
+        self.sizes = sizes
+        # Index of the oldest sample, and number of samples.
+        self.start = appended % len(sizes) if appended > len(sizes) else 0
+        self.count = min(appended, len(sizes))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def capacity(self):
+        return len(self.sizes)
+
+    def samples(self):
+        """Return the ``(time, size)`` samples, oldest first."""
+        capacity = len(self.sizes)
+        return [
+            (int(self.times[i % capacity]), int(self.sizes[i % capacity]))
+            for i in range(self.start, self.start + self.count)
+        ]
+
+    def latest(self):
+        """Return the latest ``(time, size)`` sample, or None."""
+        if not self.count:
+            return None
+        i = (self.start + self.count - 1) % len(self.sizes)
+        return int(self.times[i]), int(self.sizes[i])
+
+
+class RecentSizes(QueueRows):
+    """The latest sizes of every queue on the broker, in ``(queues,
+    capacity)`` arrays of sample times and sizes used as a ring per queue.
+
+    Each tracked queue takes about ``16 * capacity + 100`` bytes plus its
+    name, i.e. about 1 KB with a capacity of 60, or 20 MB for 20,000
+    queues.
+
+    :param capacity: Number of samples kept per queue.
+    :param clock: Function returning the current UNIX time.
+    """
+
+    def __init__(self, capacity, clock=time.time):
+        # Per queue, its samples, the number of samples ever appended, and
+        # the time of the latest one whose size differs from the previous.
+        super().__init__(
+            {
+                "times": (np.int64, 0, capacity),
+                "sizes": (np.int64, 0, capacity),
+                "appended": (np.int64, 0, None),
+                "changed_at": (np.int64, 0, None),
+            }
+        )
+        self.capacity = capacity
+        self._clock = clock
+
+    def get(self, name):
+        """Return the :class:`SizeRing` of a queue, or None."""
+        row = self._index.get(name)
+        if row is None:
+            return None
+        return SizeRing(self.times[row], self.sizes[row], int(self.appended[row]))
+
+    def record(self, name, size):
+        """Append an observation of a queue's size to its ring."""
+        self.record_all([name], [size])
+
+    def record_all(self, names, sizes):
+        """Append an observation of the sizes of the named queues, all
+        distinct, to their rings.
+        """
+        now = int(self._clock())
+        rows = self.rows(names)
+        sizes = np.asarray(sizes, np.int64)
+        appended = self.appended[rows]
+        changed = (appended == 0) | (
+            self.sizes[rows, (appended - 1) % self.capacity] != sizes
+        )
+        self.changed_at[rows[changed]] = now
+        slots = appended % self.capacity
+        self.times[rows, slots] = now
+        self.sizes[rows, slots] = sizes
+        self.appended[rows] = appended + 1
+
+    def varying(self, rows):
+        """Return whether the sizes in the rings of the given rows (-1 for
+        untracked queues) vary, i.e. whether the queues may be growing.
+        """
+        tracked = rows >= 0
+        rows = np.where(tracked, rows, 0)
+        appended = self.appended[rows]
+        oldest = np.where(appended > self.capacity, appended % self.capacity, 0)
+        return (
+            tracked
+            & (appended >= 2)
+            & (self.changed_at[rows] > self.times[rows, oldest])
+        )
+
+    def window(self, rows):
+        """Return the ``(times, sizes, counts, current)`` arrays of the
+        samples, number of samples and latest size of the given rows.  Only
+        the first ``counts[i]`` samples of row ``i`` are set.
+        """
+        appended = self.appended[rows]
+        latest = self.sizes[rows, (appended - 1) % self.capacity]
+        return (
+            self.times[rows],
+            self.sizes[rows],
+            np.minimum(appended, self.capacity),
+            latest,
+        )
+
+
+def samples(queue_name, since=0):
+    """Return the ``(time, size)`` raw samples of a queue since a UNIX time."""
+    return db_session.execute(
+        select(QueueSizeSample.sampled_at, QueueSizeSample.size)
+        .where(
+            QueueSizeSample.queue_name == queue_name,
+            QueueSizeSample.sampled_at >= since,
+        )
+        .order_by(QueueSizeSample.sampled_at)
+    ).all()
+
+
+def rollups(queue_name, since=0):
+    """Return the rollups of a queue for the periods starting since a UNIX
+    time.
+    """
+    return (
+        db_session.execute(
+            select(QueueSizeRollup)
+            .where(
+                QueueSizeRollup.queue_name == queue_name,
+                QueueSizeRollup.period_start >= since,
+            )
+            .order_by(QueueSizeRollup.period_start)
+        )
+        .scalars()
+        .all()
+    )
@@ -4,10 +4,18 @@
 
 """Wrapper functions around the RabbitMQ management plugin's REST API."""
 
+import codecs
+import collections
 import json
-from urllib.parse import quote
+import os
+import re
+import threading
+from concurrent import futures
+from urllib.parse import quote, urlencode
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
 from pulseguardian import config
 
@@ -16,21 +24,132 @@ class PulseManagementException(Exception):
     pass
 
 
+class FetchCancelled(PulseManagementException):
+    """Raised when a listing is abandoned through its cancel event."""
+
+
+# Interval, in seconds, at which pages in flight check their cancel event.
+CANCEL_POLL_INTERVAL = 0.1
+
+
+def _check_cancel(cancel):
+    if cancel is not None and cancel.is_set():
+        raise FetchCancelled("Fetch cancelled.")
+
+
+# HTTP client
+#
+# All calls share a single pool of keep-alive connections to the management
+# API.  Each thread gets its own ``requests.Session`` (sessions aren't
+# thread-safe) but they all mount the same adapter, and thus the same
+# connections.  The pool is dropped in forked children, e.g. gunicorn
+# workers, so that they never share sockets with their parent.
+
+_client_lock = threading.Lock()
+_client_local = threading.local()
+_adapter = None
+_stats = {"requests": 0, "connections": 0}
+
+
+def _count(stat):
+    with _client_lock:
+        _stats[stat] += 1
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        _count("connections")
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        _count("connections")
+        return super()._new_conn()
+
+
+class _PooledAdapter(HTTPAdapter):
+    """HTTPAdapter counting the new connections it opens."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+def _session():
+    global _adapter
+
+    session = getattr(_client_local, "session", None)
+    if session is None:
+        with _client_lock:
+            if _adapter is None:
+                _adapter = _PooledAdapter(
+                    pool_connections=1,
+                    pool_maxsize=config.rabbit_pool_size,
+                    pool_block=True,
+                )
+            adapter = _adapter
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _client_local.session = session
+    return session
+
+
+def reset_client(close=True):
+    """Drop the pooled connections and reset the client's counters.
+
+    :param close: Whether to close the pooled sockets.  Forked children
+    must not, as the sockets are still in use by their parent.
+    """
+    global _adapter, _client_local
+
+    with _client_lock:
+        if _adapter is not None and close:
+            _adapter.close()
+        _adapter = None
+        _client_local = threading.local()
+        _stats["requests"] = _stats["connections"] = 0
+
+
+def _reset_client_after_fork():
+    global _client_lock
+
+    # The lock may have been held by another thread of the parent process.
+    _client_lock = threading.Lock()
+    reset_client(close=False)
+
+
+os.register_at_fork(after_in_child=_reset_client_after_fork)
+
+
+def client_stats():
+    """Return counters of the pooled client: the number of requests sent,
+    of connections opened and of requests that reused a connection.
+    """
+    with _client_lock:
+        stats = dict(_stats)
+    stats["reused"] = max(stats["requests"] - stats["connections"], 0)
+    return stats
+
+
 def _api_request(path, method="GET", data=None):
     if not config.rabbit_management_url:
         raise PulseManagementException("No RabbitMQ management URL configured.")
 
-    session = requests.Session()
     url = "{0}{1}".format(config.rabbit_management_url, path)
-    request = requests.Request(
+    _count("requests")
+    response = _session().request(
         method,
         url,
         auth=(config.rabbit_user, config.rabbit_password),
         data=json.dumps(data),
-    ).prepare()
-    request.headers["Content-type"] = "application/json"
-    response = session.send(request)
-    session.close()
+        headers={"Content-type": "application/json"},
+        timeout=(config.rabbit_connect_timeout, config.rabbit_read_timeout),
+    )
 
     if response is None or not response.content:
         return None
@@ -45,6 +164,163 @@ def _api_request(path, method="GET", data=None):
         )
 
 
+# Size of the chunks read from streamed responses.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+_ARRAY_SEPARATORS = re.compile(r"[\s,]*")
+
+
+def _iter_json_array(chunks):
+    """Incrementally decode a JSON array from an iterable of text chunks,
+    yielding its items one at a time.
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    started = False
+
+    for chunk in chunks:
+        buf = buf[pos:] + chunk
+        pos = 0
+        while True:
+            pos = _ARRAY_SEPARATORS.match(buf, pos).end()
+            if pos >= len(buf):
+                break
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError("Expected a JSON array, got: {0}".format(buf))
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # The item is cut short; wait for the next chunk.
+                break
+            yield item
+
+    raise ValueError("Truncated JSON array: {0}".format(buf[pos:]))
+
+
+def _api_stream(path, cancel=None):
+    """GET a JSON array from the management API, decoding it as it is
+    received rather than loading the whole response in memory.
+
+    If ``cancel``, a :class:`threading.Event`, is set, the response is
+    closed and :class:`FetchCancelled` raised before the next chunk.
+    """
+    if not config.rabbit_management_url:
+        raise PulseManagementException("No RabbitMQ management URL configured.")
+
+    url = "{0}{1}".format(config.rabbit_management_url, path)
+    _count("requests")
+    response = _session().get(
+        url,
+        auth=(config.rabbit_user, config.rabbit_password),
+        headers={"Content-type": "application/json"},
+        timeout=(config.rabbit_connect_timeout, config.rabbit_read_timeout),
+        stream=True,
+    )
+
+    def decode(chunks):
+        text_decoder = codecs.getincrementaldecoder("utf-8")()
+        for chunk in chunks:
+            _check_cancel(cancel)
+            yield text_decoder.decode(chunk)
+
+    try:
+        _check_cancel(cancel)
+        chunks = decode(response.iter_content(STREAM_CHUNK_SIZE))
+        try:
+            yield from _iter_json_array(chunks)
+        except ValueError as e:
+            raise PulseManagementException(
+                "Error when calling 'GET {0}'. {1}".format(path, e)
+            )
+    finally:
+        response.close()
+
+
+# Compact records
+#
+# The guardian only needs a few fields of each queue and binding; decoding
+# them into tuples rather than keeping the management API's full documents
+# greatly reduces the memory held by a snapshot.
+
+
+class _Record(object):
+    """Base of the compact records, mixed in before their namedtuple."""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_json(cls, data):
+        """Return the record of a management API item, or ``data`` itself if
+        already a record.
+        """
+        if isinstance(data, cls):
+            return data
+        return cls(*(data.get(field) for field in cls._fields))
+
+
+# Fields of the queues needed by the guardian.  ``message_bytes`` is the size
+# of the bodies of the ready and unacknowledged messages, ``message_bytes_ram``
+# the part of it held in memory, and ``memory`` the memory used by the queue
+# process.
+QUEUE_SNAPSHOT_COLUMNS = (
+    "name",
+    "vhost",
+    "messages",
+    "messages_ready",
+    "durable",
+    "message_bytes",
+    "message_bytes_ram",
+    "memory",
+)
+
+
+class QueueRecord(
+    _Record, collections.namedtuple("QueueRecord", QUEUE_SNAPSHOT_COLUMNS)
+):
+    """The fields of a queue the guardian needs.  ``messages`` is None for
+    queues in a weird state (see bug 1066338).
+    """
+
+    __slots__ = ()
+
+
+# Fields of the nodes needed to estimate the broker's pressure.
+NODE_COLUMNS = (
+    "name",
+    "running",
+    "mem_used",
+    "mem_limit",
+    "mem_alarm",
+    "disk_free",
+    "disk_free_limit",
+    "disk_free_alarm",
+)
+
+
+class NodeRecord(_Record, collections.namedtuple("NodeRecord", NODE_COLUMNS)):
+    """The fields of a cluster node the guardian needs."""
+
+    __slots__ = ()
+
+
+class BindingRecord(
+    _Record,
+    collections.namedtuple(
+        "BindingRecord", ("source", "destination", "destination_type", "routing_key")
+    ),
+):
+    """The fields of a binding the guardian needs."""
+
+    __slots__ = ()
+
+
 # Queues
 
 
@@ -56,6 +332,116 @@ def queues(vhost=None):
         return _api_request("queues")
 
 
+class QueueSnapshot(object):
+    """Iterates over a vhost's queues, as :class:`QueueRecord` records.
+
+    Queues are requested ``page_size`` at a time, sorted by name and
+    reduced to the record's fields, with up to ``workers`` pages fetched
+    concurrently.  Iterating is a generator: only the pages in flight are
+    held in memory, and the management plugin only has to serialize one
+    page per request.
+
+    Pages are not an atomic snapshot: queues created or deleted while
+    paging shift the following pages.  If the queue count changed between
+    pages or a queue was seen twice, i.e. if some queues may have been
+    missed, the whole listing is requested once more in a single unpaged,
+    column-filtered request, and the queues missed by paging are yielded
+    last.  Once iteration is over, ``consistent`` is False if that request
+    failed too.
+
+    If ``cancel``, a :class:`threading.Event`, is set, iterating raises
+    :class:`FetchCancelled` between pages, rather than waiting for the
+    pages in flight.
+    """
+
+    def __init__(self, vhost=None, page_size=None, workers=None, cancel=None):
+        self.path = "queues/{0}".format(quote(vhost, "")) if vhost else "queues"
+        self.page_size = page_size or config.rabbit_page_size
+        self.workers = workers or config.rabbit_page_workers
+        self.cancel = cancel
+        self.total = None
+        self.consistent = True
+
+    def _fetch_page(self, page):
+        query = urlencode(
+            {
+                "page": page,
+                "page_size": self.page_size,
+                "columns": ",".join(QueueRecord._fields),
+                "sort": "name",
+            }
+        )
+        return _api_request("{0}?{1}".format(self.path, query))
+
+    def _fetch_all(self):
+        query = urlencode({"columns": ",".join(QueueRecord._fields)})
+        return _api_request("{0}?{1}".format(self.path, query))
+
+    def _result(self, future):
+        """Wait for a page in flight, checking the cancel event."""
+        while True:
+            _check_cancel(self.cancel)
+            try:
+                return future.result(timeout=CANCEL_POLL_INTERVAL)
+            except futures.TimeoutError:
+                pass
+
+    def _check_page(self, page):
+        if page["filtered_count"] != self.total:
+            self.consistent = False
+        return page["items"]
+
+    def __iter__(self):
+        first_page = self._fetch_page(1)
+        self.total = first_page["filtered_count"]
+        self.consistent = True
+        seen = set()
+
+        def check_items(items):
+            for item in items:
+                record = QueueRecord.from_json(item)
+                if record.name in seen:
+                    self.consistent = False
+                    continue
+                seen.add(record.name)
+                yield record
+
+        yield from check_items(self._check_page(first_page))
+
+        page_count = first_page["page_count"]
+        next_page = 2
+        pending = collections.deque()
+        executor = futures.ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="management-page"
+        )
+        try:
+            while next_page <= page_count or pending:
+                while next_page <= page_count and len(pending) < self.workers:
+                    pending.append(executor.submit(self._fetch_page, next_page))
+                    next_page += 1
+                page = self._result(pending.popleft())
+                yield from check_items(self._check_page(page))
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        if len(seen) != self.total:
+            self.consistent = False
+        if self.consistent:
+            return
+
+        _check_cancel(self.cancel)
+        try:
+            items = self._fetch_all()
+        except (PulseManagementException, requests.RequestException):
+            return
+        self.consistent = True
+        for item in items:
+            record = QueueRecord.from_json(item)
+            if record.name not in seen:
+                seen.add(record.name)
+                yield record
+
+
 def queue(vhost, queue):
     vhost = quote(vhost, "")
     queue = quote(queue, "")
@@ -90,6 +476,31 @@ def bindings(vhost):
     return [b for b in bindings if b["source"]]
 
 
+def iter_bindings(vhost, cancel=None):
+    """All bindings for all queues, as :class:`BindingRecord` records decoded
+    while the response is streamed; see :func:`_api_stream` for ``cancel``.
+    """
+    if vhost:
+        vhost = quote(vhost, "")
+        bindings = _api_stream("bindings/{0}".format(vhost), cancel)
+    else:
+        bindings = _api_stream("bindings", cancel)
+    for b in bindings:
+        if b["source"]:
+            yield BindingRecord.from_json(b)
+
+
+# Nodes
+
+
+def nodes():
+    """The cluster's nodes, as :class:`NodeRecord` records.  Only their
+    :data:`NODE_COLUMNS` are requested, which keeps the poll cheap.
+    """
+    query = urlencode({"columns": ",".join(NODE_COLUMNS)})
+    return [NodeRecord.from_json(node) for node in _api_request("nodes?" + query) or []]
+
+
 # Users
 
 
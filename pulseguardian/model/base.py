@@ -5,13 +5,17 @@
 import sys
 import time
 
-from sqlalchemy import create_engine, select
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import DeclarativeBase, scoped_session, sessionmaker
 from sqlalchemy.exc import OperationalError
 
 sys.path.append("..")
 from pulseguardian import config, mozdef
 
+# Maximum number of rows per multi-row INSERT statement.
+INSERT_BATCH_SIZE = 500
+
 
 class Base(DeclarativeBase):
     """Base class for all SQLAlchemy models with convenience query methods."""
@@ -32,6 +36,23 @@ class Base(DeclarativeBase):
         """Get all records for this model."""
         return db_session.execute(select(cls)).scalars().all()
 
+    @classmethod
+    def insert_missing(cls, rows):
+        """Insert rows (dicts of column values) in batches, skipping those
+        conflicting with existing ones on PostgreSQL and SQLite.
+        """
+        dialect = db_session.get_bind().dialect.name
+        if dialect == "postgresql":
+            stmt = postgresql.insert(cls).on_conflict_do_nothing()
+        elif dialect == "sqlite":
+            stmt = sqlite.insert(cls).on_conflict_do_nothing()
+        else:
+            stmt = insert(cls)
+
+        rows = list(rows)
+        for i in range(0, len(rows), INSERT_BATCH_SIZE):
+            db_session.execute(stmt.values(rows[i : i + INSERT_BATCH_SIZE]))
+
 
 engine = create_engine(
     config.database_url,
@@ -2,7 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from sqlalchemy import ForeignKey, String
+from sqlalchemy import ForeignKey, Index, String
 from sqlalchemy.orm import Mapped, mapped_column
 
 from pulseguardian.model.base import Base
@@ -10,6 +10,16 @@ from pulseguardian.model.base import Base
 
 class Binding(Base):
     __tablename__ = "bindings"
+    __table_args__ = (
+        Index(
+            "ix_bindings_queue_name_exchange_routing_key",
+            "queue_name",
+            "exchange",
+            "routing_key",
+            unique=True,
+        ),
+        Index("ix_bindings_queue_name", "queue_name"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     exchange: Mapped[str] = mapped_column(String(255))
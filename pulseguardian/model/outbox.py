@@ -0,0 +1,53 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from datetime import datetime, timezone
+from typing import Optional
+
+from sqlalchemy import DateTime, Index, Integer, String, Text
+from sqlalchemy.orm import Mapped, mapped_column
+
+from pulseguardian.model.base import Base
+
+PENDING = "pending"
+SENT = "sent"
+FAILED = "failed"
+
+
+def utcnow():
+    """Return the current UTC time as a naive datetime, as stored."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class OutboxEmail(Base):
+    """An email waiting to be sent, or already sent, by the outbox worker."""
+
+    __tablename__ = "email_outbox"
+    __table_args__ = (
+        Index("ix_email_outbox_state_next_attempt_at", "state", "next_attempt_at"),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    # Comma-separated recipient addresses.
+    to_addrs: Mapped[str] = mapped_column(Text)
+    subject: Mapped[str] = mapped_column(String(255))
+    text_data: Mapped[str] = mapped_column(Text)
+    # One of PENDING, SENT or FAILED (once out of attempts).
+    state: Mapped[str] = mapped_column(String(16), default=PENDING)
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=utcnow)
+    next_attempt_at: Mapped[datetime] = mapped_column(DateTime, default=utcnow)
+    sent_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+
+    @property
+    def recipients(self):
+        return self.to_addrs.split(",")
+
+    def __repr__(self):
+        return "<OutboxEmail(subject='{0}', state='{1}')>".format(
+            self.subject, self.state
+        )
+
+    __str__ = __repr__
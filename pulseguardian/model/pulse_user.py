@@ -3,7 +3,7 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import re
-from typing import List, TYPE_CHECKING
+from typing import List, Optional, TYPE_CHECKING
 
 from sqlalchemy import Integer, String
 from sqlalchemy.orm import Mapped, mapped_column, relationship
@@ -25,6 +25,9 @@ class RabbitMQAccount(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True)
     username: Mapped[str] = mapped_column(String(255), unique=True)
+    # Thresholds of the account's queues, overriding the global ones if set.
+    warn_queue_size: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    del_queue_size: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
 
     queues: Mapped[List["Queue"]] = relationship(
         back_populates="owner", cascade="save-update, merge, delete"
@@ -57,6 +60,43 @@ class RabbitMQAccount(Base):
 
         return rabbitmq_account
 
+    @staticmethod
+    def new_users(usernames, owners=None, create_rabbitmq_user=True):
+        """Like :meth:`new_user`, for several accounts without passwords,
+        stored in a single transaction.
+
+        The accounts are inserted before their RabbitMQ users are created,
+        so that none is created for an account that already exists.  If
+        anything fails, the transaction is rolled back and the error
+        re-raised.
+
+        Returns a dict mapping the usernames to the new accounts' ids.
+        """
+        if owners and not isinstance(owners, list):
+            owners = [owners]
+        rabbitmq_accounts = [
+            RabbitMQAccount(owners=list(owners or []), username=username)
+            for username in usernames
+        ]
+
+        try:
+            db_session.add_all(rabbitmq_accounts)
+            db_session.flush()
+            # Read the ids before committing expires them.
+            account_ids = {
+                account.username: account.id for account in rabbitmq_accounts
+            }
+            if create_rabbitmq_user:
+                for rabbitmq_account in rabbitmq_accounts:
+                    rabbitmq_account._create_user("")
+                    rabbitmq_account._set_permissions()
+            db_session.commit()
+        except Exception:
+            db_session.rollback()
+            raise
+
+        return account_ids
+
     @staticmethod
     def strong_password(password):
         return (
@@ -96,6 +136,16 @@ class RabbitMQAccount(Base):
             write=write_conf_perms,
         )
 
+    def effective_thresholds(self):
+        """Return the ``(warning, deletion)`` thresholds of the account's
+        queues, unless set on the queues themselves.
+        """
+        warn_size, del_size = self.warn_queue_size, self.del_queue_size
+        return (
+            config.warn_queue_size if warn_size is None else warn_size,
+            config.del_queue_size if del_size is None else del_size,
+        )
+
     def __repr__(self):
         return "<RabbitMQAccount(username='{0}', owners='{1}')>".format(
             self.username, ", ".join([owner.email for owner in self.owners])
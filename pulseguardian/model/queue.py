@@ -4,9 +4,10 @@
 
 from typing import List, Optional
 
-from sqlalchemy import Boolean, ForeignKey, Integer, String
+from sqlalchemy import BigInteger, Boolean, ForeignKey, Integer, String
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
+from pulseguardian import config
 from pulseguardian.model.base import Base
 from pulseguardian.model.binding import Binding
 from pulseguardian.model.pulse_user import RabbitMQAccount
@@ -24,12 +25,32 @@ class Queue(Base):
     unbounded: Mapped[bool] = mapped_column(Boolean, default=False)
     warned: Mapped[Optional[bool]] = mapped_column(Boolean, nullable=True)
     durable: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+    # bytes of message bodies, of those in memory, and memory of the queue
+    message_bytes: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
+    message_bytes_ram: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
+    memory: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
+    # thresholds overriding the owner's and the global ones, if set
+    warn_queue_size: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    del_queue_size: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
 
     bindings: Mapped[List["Binding"]] = relationship(
         cascade="save-update, merge, delete"
     )
     owner: Mapped[Optional["RabbitMQAccount"]] = relationship(back_populates="queues")
 
+    def effective_thresholds(self):
+        """Return the queue's ``(warning, deletion)`` thresholds: its own if
+        set, else its owner's, else the global ones.
+        """
+        if self.owner:
+            warn_size, del_size = self.owner.effective_thresholds()
+        else:
+            warn_size, del_size = config.warn_queue_size, config.del_queue_size
+        return (
+            warn_size if self.warn_queue_size is None else self.warn_queue_size,
+            del_size if self.del_queue_size is None else self.del_queue_size,
+        )
+
     def __repr__(self):
         return "<Queue(name='{0}', owner='{1}')>".format(self.name, self.owner)
 
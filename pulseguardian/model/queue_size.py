@@ -0,0 +1,54 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from sqlalchemy import Float, Index, Integer, String
+from sqlalchemy.orm import Mapped, mapped_column
+
+from pulseguardian.model.base import Base
+
+
+class QueueSizeSample(Base):
+    """A queue's size when it changed, or when its last sample got older
+    than the rollup period.  The size holds until the queue's next sample.
+
+    Samples outlive their queue, until pruned; times are UNIX timestamps.
+    """
+
+    __tablename__ = "queue_size_samples"
+    __table_args__ = (Index("ix_queue_size_samples_sampled_at", "sampled_at"),)
+
+    queue_name: Mapped[str] = mapped_column(String(255), primary_key=True)
+    sampled_at: Mapped[int] = mapped_column(Integer, primary_key=True)
+    size: Mapped[int] = mapped_column(Integer)
+
+    def __repr__(self):
+        return "<QueueSizeSample(queue_name='{0}', sampled_at={1}, size={2})>".format(
+            self.queue_name, self.sampled_at, self.size
+        )
+
+    __str__ = __repr__
+
+
+class QueueSizeRollup(Base):
+    """The minimum, maximum and average size of a queue over the period
+    starting at ``period_start``, as observed by the guardian.
+    """
+
+    __tablename__ = "queue_size_rollups"
+    __table_args__ = (Index("ix_queue_size_rollups_period_start", "period_start"),)
+
+    queue_name: Mapped[str] = mapped_column(String(255), primary_key=True)
+    period_start: Mapped[int] = mapped_column(Integer, primary_key=True)
+    min_size: Mapped[int] = mapped_column(Integer)
+    max_size: Mapped[int] = mapped_column(Integer)
+    avg_size: Mapped[float] = mapped_column(Float)
+    # Number of observations the rollup was computed from.
+    samples: Mapped[int] = mapped_column(Integer)
+
+    def __repr__(self):
+        return "<QueueSizeRollup(queue_name='{0}', period_start={1})>".format(
+            self.queue_name, self.period_start
+        )
+
+    __str__ = __repr__
@@ -0,0 +1,218 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Persistent outbox for the guardian's emails, delivered from a background
+thread so that a slow SMTP server doesn't hold up the guard loop.
+"""
+
+import threading
+import traceback
+from datetime import timedelta
+
+from sqlalchemy import delete, func, select
+
+from pulseguardian import config, mozdef
+from pulseguardian.model.base import db_session
+from pulseguardian.model.outbox import FAILED, PENDING, SENT, OutboxEmail, utcnow
+from pulseguardian.sendemail import Mailer
+
+
+def enqueue(to_addrs, subject, text_data):
+    """Store an email in the outbox, to be sent by an :class:`OutboxWorker`."""
+    db_session.add(
+        OutboxEmail(to_addrs=",".join(to_addrs), subject=subject, text_data=text_data)
+    )
+    db_session.commit()
+
+
+def default_mailer():
+    """Return a :class:`Mailer` for the configured SMTP server."""
+    return Mailer(
+        from_addr=config.email_from,
+        server=config.email_smtp_server,
+        port=config.email_smtp_port,
+        username=config.email_account,
+        password=config.email_password,
+        use_ssl=config.email_ssl,
+        timeout=config.email_smtp_timeout,
+    )
+
+
+class OutboxWorker(object):
+    """Sends the emails of the outbox from a background thread.
+
+    Every ``interval`` seconds, the pending emails that are due are sent,
+    oldest first.  An email that fails to be sent is retried after
+    ``retry_delay`` seconds, doubling with every attempt up to
+    ``retry_max_delay``, and given up on after ``max_attempts``.  Sent and
+    failed emails are deleted once older than ``retention`` days, unless it
+    is 0.
+
+    The emails of a batch are sent over a single SMTP connection, closed
+    once the batch is done.
+
+    :param mailer: The :class:`Mailer` to send emails with; defaults to one
+                   for the configured SMTP server.
+    """
+
+    def __init__(
+        self,
+        interval=config.email_outbox_interval,
+        batch_size=config.email_outbox_batch_size,
+        max_attempts=config.email_max_attempts,
+        retry_delay=config.email_retry_delay,
+        retry_max_delay=config.email_retry_max_delay,
+        retention=config.email_outbox_retention,
+        mailer=None,
+    ):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self.retention = retention
+        self.mailer = mailer if mailer is not None else default_mailer()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {
+            "sent": 0,
+            "retried": 0,
+            "failed": 0,
+            "pruned": 0,
+        }
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="guardian-outbox", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        """Return the delivery counters and SMTP timings, along with the
+        outbox depth, i.e. the number of emails waiting to be sent.
+        """
+        depth = db_session.execute(
+            select(func.count()).where(OutboxEmail.state == PENDING)
+        ).scalar_one()
+        stats = dict(self._stats, depth=depth)
+        for key, value in self.mailer.stats().items():
+            stats["smtp_" + key] = value
+        return stats
+
+    def deliver(self):
+        """Send a batch of due emails, and prune the old ones.  Returns the
+        number of emails sent.
+        """
+        due = (OutboxEmail.state == PENDING, OutboxEmail.next_attempt_at <= utcnow())
+        email_ids = (
+            db_session.execute(
+                select(OutboxEmail.id)
+                .where(*due)
+                .order_by(OutboxEmail.id)
+                .limit(self.batch_size)
+            )
+            .scalars()
+            .all()
+        )
+
+        # Each email is committed as soon as it's sent, so that it isn't sent
+        # again if a later one fails to be.  Concurrent workers skip each
+        # other's emails where supported.
+        sent = 0
+        try:
+            for email_id in email_ids:
+                email = db_session.execute(
+                    select(OutboxEmail)
+                    .where(OutboxEmail.id == email_id, *due)
+                    .with_for_update(skip_locked=True)
+                ).scalar_one_or_none()
+                if email is None:
+                    continue
+                sent += self._send(email)
+                db_session.commit()
+        finally:
+            self.mailer.close()
+        self._prune()
+        db_session.commit()
+        return sent
+
+    def _prune(self):
+        """Delete the emails sent or given up on more than ``retention``
+        days ago.
+        """
+        if not self.retention:
+            return
+        # Failed emails have no sending time; their age counts from their
+        # creation.
+        result = db_session.execute(
+            delete(OutboxEmail).where(
+                OutboxEmail.state != PENDING,
+                func.coalesce(OutboxEmail.sent_at, OutboxEmail.created_at)
+                < utcnow() - timedelta(days=self.retention),
+            )
+        )
+        self._stats["pruned"] += result.rowcount
+
+    def _send(self, email):
+        """Send an email and update its state.  Returns True if sent."""
+        email.attempts += 1
+        try:
+            self.mailer.send(email.recipients, email.subject, email.text_data)
+        except Exception as e:
+            email.last_error = "{0}: {1}".format(type(e).__name__, e)
+            if email.attempts >= self.max_attempts:
+                email.state = FAILED
+                self._stats["failed"] += 1
+                mozdef.log(
+                    mozdef.ERROR,
+                    mozdef.OTHER,
+                    "Giving up sending email.",
+                    details={
+                        "subject": email.subject,
+                        "attempts": email.attempts,
+                        "message": email.last_error,
+                    },
+                )
+            else:
+                delay = min(
+                    self.retry_delay * 2 ** (email.attempts - 1),
+                    self.retry_max_delay,
+                )
+                email.next_attempt_at = utcnow() + timedelta(seconds=delay)
+                self._stats["retried"] += 1
+            return False
+
+        email.state = SENT
+        email.sent_at = utcnow()
+        email.last_error = None
+        self._stats["sent"] += 1
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.deliver()
+                mozdef.log(
+                    mozdef.DEBUG,
+                    mozdef.OTHER,
+                    "Email outbox status.",
+                    details=self.stats(),
+                )
+            except Exception:
+                db_session.rollback()
+                mozdef.log(
+                    mozdef.ERROR,
+                    mozdef.OTHER,
+                    "Email outbox delivery failed.",
+                    details={"message": traceback.format_exc()},
+                )
+            self._stop.wait(self.interval)
+        db_session.remove()
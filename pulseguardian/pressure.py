@@ -0,0 +1,68 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Pressure of the broker's nodes on their memory and disk limits, past
+which RabbitMQ raises an alarm and blocks all publishers.
+"""
+
+from collections import namedtuple
+
+# Pressure levels, by increasing severity.
+NORMAL = "normal"
+HIGH = "high"
+EMERGENCY = "emergency"
+
+# Pressure of the cluster: ``score`` is that of its most pressed node, named
+# ``node``, and ``alarms`` describe the alarms raised on its nodes.
+Pressure = namedtuple("Pressure", ["score", "level", "node", "alarms"])
+
+NO_PRESSURE = Pressure(0.0, NORMAL, None, ())
+
+
+def node_score(node):
+    """Return the pressure of a :class:`NodeRecord`: the highest of its
+    memory use relative to its memory high watermark and of its free disk
+    limit relative to its free disk space.  RabbitMQ raises an alarm at 1.
+    """
+    scores = [0.0]
+    if node.mem_used is not None and node.mem_limit:
+        scores.append(node.mem_used / node.mem_limit)
+    if node.disk_free is not None and node.disk_free_limit:
+        scores.append(
+            node.disk_free_limit / node.disk_free if node.disk_free > 0 else 1.0
+        )
+    return max(scores)
+
+
+def assess(nodes, high, emergency):
+    """Return the :class:`Pressure` of a cluster from its nodes' records.
+
+    The level is :data:`EMERGENCY` if any running node has an alarm raised
+    or a score of at least ``emergency``, :data:`HIGH` if at least ``high``
+    and :data:`NORMAL` otherwise.
+    """
+    score, pressed_node, alarms = 0.0, None, []
+    for node in nodes:
+        if node.running is False:
+            continue
+        node_alarms = [
+            "{0}: {1}".format(node.name, kind)
+            for kind, raised in (
+                ("memory", node.mem_alarm),
+                ("disk", node.disk_free_alarm),
+            )
+            if raised
+        ]
+        alarms.extend(node_alarms)
+        node_pressure = max(node_score(node), 1.0 if node_alarms else 0.0)
+        if pressed_node is None or node_pressure > score:
+            score, pressed_node = node_pressure, node.name
+
+    if alarms or score >= emergency:
+        level = EMERGENCY
+    elif score >= high:
+        level = HIGH
+    else:
+        level = NORMAL
+    return Pressure(score, level, pressed_node, tuple(alarms))
@@ -0,0 +1,66 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Rate limiting of the guardian's calls to the broker."""
+
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Token bucket refilled with ``rate`` tokens per second, holding at most
+    ``burst`` tokens.  It starts full.
+
+    :param rate: Tokens added per second; 0 or less disables the limit.
+    :param burst: Maximum number of tokens, i.e. of calls allowed at once.
+    :param clock: Function returning the current time, in seconds.
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._lock = threading.Lock()
+        self._stats = {
+            "acquired": 0,
+            "deferred": 0,
+        }
+
+    @property
+    def unlimited(self):
+        return self.rate <= 0
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self, count):
+        """Take up to ``count`` tokens.  Returns the number of tokens taken;
+        the calls left over should be deferred.
+        """
+        with self._lock:
+            if self.unlimited:
+                self._stats["acquired"] += count
+                return count
+            self._refill()
+            taken = min(count, int(self._tokens))
+            self._tokens -= taken
+            self._stats["acquired"] += taken
+            self._stats["deferred"] += count - taken
+            return taken
+
+    def stats(self):
+        """Return the bucket's settings, current tokens and counters."""
+        with self._lock:
+            if not self.unlimited:
+                self._refill()
+            return dict(
+                self._stats,
+                rate=self.rate,
+                burst=self.burst,
+                tokens=None if self.unlimited else round(self._tokens, 2),
+            )
@@ -0,0 +1,100 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Per-queue state kept in numpy arrays, so that it can be updated for all
+the queues of a snapshot at once.
+"""
+
+from itertools import repeat
+
+import numpy as np
+
+# Number of rows allocated at first.
+INITIAL_ROWS = 64
+
+
+class QueueRows(object):
+    """Assigns each tracked queue a row of preallocated numpy arrays, kept
+    from one guard cycle to the next.
+
+    ``columns`` maps attribute names to ``(dtype, fill value, width)``
+    triples; columns with a width are 2-D.  Rows are reset to the fill
+    values when assigned to a queue, and reused once their queue is
+    forgotten; the arrays double in size when full.  The rows of the last
+    names looked up are kept until a queue is tracked or forgotten, as the
+    snapshots of consecutive cycles mostly have the same queues.
+    """
+
+    def __init__(self, columns):
+        self._columns = columns
+        # Queue name -> row.
+        self._index = {}
+        self._free = []
+        self._allocated = 0
+        # (names, rows) of the last lookup.
+        self._found = None
+        for attr, (dtype, fill, width) in columns.items():
+            shape = (INITIAL_ROWS,) if width is None else (INITIAL_ROWS, width)
+            setattr(self, attr, np.full(shape, fill, dtype))
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def find(self, names):
+        """Return the rows of the named queues, -1 for untracked ones."""
+        if self._found is not None and self._found[0] == names:
+            return self._found[1].copy()
+        rows = np.fromiter(
+            map(self._index.get, names, repeat(-1)), np.int64, len(names)
+        )
+        self._found = (list(names), rows.copy())
+        return rows
+
+    def rows(self, names):
+        """Return the rows of the named queues, assigning rows to the
+        untracked ones.
+        """
+        rows = self.find(names)
+        for i in np.flatnonzero(rows < 0):
+            rows[i] = self._assign(names[i])
+        return rows
+
+    def _assign(self, name):
+        row = self._index.get(name)
+        if row is not None:
+            return row
+        if self._free:
+            row = self._free.pop()
+        else:
+            row = self._allocated
+            self._allocated += 1
+            if row == len(getattr(self, next(iter(self._columns)))):
+                self._grow()
+        for attr, (_, fill, _) in self._columns.items():
+            getattr(self, attr)[row] = fill
+        self._index[name] = row
+        self._found = None
+        return row
+
+    def _grow(self):
+        for attr, (dtype, fill, _) in self._columns.items():
+            old = getattr(self, attr)
+            new = np.full((2 * len(old),) + old.shape[1:], fill, dtype)
+            new[: len(old)] = old
+            setattr(self, attr, new)
+
+    def forget(self, names):
+        """Stop tracking the named queues, e.g. once deleted."""
+        for name in names:
+            row = self._index.pop(name, None)
+            if row is not None:
+                self._free.append(row)
+                self._found = None
+
+    def retain(self, names):
+        """Stop tracking the queues not in ``names``."""
+        self.forget(set(self._index).difference(names))
@@ -0,0 +1,154 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Scheduling of the checks of fast-growing queues between full sweeps."""
+
+import heapq
+import time
+
+import numpy as np
+
+from pulseguardian.rows import QueueRows
+
+# Weight of the latest sample in a queue's smoothed growth rate.
+RATE_SMOOTHING = 0.5
+# Fraction of the estimated time until a queue reaches its next threshold
+# after which it is checked again, to absorb bursts.
+SAFETY_FACTOR = 0.5
+
+
+class QueueScheduler(QueueRows):
+    """Keeps a priority queue of the times at which growing queues should
+    be checked again.
+
+    Each observation of a queue's size updates its smoothed growth rate,
+    from which the time left until it reaches the next of the warning and
+    deletion thresholds is estimated.  Growing queues are scheduled to be
+    checked again well before then, at most every ``min_interval`` and at
+    least every ``max_interval`` seconds; queues that aren't growing, or are
+    past the deletion threshold, aren't scheduled.
+
+    :param thresholds: Queue sizes at which the guardian acts.
+    :param min_interval: Minimum time, in seconds, between checks of a queue.
+    :param max_interval: Maximum time, in seconds, between checks of a queue.
+    :param clock: Function returning the current time, in seconds.
+    """
+
+    def __init__(self, thresholds, min_interval, max_interval, clock=time.monotonic):
+        # Per queue, its size at its last observation, the time of that
+        # observation (NaN if none), its growth rate, and whether it's
+        # scheduled.
+        super().__init__(
+            {
+                "sizes": (np.int64, 0, None),
+                "times": (float, np.nan, None),
+                "rates": (float, 0.0, None),
+                "scheduled": (bool, False, None),
+            }
+        )
+        self.thresholds = sorted(thresholds)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._clock = clock
+        # Queue name -> (due time, vhost) of the scheduled queues.
+        self._due = {}
+        # (due time, queue name) entries; superseded ones are skipped.
+        self._heap = []
+
+    def __len__(self):
+        return len(self._due)
+
+    def observe(self, name, vhost, size, thresholds=None):
+        """Record a queue's size and reschedule its next check.
+
+        ``thresholds`` override the scheduler's ones for this queue.
+        """
+        self.observe_all([name], [vhost], [size], thresholds)
+
+    def observe_all(self, names, vhosts, sizes, thresholds=None):
+        """Record the sizes of the named queues, all distinct, and
+        reschedule their next checks.  Only the growing queues are then
+        handled one by one.
+
+        ``thresholds`` override the scheduler's ones; each is for all the
+        queues or per queue.
+        """
+        now = self._clock()
+        rows = self.rows(names)
+        sizes = np.asarray(sizes, np.int64)
+        elapsed = now - self.times[rows]
+        # Never-observed queues have a NaN time, hence no elapsed time.
+        advanced = elapsed > 0
+        sample = np.divide(
+            sizes - self.sizes[rows],
+            elapsed,
+            out=np.zeros(len(rows)),
+            where=advanced,
+        )
+        rates = np.where(
+            advanced,
+            RATE_SMOOTHING * sample + (1 - RATE_SMOOTHING) * self.rates[rows],
+            self.rates[rows],
+        )
+        self.sizes[rows] = sizes
+        self.times[rows] = now
+        self.rates[rows] = rates
+
+        # The next threshold of each queue, infinite past the last one.
+        thresholds = self.thresholds if thresholds is None else thresholds
+        limits = np.empty((len(thresholds), len(rows)))
+        for limit, t in zip(limits, thresholds):
+            limit[:] = t
+        threshold = np.where(limits >= sizes, limits, np.inf).min(
+            axis=0, initial=np.inf
+        )
+        growing = (rates > 0) & np.isfinite(threshold)
+        interval = np.divide(
+            SAFETY_FACTOR * (threshold - sizes),
+            rates,
+            out=np.zeros(len(rows)),
+            where=growing,
+        )
+        due = now + np.clip(interval, self.min_interval, self.max_interval)
+
+        for i in np.flatnonzero(self.scheduled[rows] & ~growing):
+            self._due.pop(names[i], None)
+        self.scheduled[rows] = growing
+        for i in np.flatnonzero(growing):
+            name = names[i]
+            self._due[name] = (float(due[i]), vhosts[i])
+            heapq.heappush(self._heap, (float(due[i]), name))
+
+    def forget(self, names):
+        """Stop tracking the named queues, e.g. once deleted."""
+        names = list(names)
+        super().forget(names)
+        for name in names:
+            self._due.pop(name, None)
+
+    def next_due(self):
+        """Return the time of the next scheduled check, or None."""
+        self._discard_superseded()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self):
+        """Unschedule the queues due for a check and return their
+        ``(name, vhost)`` pairs, earliest first.
+        """
+        now = self._clock()
+        due = []
+        while self._discard_superseded() and self._heap[0][0] <= now:
+            _, name = heapq.heappop(self._heap)
+            due.append((name, self._due.pop(name)[1]))
+        return due
+
+    def _discard_superseded(self):
+        """Pop the heap's superseded entries.  Returns whether any is left."""
+        while self._heap:
+            due, name = self._heap[0]
+            scheduled = self._due.get(name)
+            if scheduled is not None and scheduled[0] == due:
+                return True
+            heapq.heappop(self._heap)
+        return False
@@ -4,6 +4,8 @@
 
 import smtplib
 import sys
+import threading
+import time
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
@@ -27,6 +29,128 @@ if sys.hexversion < 0x020603F0:
     smtplib.SMTP_SSL._get_socket = _get_socket_fixed
 
 
+def _build_message(from_addr, to_addrs, subject, text_data, html_data):
+    if not from_addr or not to_addrs:
+        raise Exception("Both from_addr and to_addrs must be specified")
+    if not text_data and not html_data:
+        raise Exception("Must specify either text_data or html_data")
+
+    if not html_data:
+        msg = MIMEText(text_data)
+    elif not text_data:
+        msg = MIMEMultipart()
+        msg.preamble = subject
+        msg.attach(MIMEText(html_data, "html"))
+    else:
+        msg = MIMEMultipart("alternative")
+        msg.attach(MIMEText(text_data, "plain"))
+        msg.attach(MIMEText(html_data, "html"))
+
+    msg["Subject"] = subject
+    msg["From"] = from_addr
+    msg["To"] = ", ".join(to_addrs)
+    return msg
+
+
+class Mailer(object):
+    """Sends emails over a single, authenticated SMTP session.
+
+    The session is opened on the first send and reused by the following
+    ones until :meth:`close` is called; if the server drops it in the
+    meantime, it is reopened.  :meth:`stats` reports the time spent
+    sending, so that SMTP latency can be told apart from the rest.
+
+    :param timeout: Timeout, in seconds, of the SMTP socket operations.
+    """
+
+    def __init__(
+        self,
+        from_addr=None,
+        server="smtp.mozilla.org",
+        port=25,
+        username=None,
+        password=None,
+        use_ssl=False,
+        timeout=None,
+    ):
+        self.from_addr = from_addr
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self._smtp = None
+        self._lock = threading.Lock()
+        self._stats = {
+            "sent": 0,
+            "connections": 0,
+            "last_send_seconds": 0.0,
+            "max_send_seconds": 0.0,
+            "total_send_seconds": 0.0,
+        }
+
+    def _connect(self):
+        smtp_class = smtplib.SMTP_SSL if self.use_ssl else smtplib.SMTP
+        smtp = smtp_class(self.server, self.port, timeout=self.timeout)
+        try:
+            if self.username and self.password:
+                smtp.login(self.username, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        self._stats["connections"] += 1
+        return smtp
+
+    def send(self, to_addrs, subject="No Subject", text_data=None, html_data=None):
+        """Sends an email.  See :func:`sendemail`."""
+        msg = _build_message(self.from_addr, to_addrs, subject, text_data, html_data)
+
+        with self._lock:
+            start = time.monotonic()
+            reconnected = self._smtp is None
+            while True:
+                if self._smtp is None:
+                    self._smtp = self._connect()
+                try:
+                    self._smtp.sendmail(self.from_addr, to_addrs, msg.as_string())
+                except smtplib.SMTPServerDisconnected:
+                    self._smtp = None
+                    # Only retry on a session reused from a previous send.
+                    if reconnected:
+                        raise
+                    reconnected = True
+                else:
+                    break
+
+            elapsed = time.monotonic() - start
+            self._stats["sent"] += 1
+            self._stats["last_send_seconds"] = elapsed
+            self._stats["max_send_seconds"] = max(
+                self._stats["max_send_seconds"], elapsed
+            )
+            self._stats["total_send_seconds"] += elapsed
+
+    def close(self):
+        with self._lock:
+            if self._smtp is not None:
+                try:
+                    self._smtp.quit()
+                except (smtplib.SMTPException, OSError):
+                    self._smtp.close()
+                self._smtp = None
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 def sendemail(
     from_addr=None,
     to_addrs=None,
@@ -49,36 +173,8 @@ def sendemail(
     If you specify both, the email will be sent as a MIME multipart
     alternative, i.e., the recipient will see the HTML content if his
     viewer supports it; otherwise he'll see the text content.
-    """
-
-    if not from_addr or not to_addrs:
-        raise Exception("Both from_addr and to_addrs must be specified")
-    if not text_data and not html_data:
-        raise Exception("Must specify either text_data or html_data")
-
-    if use_ssl:
-        server = smtplib.SMTP_SSL(server, port)
-    else:
-        server = smtplib.SMTP(server, port)
-
-    if username and password:
-        server.login(username, password)
-
-    if not html_data:
-        msg = MIMEText(text_data)
-    elif not text_data:
-        msg = MIMEMultipart()
-        msg.preamble = subject
-        msg.attach(MIMEText(html_data, "html"))
-    else:
-        msg = MIMEMultipart("alternative")
-        msg.attach(MIMEText(text_data, "plain"))
-        msg.attach(MIMEText(html_data, "html"))
 
-    msg["Subject"] = subject
-    msg["From"] = from_addr
-    msg["To"] = ", ".join(to_addrs)
-
-    server.sendmail(from_addr, to_addrs, msg.as_string())
-
-    server.quit()
+    Use a :class:`Mailer` to send several emails over a single connection.
+    """
+    with Mailer(from_addr, server, port, username, password, use_ssl) as mailer:
+        mailer.send(to_addrs, subject, text_data, html_data)
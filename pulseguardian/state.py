@@ -0,0 +1,246 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""In-memory copy of the guardian's stored state."""
+
+import time
+from collections import namedtuple
+
+from sqlalchemy import func, or_, select
+
+from pulseguardian.model.base import db_session
+from pulseguardian.model.binding import Binding
+from pulseguardian.model.pulse_user import RabbitMQAccount
+from pulseguardian.model.queue import Queue
+from pulseguardian.model.user import User
+
+# Stored state of a queue, as needed by the guardian.
+QueueState = namedtuple(
+    "QueueState",
+    ["name", "owner_id", "size", "durable", "warned", "unbounded", "message_bytes"],
+)
+
+
+def _state_fields(columns):
+    """Keep the columns of a queue that are part of its :class:`QueueState`."""
+    return {
+        column: value
+        for column, value in columns.items()
+        if column in QueueState._fields
+    }
+
+
+class GuardianState(object):
+    """The stored queues, bindings and owners' email addresses, loaded in a
+    few queries and then kept up to date by applying the changes of each
+    guard cycle.
+
+    ``queues`` maps queue names to :class:`QueueState` records,
+    ``bindings`` is a set of ``(queue_name, exchange, routing_key)``
+    triples, ``account_ids`` maps RabbitMQ account usernames to their ids
+    and ``owner_emails`` maps RabbitMQ account ids to the email addresses of
+    their owners.
+
+    ``thresholds`` and ``account_thresholds`` map the names of the queues
+    and the ids of the accounts with threshold overrides to their effective
+    ``(warning, deletion)`` thresholds; see :meth:`load_thresholds`.
+    """
+
+    def __init__(self, queues=None, bindings=None, account_ids=None, owner_emails=None):
+        self.queues = queues if queues is not None else {}
+        self.bindings = bindings if bindings is not None else set()
+        self.account_ids = account_ids if account_ids is not None else {}
+        self.owner_emails = owner_emails if owner_emails is not None else {}
+        # Number of accounts and highest id, as of their loading.
+        self.accounts_version = None
+        self.loaded_at = time.monotonic()
+        self._fallback_admin = None
+        self.thresholds = {}
+        self.account_thresholds = {}
+
+    @classmethod
+    def load(cls):
+        """Load the whole state from the database."""
+        queues = {
+            row.name: QueueState(*row)
+            for row in db_session.execute(
+                select(*(getattr(Queue, field) for field in QueueState._fields))
+            )
+        }
+        bindings = set(
+            tuple(row)
+            for row in db_session.execute(
+                select(Binding.queue_name, Binding.exchange, Binding.routing_key)
+            )
+        )
+        state = cls(queues, bindings)
+        state.load_accounts()
+        return state
+
+    def load_accounts(self):
+        """(Re)load the RabbitMQ accounts and their owners' email addresses,
+        e.g. once :meth:`accounts_changed`.
+        """
+        self.accounts_version = self._accounts_version()
+        self.account_ids = {
+            username: account_id
+            for username, account_id in db_session.execute(
+                select(RabbitMQAccount.username, RabbitMQAccount.id)
+            )
+        }
+        self.owner_emails = {}
+        for account_id, email in db_session.execute(
+            select(RabbitMQAccount.id, User.email).join(RabbitMQAccount.owners)
+        ):
+            self.owner_emails.setdefault(account_id, []).append(email)
+
+    @staticmethod
+    def _accounts_version():
+        # Accounts are only ever inserted or deleted, with increasing ids.
+        return tuple(
+            db_session.execute(select(func.count(), func.max(RabbitMQAccount.id))).one()
+        )
+
+    def accounts_changed(self):
+        """Return whether RabbitMQ accounts were created or deleted, e.g.
+        from the web app, since they were loaded.
+        """
+        return self._accounts_version() != self.accounts_version
+
+    def find_accounts(self, usernames):
+        """Look up, in a single query, the named accounts created since the
+        state was loaded, and record them.  Returns the names of those found.
+        """
+        found = {}
+        for username, account_id, email in db_session.execute(
+            select(RabbitMQAccount.username, RabbitMQAccount.id, User.email)
+            .outerjoin(RabbitMQAccount.owners)
+            .where(RabbitMQAccount.username.in_(sorted(usernames)))
+        ):
+            found[username] = account_id
+            emails = self.owner_emails.setdefault(account_id, [])
+            if email is not None and email not in emails:
+                emails.append(email)
+        self._record_accounts(found)
+        return set(found)
+
+    def _record_accounts(self, account_ids):
+        """Add accounts to ``account_ids``, counting them in the version
+        they were loaded at, as if they had been loaded with the others.
+        """
+        new_ids = [
+            account_id
+            for username, account_id in account_ids.items()
+            if username not in self.account_ids
+        ]
+        self.account_ids.update(account_ids)
+        if self.accounts_version is not None and new_ids:
+            count, max_id = self.accounts_version
+            self.accounts_version = (count + len(new_ids), max(max_id or 0, *new_ids))
+
+    def load_thresholds(self, warn_queue_size, del_queue_size):
+        """Load the threshold overrides of the queues and accounts, resolved
+        against each other and the given global thresholds.
+
+        A queue's override takes precedence over its owner's, which takes
+        precedence over the global threshold; queues and accounts without
+        overrides aren't in the tables.
+        """
+
+        def resolve(warn, delete):
+            return (
+                warn_queue_size if warn is None else warn,
+                del_queue_size if delete is None else delete,
+            )
+
+        self.thresholds = {
+            name: resolve(warn, delete)
+            for name, warn, delete in db_session.execute(
+                select(
+                    Queue.name,
+                    func.coalesce(
+                        Queue.warn_queue_size, RabbitMQAccount.warn_queue_size
+                    ),
+                    func.coalesce(Queue.del_queue_size, RabbitMQAccount.del_queue_size),
+                )
+                .outerjoin(Queue.owner)
+                .where(
+                    or_(
+                        Queue.warn_queue_size.is_not(None),
+                        Queue.del_queue_size.is_not(None),
+                        RabbitMQAccount.warn_queue_size.is_not(None),
+                        RabbitMQAccount.del_queue_size.is_not(None),
+                    )
+                )
+            )
+        }
+        self.account_thresholds = {
+            account_id: resolve(warn, delete)
+            for account_id, warn, delete in db_session.execute(
+                select(
+                    RabbitMQAccount.id,
+                    RabbitMQAccount.warn_queue_size,
+                    RabbitMQAccount.del_queue_size,
+                ).where(
+                    or_(
+                        RabbitMQAccount.warn_queue_size.is_not(None),
+                        RabbitMQAccount.del_queue_size.is_not(None),
+                    )
+                )
+            )
+        }
+
+    @property
+    def age(self):
+        """Time, in seconds, since the state was loaded."""
+        return time.monotonic() - self.loaded_at
+
+    def fallback_admin(self):
+        """Return the ``(id, email)`` of the admin owning the accounts
+        created by the guardian, or None if there are no admins.
+        """
+        if self._fallback_admin is None:
+            self._fallback_admin = (
+                db_session.execute(
+                    select(User.id, User.email).where(User.admin == True).limit(1)
+                ).first()
+                or ()
+            )
+        return tuple(self._fallback_admin) or None
+
+    def add_accounts(self, account_ids, owner_emails):
+        """Record accounts created since the state was loaded, all owned by
+        ``owner_emails``.
+        """
+        self._record_accounts(account_ids)
+        for account_id in account_ids.values():
+            self.owner_emails[account_id] = list(owner_emails)
+
+    def apply(self, uow):
+        """Apply the changes recorded in a :class:`UnitOfWork`, in the order
+        its :meth:`~UnitOfWork.flush` writes them.
+        """
+        self.bindings -= uow.stale_bindings
+        if uow.deleted_queues:
+            for name in uow.deleted_queues:
+                self.queues.pop(name, None)
+            self.bindings = {
+                binding
+                for binding in self.bindings
+                if binding[0] not in uow.deleted_queues
+            }
+        for name, row in uow.new_queues.items():
+            self.queues[name] = QueueState(
+                **{
+                    **dict.fromkeys(QueueState._fields),
+                    "unbounded": False,
+                    **_state_fields(row),
+                }
+            )
+        self.bindings.update(
+            binding for binding in uow.new_bindings if binding[0] in self.queues
+        )
+        for name, changes in uow.queue_updates.items():
+            if name in self.queues:
+                self.queues[name] = self.queues[name]._replace(**_state_fields(changes))
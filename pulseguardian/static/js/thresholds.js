@@ -0,0 +1,41 @@
+/* This Source Code Form is subject to the terms of the Mozilla Public
+ * License, v. 2.0. If a copy of the MPL was not distributed with this
+ * file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+// Threshold overrides of queues and RabbitMQ accounts, set by admins.  Forms
+// may be reloaded, hence the delegated handler.
+$(document).ready(function() {
+    $(document).on('submit', '.thresholds', function(event) {
+        event.preventDefault();
+        var form = $(this);
+
+        function threshold(name) {
+            var value = form.find('[name=' + name + ']').val();
+            return value === '' ? null : parseInt(value, 10);
+        }
+
+        $.ajax({
+            type: 'PUT',
+            url: form.data('url'),
+            contentType: 'application/json',
+            data: JSON.stringify({
+                warnQueueSize: threshold('warn-queue-size'),
+                delQueueSize: threshold('del-queue-size')
+            }),
+            dataType: 'json',
+            headers: {
+                'X-CSRF-Token': form.closest('[data-csrf-token]').data('csrf-token'),
+            },
+            success: function(data) {
+                if (!data.ok) {
+                    errorMessage(data.error || "Couldn't set the thresholds.");
+                    return;
+                }
+                form.find('button').blur();
+            },
+            error: function() {
+                errorMessage("Couldn't set the thresholds.");
+            }
+        });
+    });
+});
@@ -0,0 +1,435 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Batching of the guardian's database writes."""
+
+import threading
+import time
+import traceback
+
+from sqlalchemy import bindparam, delete, insert, tuple_, update
+
+from pulseguardian import mozdef
+from pulseguardian.model.base import db_session
+from pulseguardian.model.binding import Binding
+from pulseguardian.model.queue import Queue
+from pulseguardian.model.queue_size import QueueSizeRollup, QueueSizeSample
+
+# Maximum number of rows, or of values in an IN clause, per statement.
+CHUNK_SIZE = 1000
+
+
+def _chunks(items):
+    items = list(items)
+    for i in range(0, len(items), CHUNK_SIZE):
+        yield items[i : i + CHUNK_SIZE]
+
+
+class UnitOfWork(object):
+    """Collects the database changes of a guard cycle and writes them as a
+    few bulk statements in a single transaction.
+
+    Side effects that must only happen once the changes are stored (emails,
+    callbacks, logs) are registered with :meth:`after_commit` and run in
+    order after a successful commit.  If writing fails, the transaction is
+    rolled back, the side effects are dropped and the error is re-raised.
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        # Queue name -> row of a queue to insert.
+        self.new_queues = {}
+        # Queue name -> changed columns of a stored queue.
+        self.queue_updates = {}
+        self.deleted_queues = set()
+        # (queue_name, exchange, routing_key) triples.
+        self.new_bindings = set()
+        # (queue_name, exchange, routing_key) triples of stale bindings.
+        self.stale_bindings = set()
+        # Rows of the size history to insert.
+        self.size_samples = []
+        self.size_rollups = []
+        # (samples, rollups) times before which the size history is pruned.
+        self.history_cutoffs = None
+        self._actions = []
+
+    def __bool__(self):
+        return bool(
+            self.new_queues
+            or self.queue_updates
+            or self.deleted_queues
+            or self.new_bindings
+            or self.stale_bindings
+            or self.size_samples
+            or self.size_rollups
+            or self.history_cutoffs
+            or self._actions
+        )
+
+    def add_queue(self, **row):
+        self.queue_updates.pop(row["name"], None)
+        self.new_queues[row["name"]] = row
+
+    def update_queue(self, name, **changes):
+        if name in self.new_queues:
+            self.new_queues[name].update(changes)
+        elif changes:
+            self.queue_updates.setdefault(name, {}).update(changes)
+
+    def delete_queue(self, name):
+        self.new_queues.pop(name, None)
+        self.queue_updates.pop(name, None)
+        self.deleted_queues.add(name)
+
+    def add_bindings(self, triples):
+        self.new_bindings.update(triples)
+
+    def delete_bindings(self, triples):
+        self.stale_bindings.update(triples)
+
+    def add_size_sample(self, queue_name, sampled_at, size):
+        self.size_samples.append(
+            {"queue_name": queue_name, "sampled_at": sampled_at, "size": size}
+        )
+
+    def add_size_rollup(self, **row):
+        self.size_rollups.append(row)
+
+    def prune_size_history(self, samples_before, rollups_before):
+        self.history_cutoffs = (samples_before, rollups_before)
+
+    def after_commit(self, func, *args, **kwargs):
+        self._actions.append((func, args, kwargs))
+
+    def log(self, *args, **kwargs):
+        """Log to mozdef once the changes are committed."""
+        self.after_commit(mozdef.log, *args, **kwargs)
+
+    def merge(self, other):
+        """Add the changes and side effects of a later unit of work, as if
+        they had been recorded in this one.  ``other`` is left untouched.
+        """
+        for name in other.deleted_queues:
+            self.delete_queue(name)
+        if other.deleted_queues:
+            # Bindings added to queues deleted since are gone with them.
+            self.new_bindings = {
+                binding
+                for binding in self.new_bindings
+                if binding[0] not in other.deleted_queues
+            }
+        for row in other.new_queues.values():
+            self.add_queue(**row)
+        for name, changes in other.queue_updates.items():
+            self.update_queue(name, **changes)
+        # The later change to a binding wins; flush() deletes stale bindings
+        # before inserting new ones.
+        self.new_bindings -= other.stale_bindings
+        self.stale_bindings -= other.new_bindings
+        self.new_bindings.update(other.new_bindings)
+        self.stale_bindings.update(other.stale_bindings)
+        self.size_samples.extend(other.size_samples)
+        self.size_rollups.extend(other.size_rollups)
+        if other.history_cutoffs is not None:
+            self.history_cutoffs = other.history_cutoffs
+        self._actions.extend(other._actions)
+
+    def flush(self):
+        """Write the pending changes within the current transaction."""
+        # Deletions go first, so that a queue deleted and then seen again
+        # before a write-behind flush is re-inserted.
+        binding_columns = tuple_(
+            Binding.queue_name, Binding.exchange, Binding.routing_key
+        )
+        for triples in _chunks(sorted(self.stale_bindings)):
+            db_session.execute(delete(Binding).where(binding_columns.in_(triples)))
+        for names in _chunks(sorted(self.deleted_queues)):
+            db_session.execute(delete(Binding).where(Binding.queue_name.in_(names)))
+            db_session.execute(delete(Queue).where(Queue.name.in_(names)))
+        # Queues must be inserted before their bindings, which the unique
+        # index on their columns keeps concurrent guardians from recording
+        # twice.
+        for rows in _chunks(self.new_queues.values()):
+            db_session.execute(insert(Queue), rows)
+        Binding.insert_missing(
+            {"queue_name": queue_name, "exchange": exchange, "routing_key": routing_key}
+            for queue_name, exchange, routing_key in sorted(self.new_bindings)
+            if queue_name in self.new_queues or queue_name not in self.deleted_queues
+        )
+        # Updates are grouped by changed columns, one executemany per group.
+        # Unlike the ORM's bulk update, this tolerates queues deleted in the
+        # meantime, e.g. from the web app.
+        updates = {}
+        for name, changes in self.queue_updates.items():
+            row = {"_" + column: value for column, value in changes.items()}
+            row["_name"] = name
+            updates.setdefault(tuple(sorted(changes)), []).append(row)
+        table = Queue.__table__
+        for columns, rows in updates.items():
+            stmt = (
+                update(table)
+                .where(table.c.name == bindparam("_name"))
+                .values({column: bindparam("_" + column) for column in columns})
+            )
+            for chunk in _chunks(rows):
+                db_session.execute(stmt, chunk)
+
+        # Rows may already exist, e.g. written by a guardian restarted
+        # within the second.
+        QueueSizeSample.insert_missing(self.size_samples)
+        QueueSizeRollup.insert_missing(self.size_rollups)
+        if self.history_cutoffs is not None:
+            samples_before, rollups_before = self.history_cutoffs
+            db_session.execute(
+                delete(QueueSizeSample).where(
+                    QueueSizeSample.sampled_at < samples_before
+                )
+            )
+            db_session.execute(
+                delete(QueueSizeRollup).where(
+                    QueueSizeRollup.period_start < rollups_before
+                )
+            )
+
+    def commit(self):
+        """Write and commit the pending changes, then run the side effects."""
+        try:
+            self.flush()
+            db_session.commit()
+        except Exception:
+            db_session.rollback()
+            self._reset()
+            raise
+
+        actions = self._actions
+        self._reset()
+        for func, args, kwargs in actions:
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                # The changes are stored; a failing email or callback
+                # shouldn't prevent the others.
+                mozdef.log(
+                    mozdef.ERROR,
+                    mozdef.OTHER,
+                    "Post-commit action failed.",
+                    details={
+                        "action": getattr(func, "__name__", repr(func)),
+                        "message": traceback.format_exc(),
+                    },
+                )
+
+
+class WriteBehindTimeout(Exception):
+    """Raised when a unit of work can't be queued for writing in time."""
+
+
+class WriteBehindWriter(object):
+    """Commits units of work from a background thread, so that the guard
+    loop doesn't wait on the database.
+
+    Submitted units of work are kept in a bounded list and coalesced into a
+    single transaction every ``interval`` seconds.  Once ``max_pending`` of
+    them are waiting, :meth:`submit` blocks until the next successful flush,
+    for up to ``submit_timeout`` seconds; the time spent blocked is reported
+    by :meth:`stats`.
+
+    A failed flush is retried on the next one.  After ``max_failures`` in a
+    row, the units of work are committed one by one instead, and those that
+    still fail are dropped, so that a single bad one can't hold up the
+    others forever.
+
+    :param interval: Time, in seconds, between flushes.
+    :param max_pending: Number of unwritten units of work after which
+                        :meth:`submit` blocks.
+    :param max_failures: Number of failed flushes in a row after which the
+                         units of work are committed one by one.
+    :param submit_timeout: Time, in seconds, after which a blocked
+                           :meth:`submit` raises :class:`WriteBehindTimeout`,
+                           or None to wait indefinitely.
+    :param on_failure: Callback called with the number of failed flushes in
+                       a row, and the last error, once it reaches
+                       ``max_failures``; only once until a flush succeeds.
+    """
+
+    def __init__(
+        self,
+        interval,
+        max_pending,
+        max_failures=3,
+        submit_timeout=None,
+        on_failure=None,
+    ):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_failures = max_failures
+        self.submit_timeout = submit_timeout
+        self.on_failure = on_failure
+        self._failures = 0
+        self._failure_notified = False
+        self._pending = []
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+        self._stats = {
+            "submitted": 0,
+            "flushes": 0,
+            "failures": 0,
+            "dropped": 0,
+            "blocked": 0,
+            "blocked_seconds": 0.0,
+            "max_pending": 0,
+            "last_flush_seconds": 0.0,
+        }
+
+    def start(self):
+        self._stopping = False
+        self._thread = threading.Thread(
+            target=self._run, name="guardian-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop the flusher thread once it has written what is pending."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, uow):
+        """Queue a unit of work to be committed by the flusher thread.
+
+        Raises :class:`WriteBehindTimeout` if too many units of work are
+        still waiting after ``submit_timeout`` seconds; ``uow`` is then
+        dropped.
+        """
+        if not uow:
+            return
+        with self._cond:
+            if len(self._pending) >= self.max_pending:
+                self._stats["blocked"] += 1
+                start = time.monotonic()
+                available = self._cond.wait_for(
+                    lambda: len(self._pending) < self.max_pending or self._stopping,
+                    timeout=self.submit_timeout,
+                )
+                self._stats["blocked_seconds"] += time.monotonic() - start
+                if not available:
+                    raise WriteBehindTimeout(
+                        "{0} units of work still pending after {1} seconds.".format(
+                            len(self._pending), self.submit_timeout
+                        )
+                    )
+            self._pending.append(uow)
+            self._stats["submitted"] += 1
+            self._stats["max_pending"] = max(
+                self._stats["max_pending"], len(self._pending)
+            )
+
+    def pending(self):
+        """Return a unit of work holding every change not committed yet,
+        for readers of the database to overlay on what they read.
+        """
+        with self._cond:
+            batch = list(self._pending)
+        uow = UnitOfWork()
+        for delta in batch:
+            uow.merge(delta)
+        return uow
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats, pending=len(self._pending))
+
+    def flush(self):
+        """Commit the pending units of work as a single transaction."""
+        with self._cond:
+            batch = list(self._pending)
+        if not batch:
+            return
+
+        uow = UnitOfWork()
+        for delta in batch:
+            uow.merge(delta)
+        start = time.monotonic()
+        try:
+            uow.commit()
+        except Exception:
+            message = traceback.format_exc()
+            with self._cond:
+                self._stats["failures"] += 1
+                self._failures += 1
+                failures = self._failures
+            mozdef.log(
+                mozdef.ERROR,
+                mozdef.OTHER,
+                "Write-behind flush failed.",
+                details={
+                    "pending": len(batch),
+                    "failures": failures,
+                    "message": message,
+                },
+            )
+            if failures < self.max_failures:
+                return
+            if not self._failure_notified and self.on_failure is not None:
+                self._failure_notified = True
+                try:
+                    self.on_failure(failures, message)
+                except Exception:
+                    mozdef.log(
+                        mozdef.ERROR,
+                        mozdef.OTHER,
+                        "Write-behind failure notification failed.",
+                        details={"message": traceback.format_exc()},
+                    )
+            self._flush_each(batch)
+        else:
+            self._failure_notified = False
+
+        with self._cond:
+            # Units of work submitted during the flush stay pending.
+            del self._pending[: len(batch)]
+            self._failures = 0
+            self._stats["flushes"] += 1
+            self._stats["last_flush_seconds"] = time.monotonic() - start
+            self._cond.notify_all()
+
+    def _flush_each(self, batch):
+        """Commit the units of work of a failing batch one by one, in order,
+        dropping those that still fail.
+        """
+        for delta in batch:
+            uow = UnitOfWork()
+            uow.merge(delta)
+            try:
+                uow.commit()
+            except Exception:
+                with self._cond:
+                    self._stats["dropped"] += 1
+                mozdef.log(
+                    mozdef.ERROR,
+                    mozdef.OTHER,
+                    "Dropping unit of work that can't be written.",
+                    details={
+                        "newqueues": len(delta.new_queues),
+                        "updatedqueues": len(delta.queue_updates),
+                        "deletedqueues": len(delta.deleted_queues),
+                        "message": traceback.format_exc(),
+                    },
+                )
+
+    def _run(self):
+        while True:
+            with self._cond:
+                stopping = self._cond.wait_for(
+                    lambda: self._stopping, timeout=self.interval
+                )
+            self.flush()
+            if stopping:
+                break
@@ -34,6 +34,7 @@ import base64
 import os.path
 import re
 import sys
+import time
 from functools import wraps
 
 import os
@@ -57,7 +58,13 @@ from sqlalchemy.orm import joinedload, subqueryload
 from werkzeug.exceptions import NotFound
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-from pulseguardian import auth, config, management as pulse_management, mozdef
+from pulseguardian import (
+    auth,
+    config,
+    forecast,
+    management as pulse_management,
+    mozdef,
+)
 from pulseguardian.model.base import db_session, init_db
 from pulseguardian.model.pulse_user import RabbitMQAccount
 from pulseguardian.model.queue import Queue
@@ -380,12 +387,32 @@ def _load_queues_data():
     return users, no_owner_queues
 
 
+def _queue_forecasts(users, no_owner_queues):
+    """Estimate the growth of the listed queues from their size history,
+    up to their own deletion thresholds.
+    """
+    queues = list(no_owner_queues)
+    for user in users:
+        for rabbitmq_account in user.rabbitmq_accounts:
+            queues.extend(rabbitmq_account.queues)
+    return forecast.forecast_history(
+        [queue.name for queue in queues],
+        [queue.effective_thresholds()[1] for queue in queues],
+        since=time.time() - config.growth_window,
+    )
+
+
 @app.route("/queues")
 @sh.wrapper()
 @oidc.oidc_auth
 def queues():
     users, no_owner_queues = _load_queues_data()
-    return render_template("queues.html", users=users, no_owner_queues=no_owner_queues)
+    return render_template(
+        "queues.html",
+        users=users,
+        no_owner_queues=no_owner_queues,
+        forecasts=_queue_forecasts(users, no_owner_queues),
+    )
 
 
 @app.route("/queues_listing")
@@ -394,7 +421,10 @@ def queues():
 def queues_listing():
     users, no_owner_queues = _load_queues_data()
     return render_template(
-        "queues_listing.html", users=users, no_owner_queues=no_owner_queues
+        "queues_listing.html",
+        users=users,
+        no_owner_queues=no_owner_queues,
+        forecasts=_queue_forecasts(users, no_owner_queues),
     )
 
 
@@ -517,6 +547,88 @@ def set_user_admin(user_id):
     return jsonify(ok=True)
 
 
+def _thresholds_from_request():
+    """Return the ``(warning, deletion)`` thresholds of a JSON request, None
+    clearing a threshold.  Aborts if they aren't positive integers.
+    """
+    data = request.json or {}
+    if "warnQueueSize" not in data or "delQueueSize" not in data:
+        abort(400)
+
+    thresholds = (data["warnQueueSize"], data["delQueueSize"])
+    for threshold in thresholds:
+        if threshold is not None and (type(threshold) is not int or threshold <= 0):
+            abort(400)
+    return thresholds
+
+
+def _set_thresholds(obj, thresholds, details):
+    """Set the threshold overrides of a queue or RabbitMQ account, if its
+    resulting warning threshold isn't above its deletion threshold.
+    """
+    obj.warn_queue_size, obj.del_queue_size = thresholds
+    warn_size, del_size = obj.effective_thresholds()
+    details.update(
+        {
+            "username": g.user.email,
+            "warningthreshold": thresholds[0],
+            "deletionthreshold": thresholds[1],
+        }
+    )
+
+    if warn_size > del_size:
+        db_session.rollback()
+        details["message"] = "Warning threshold above deletion threshold."
+        mozdef.log(
+            mozdef.WARNING,
+            mozdef.OTHER,
+            "Thresholds update rejected.",
+            details=details,
+        )
+        return jsonify(
+            ok=False,
+            error="The warning threshold ({0}) can't be above the deletion "
+            "threshold ({1}).".format(warn_size, del_size),
+        )
+
+    db_session.commit()
+    mozdef.log(
+        mozdef.NOTICE,
+        mozdef.OTHER,
+        "Thresholds updated.",
+        details=details,
+    )
+    return jsonify(ok=True)
+
+
+@app.route("/queue/<path:queue_name>/thresholds", methods=["PUT"])
+@sh.wrapper()
+@oidc.oidc_auth
+@requires_admin
+def set_queue_thresholds(queue_name):
+    thresholds = _thresholds_from_request()
+    queue = db_session.get(Queue, queue_name)
+    if not queue:
+        abort(400)
+
+    return _set_thresholds(queue, thresholds, {"queuename": queue_name})
+
+
+@app.route("/rabbitmq-account/<rabbitmq_username>/thresholds", methods=["PUT"])
+@sh.wrapper()
+@oidc.oidc_auth
+@requires_admin
+def set_rabbitmq_account_thresholds(rabbitmq_username):
+    thresholds = _thresholds_from_request()
+    rabbitmq_account = RabbitMQAccount.get_by(username=rabbitmq_username)
+    if not rabbitmq_account:
+        abort(400)
+
+    return _set_thresholds(
+        rabbitmq_account, thresholds, {"rabbitmqusername": rabbitmq_username}
+    )
+
+
 # Read-Only API
 
 
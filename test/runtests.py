@@ -3,17 +3,23 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import base64
+import json
 import logging
 import multiprocessing
 import os
 import socket
+import socketserver
 import sys
+import threading
 import time
 import unittest
 import uuid
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import Mock, patch
-from urllib.parse import urlparse
+from urllib.parse import parse_qs, urlparse
 
+import numpy as np
 from kombu import Exchange
 from mozillapulse import consumers, publishers
 from mozillapulse.messages.test import TestMessage
@@ -35,13 +41,34 @@ from docker_setup import (
 
 from sqlalchemy import select
 
-from pulseguardian import dbinit, management as pulse_management, web
-from pulseguardian.guardian import PulseGuardian
+from pulseguardian import (
+    dbinit,
+    forecast,
+    history,
+    management as pulse_management,
+    outbox,
+    pressure,
+    web,
+)
+from pulseguardian.columns import QueueColumns, StoredColumns
+from pulseguardian.guardian import SHED, PulseGuardian
+from pulseguardian.history import RecentSizes, SizeHistory
 from pulseguardian.model.base import db_session
+from pulseguardian.model import outbox as outbox_model
 from pulseguardian.model.binding import Binding
+from pulseguardian.model.outbox import OutboxEmail
 from pulseguardian.model.pulse_user import RabbitMQAccount
 from pulseguardian.model.queue import Queue
+from pulseguardian.model.queue_size import QueueSizeRollup, QueueSizeSample
 from pulseguardian.model.user import User
+from pulseguardian.ratelimit import TokenBucket
+from pulseguardian.scheduler import QueueScheduler
+from pulseguardian.state import GuardianState, QueueState
+from pulseguardian.unit_of_work import (
+    UnitOfWork,
+    WriteBehindTimeout,
+    WriteBehindWriter,
+)
 
 web.app.config["TESTING"] = True
 
@@ -809,6 +836,1423 @@ class QueryPerformanceTest(unittest.TestCase):
         )
 
 
+class MonitorQueuesTest(unittest.TestCase):
+    """Tests the guardian's reconciliation of queue snapshots with the
+    database (no RabbitMQ required).
+    """
+
+    def setUp(self):
+        from pulseguardian.model.base import init_db
+
+        init_db()
+        for tbl in [
+            Binding,
+            Queue,
+            RabbitMQAccount,
+            User,
+            OutboxEmail,
+            QueueSizeSample,
+            QueueSizeRollup,
+        ]:
+            for obj in tbl.get_all():
+                db_session.delete(obj)
+        db_session.commit()
+
+        self.user = User.new_user(email=CONSUMER_EMAIL)
+        self.rabbitmq_account = RabbitMQAccount.new_user(
+            CONSUMER_USER, owners=[self.user], create_rabbitmq_user=False
+        )
+        self.guardian = PulseGuardian(
+            warn_queue_size=TEST_WARN_SIZE,
+            del_queue_size=TEST_DELETE_SIZE,
+            emails=False,
+        )
+
+    def _queue_data(self, name, size, durable=True):
+        return {
+            "name": "queue/{}/{}".format(CONSUMER_USER, name),
+            "vhost": DEFAULT_RABBIT_VHOST,
+            "messages": size,
+            "messages_ready": size,
+            "durable": durable,
+        }
+
+    def _binding_data(self, queue_data, routing_key="#"):
+        return {
+            "source": "exchange/pulse/test",
+            "destination": queue_data["name"],
+            "destination_type": "queue",
+            "routing_key": routing_key,
+        }
+
+    def _monitor(self, queues, bindings=()):
+        with patch.object(pulse_management, "delete_queue") as delete_queue:
+            self.guardian.monitor_queues(queues, list(bindings))
+        db_session.expire_all()
+        return [call.kwargs["queue"] for call in delete_queue.call_args_list]
+
+    def test_reconcile_inserts_updates_and_deletes(self):
+        small = self._queue_data("small", 1)
+        growing = self._queue_data("growing", 2)
+        self._monitor([small, growing], [self._binding_data(small)])
+
+        self.assertEqual(
+            {q.name for q in Queue.get_all()}, {small["name"], growing["name"]}
+        )
+        self.assertEqual(len(Queue.get_by(name=small["name"]).bindings), 1)
+        self.assertEqual(Queue.get_by(name=small["name"]).owner, self.rabbitmq_account)
+
+        growing["messages"] = growing["messages_ready"] = TEST_WARN_SIZE + 1
+        self._monitor([small, growing], [self._binding_data(small)])
+        self.assertTrue(Queue.get_by(name=growing["name"]).warned)
+        self.assertEqual(Queue.get_by(name=growing["name"]).size, TEST_WARN_SIZE + 1)
+
+        growing["messages"] = growing["messages_ready"] = TEST_DELETE_SIZE + 1
+        deleted = self._monitor([small, growing], [self._binding_data(small)])
+        self.assertEqual(deleted, [growing["name"]])
+        self.assertEqual({q.name for q in Queue.get_all()}, {small["name"]})
+
+    def test_reconcile_writes_only_changed_queues(self):
+        from sqlalchemy import event
+        from pulseguardian.model.base import engine
+
+        queues = [self._queue_data("q{}".format(i), 1) for i in range(50)]
+        self._monitor(queues)
+
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        queues[0]["messages"] = 2
+        event.listen(engine, "before_cursor_execute", record_statement)
+        try:
+            self._monitor(queues)
+        finally:
+            event.remove(engine, "before_cursor_execute", record_statement)
+
+        updates = [s for s in statements if s.startswith("UPDATE")]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(Queue.get_by(name=queues[0]["name"]).size, 2)
+
+    def test_state_cache(self):
+        from sqlalchemy import event
+        from pulseguardian.model.base import engine
+
+        queue_data = self._queue_data("cached", 1)
+        bindings = [self._binding_data(queue_data)]
+        self._monitor([queue_data], bindings)
+        self.guardian.load_state()
+
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        # Unchanged queues need no database access at all.
+        event.listen(engine, "before_cursor_execute", record_statement)
+        try:
+            self._monitor([queue_data], bindings)
+            self.guardian.clear_deleted_queues([queue_data], bindings)
+        finally:
+            event.remove(engine, "before_cursor_execute", record_statement)
+        self.assertEqual(statements, [])
+
+        # Changes made from the web app are seen once the state is reloaded.
+        queue = Queue.get_by(name=queue_data["name"])
+        queue.unbounded = True
+        db_session.commit()
+        self.guardian.load_state()
+        queue_data["messages"] = queue_data["messages_ready"] = TEST_DELETE_SIZE + 1
+        self.assertEqual(self._monitor([queue_data], bindings), [])
+
+        # Updating a queue deleted in the meantime does nothing.
+        db_session.delete(Queue.get_by(name=queue_data["name"]))
+        db_session.commit()
+        queue_data["messages"] = queue_data["messages_ready"] = 1
+        self._monitor([queue_data], bindings)
+        self.assertEqual(Queue.get_all(), [])
+
+    def test_new_owners_created_in_one_batch(self):
+        from sqlalchemy import event
+        from pulseguardian.model.base import engine
+
+        admin = User.new_user(email=ADMIN_EMAIL, admin=True)
+        owners = ["newowner1", "newowner2"]
+        queues = [
+            dict(self._queue_data(None, 1), name="queue/{}/q{}".format(owner, i))
+            for owner in owners
+            for i in range(3)
+        ]
+        self.guardian.load_state()
+
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(engine, "before_cursor_execute", record_statement)
+        try:
+            with patch.object(pulse_management, "create_user"), patch.object(
+                pulse_management, "set_permission"
+            ), patch.object(
+                RabbitMQAccount, "new_users", wraps=RabbitMQAccount.new_users
+            ) as new_users:
+                self._monitor(queues)
+        finally:
+            event.remove(engine, "before_cursor_execute", record_statement)
+
+        new_users.assert_called_once()
+        # The missing owners are only looked up once, in a single query.
+        self.assertEqual(len([s for s in statements if "FROM pulse_users" in s]), 1)
+        for owner in owners:
+            rabbitmq_account = RabbitMQAccount.get_by(username=owner)
+            self.assertEqual(rabbitmq_account.owners, [admin])
+            self.assertEqual(len(rabbitmq_account.queues), 3)
+
+    def test_owners_created_since_state_loaded(self):
+        self.guardian.load_state()
+        # Created from the web app, after the guardian loaded its state.
+        web_account = RabbitMQAccount.new_user(
+            "webowner", owners=[self.user], create_rabbitmq_user=False
+        )
+        queue_data = dict(self._queue_data(None, 1), name="queue/webowner/q")
+
+        with patch.object(pulse_management, "create_user") as create_user:
+            self._monitor([queue_data])
+        create_user.assert_not_called()
+        self.assertEqual(Queue.get_by(name=queue_data["name"]).owner, web_account)
+        self.assertEqual(
+            self.guardian._owner_emails(web_account.id, self.guardian._state),
+            [CONSUMER_EMAIL],
+        )
+
+        # Deleted accounts are dropped from the state on the next check.
+        self.assertFalse(self.guardian._state.accounts_changed())
+        db_session.delete(web_account)
+        db_session.commit()
+        self.guardian.check_accounts()
+        self.assertNotIn("webowner", self.guardian._state.account_ids)
+
+    def test_failed_owner_creation(self):
+        User.new_user(email=ADMIN_EMAIL, admin=True)
+        self.guardian.load_state()
+        queue_data = dict(self._queue_data(None, 1), name="queue/newowner/q")
+
+        with patch.object(
+            pulse_management,
+            "create_user",
+            side_effect=pulse_management.PulseManagementException("Timed out."),
+        ):
+            self._monitor([queue_data])
+        self.assertIsNone(RabbitMQAccount.get_by(username="newowner"))
+        self.assertEqual(Queue.get_all(), [])
+
+        # The queue's owner is created on the next cycle.
+        with patch.object(pulse_management, "create_user"), patch.object(
+            pulse_management, "set_permission"
+        ):
+            self._monitor([queue_data])
+        self.assertEqual(
+            Queue.get_by(name=queue_data["name"]).owner.username, "newowner"
+        )
+
+    def test_clear_deleted_queues_and_bindings(self):
+        kept = self._queue_data("kept", 1)
+        gone = self._queue_data("gone", 1)
+        bindings = [
+            self._binding_data(kept, "a"),
+            self._binding_data(kept, "b"),
+            self._binding_data(gone),
+        ]
+        self._monitor([kept, gone], bindings)
+        self.assertEqual(len(Binding.get_all()), 3)
+
+        # "b" was unbound and "c" bound since the last cycle.
+        bindings = [self._binding_data(kept, "a"), self._binding_data(kept, "c")]
+        self.guardian.clear_deleted_queues([kept], bindings)
+        db_session.expire_all()
+
+        self.assertEqual([q.name for q in Queue.get_all()], [kept["name"]])
+        self.assertEqual(
+            {(b.queue_name, b.routing_key) for b in Binding.get_all()},
+            {(kept["name"], "a"), (kept["name"], "c")},
+        )
+
+    def test_insert_missing_bindings_ignores_duplicates(self):
+        queue_data = self._queue_data("dup", 1)
+        self._monitor([queue_data], [self._binding_data(queue_data)])
+
+        row = {
+            "queue_name": queue_data["name"],
+            "exchange": "exchange/pulse/test",
+            "routing_key": "#",
+        }
+        Binding.insert_missing([row, row])
+        db_session.commit()
+
+        self.assertEqual(len(Binding.get_all()), 1)
+
+    def test_side_effects_follow_commit(self):
+        on_warn = Mock()
+        self.guardian.on_warn = on_warn
+        queue_data = self._queue_data("warned", TEST_WARN_SIZE + 1)
+
+        # Nothing is written or reported if the transaction fails.
+        with patch.object(db_session, "commit", side_effect=RuntimeError):
+            self.assertRaises(RuntimeError, self._monitor, [queue_data])
+        on_warn.assert_not_called()
+        self.assertEqual(Queue.get_all(), [])
+
+        uow = UnitOfWork()
+        with patch.object(pulse_management, "delete_queue"):
+            self.guardian.monitor_queues([queue_data], [], uow)
+        on_warn.assert_not_called()
+        uow.commit()
+        on_warn.assert_called_once_with(queue_data["name"])
+        self.assertTrue(Queue.get_by(name=queue_data["name"]).warned)
+
+    def test_write_behind(self):
+        on_warn = Mock()
+        guardian = PulseGuardian(
+            warn_queue_size=TEST_WARN_SIZE,
+            del_queue_size=TEST_DELETE_SIZE,
+            emails=False,
+            on_warn=on_warn,
+            write_behind=True,
+        )
+        queue_data = self._queue_data("behind", TEST_WARN_SIZE + 1)
+
+        def cycle():
+            uow = UnitOfWork()
+            guardian.monitor_queues([queue_data], [self._binding_data(queue_data)], uow)
+            guardian._commit(uow)
+
+        # The second cycle sees the unwritten changes of the first one, so
+        # it has nothing to add.
+        cycle()
+        cycle()
+        self.assertEqual(Queue.get_all(), [])
+        self.assertEqual(guardian._writer.stats()["pending"], 1)
+
+        guardian._writer.flush()
+        db_session.expire_all()
+        on_warn.assert_called_once_with(queue_data["name"])
+        queue = Queue.get_by(name=queue_data["name"])
+        self.assertTrue(queue.warned)
+        self.assertEqual(len(queue.bindings), 1)
+
+        # Stopping the flusher thread writes what is pending.
+        guardian._writer.interval = 60
+        guardian._writer.start()
+        queue_data["messages"] = queue_data["messages_ready"] = 1
+        cycle()
+        guardian._writer.stop()
+        db_session.expire_all()
+        self.assertEqual(Queue.get_by(name=queue_data["name"]).size, 1)
+        self.assertEqual(guardian._writer.stats()["flushes"], 2)
+
+    def test_write_behind_state_load(self):
+        guardian = PulseGuardian(
+            warn_queue_size=TEST_WARN_SIZE,
+            del_queue_size=TEST_DELETE_SIZE,
+            emails=False,
+            write_behind=True,
+        )
+        queue_data = self._queue_data("behind", 1)
+        uow = UnitOfWork()
+        guardian.monitor_queues([queue_data], [], uow)
+        guardian._commit(uow)
+
+        load = GuardianState.load
+
+        def load_then_flush():
+            state = load()
+            guardian._writer.flush()
+            return state
+
+        # Changes flushed while the state is read are still in it.
+        with patch.object(GuardianState, "load", side_effect=load_then_flush):
+            guardian.load_state()
+        self.assertIn(queue_data["name"], guardian._state.queues)
+
+    def _write_behind(self, *uows):
+        writer = WriteBehindWriter(60, len(uows))
+        for uow in uows:
+            writer.submit(uow)
+        writer.flush()
+        db_session.expire_all()
+
+    def _new_queue_uow(self, name, bindings=()):
+        uow = UnitOfWork()
+        uow.add_queue(name=name, owner_id=None, size=1, durable=True, warned=None)
+        uow.add_bindings(bindings)
+        return uow
+
+    def test_write_behind_coalesces_bindings(self):
+        name = self._queue_data("bound", 1)["name"]
+        binding = (name, "ex", "rk")
+        stale = UnitOfWork()
+        stale.delete_bindings({binding})
+        # A binding added, then found stale by a later cycle.
+        self._write_behind(self._new_queue_uow(name, {binding}), stale)
+        self.assertEqual(Binding.get_all(), [])
+
+        # A stored binding found stale, then added back.
+        self._write_behind(self._new_queue_uow(name, {binding}))
+        added = UnitOfWork()
+        added.add_bindings({binding})
+        self._write_behind(stale, added)
+        self.assertEqual(
+            [(b.queue_name, b.exchange, b.routing_key) for b in Binding.get_all()],
+            [binding],
+        )
+
+    def test_write_behind_coalesces_deleted_queues(self):
+        created, updated = (
+            self._queue_data(name, 1)["name"] for name in ("created", "updated")
+        )
+        self._write_behind(self._new_queue_uow(updated))
+        changes = self._new_queue_uow(created, {(created, "ex", "rk")})
+        changes.update_queue(updated, size=5)
+        deleted = UnitOfWork()
+        deleted.delete_queue(created)
+        deleted.delete_queue(updated)
+        # A queue created again after being deleted doesn't get back the
+        # bindings it had before.
+        self._write_behind(changes, deleted, self._new_queue_uow(created))
+        self.assertEqual([q.name for q in Queue.get_all()], [created])
+        self.assertEqual(Binding.get_all(), [])
+
+    def test_write_behind_failures(self):
+        on_failure = Mock()
+        writer = WriteBehindWriter(
+            60, 2, max_failures=2, submit_timeout=0.01, on_failure=on_failure
+        )
+        names = [self._queue_data(name, 1)["name"] for name in ("good", "bad")]
+        for name in names:
+            uow = UnitOfWork()
+            uow.add_queue(name=name, owner_id=None, size=1, durable=True, warned=None)
+            writer.submit(uow)
+
+        flush = UnitOfWork.flush
+
+        def failing_flush(uow):
+            if names[1] in uow.new_queues:
+                raise RuntimeError("Bad row.")
+            flush(uow)
+
+        with patch.object(UnitOfWork, "flush", failing_flush):
+            writer.flush()
+            on_failure.assert_not_called()
+            # Too many changes are waiting to take more.
+            extra = UnitOfWork()
+            extra.update_queue(names[0], size=2)
+            with self.assertRaises(WriteBehindTimeout):
+                writer.submit(extra)
+            # After too many failures in a row, the units of work are
+            # written one by one, and those still failing are dropped.
+            writer.flush()
+        on_failure.assert_called_once()
+        self.assertEqual([q.name for q in Queue.get_all()], [names[0]])
+        stats = writer.stats()
+        self.assertEqual((stats["pending"], stats["dropped"]), (0, 1))
+
+    def test_incomplete_snapshots(self):
+        kept = self._queue_data("kept", 1)
+        gone = self._queue_data("gone", 1)
+        self._monitor([kept, gone])
+        self.guardian.load_state()
+
+        def sweep(queues, complete):
+            with patch.object(
+                self.guardian,
+                "fetch_snapshot",
+                return_value=(queues, {}, complete),
+            ), patch.object(pulse_management, "nodes", return_value=[]):
+                self.guardian.sweep()
+            db_session.expire_all()
+            return {q.name for q in Queue.get_all()}
+
+        # Queues missing from an incomplete snapshot may have been skipped;
+        # they're only taken for deleted if missing from the next one too.
+        self.assertEqual(sweep([kept], False), {kept["name"], gone["name"]})
+        self.assertIsNotNone(self.guardian.recent_sizes.get(gone["name"]))
+        self.assertEqual(sweep([kept], False), {kept["name"]})
+        self.assertIsNone(self.guardian.recent_sizes.get(gone["name"]))
+
+    def test_failed_deletions_are_retried(self):
+        on_delete = Mock()
+        self.guardian.on_delete = on_delete
+        ok = self._queue_data("ok", TEST_DELETE_SIZE + 1)
+        flaky = self._queue_data("flaky", TEST_DELETE_SIZE + 1)
+
+        def delete_queue(vhost, queue):
+            if queue == flaky["name"]:
+                raise pulse_management.PulseManagementException("Timed out.")
+
+        with patch.object(pulse_management, "delete_queue", side_effect=delete_queue):
+            self.guardian.monitor_queues([ok, flaky], [self._binding_data(flaky)])
+        db_session.expire_all()
+        on_delete.assert_called_once_with(ok["name"])
+        self.assertEqual([q.name for q in Queue.get_all()], [flaky["name"]])
+        self.assertEqual(len(Queue.get_by(name=flaky["name"]).bindings), 1)
+
+        self.assertEqual(self._monitor([flaky]), [flaky["name"]])
+        self.assertEqual(Queue.get_all(), [])
+        self.assertEqual(on_delete.call_count, 2)
+
+    def test_deletions_notified_without_commit(self):
+        on_delete = Mock()
+        self.guardian.on_delete = on_delete
+        overgrown = self._queue_data("overgrown", TEST_DELETE_SIZE + 1)
+        # The queue is gone from RabbitMQ even if its row can't be removed.
+        with patch.object(
+            UnitOfWork, "flush", side_effect=RuntimeError("Database is down.")
+        ):
+            with self.assertRaises(RuntimeError):
+                self._monitor([overgrown])
+        on_delete.assert_called_once_with(overgrown["name"])
+
+    def test_deletion_rate_limit(self):
+        self.guardian.delete_limiter = TokenBucket(rate=1, burst=2, clock=lambda: 0)
+        queues = [
+            self._queue_data("storm{}".format(size), TEST_DELETE_SIZE + size)
+            for size in (1, 3, 2)
+        ]
+
+        # The biggest queues are deleted first, the others are deferred.
+        self.assertEqual(self._monitor(queues), [queues[1]["name"], queues[2]["name"]])
+        self.assertEqual([q.name for q in Queue.get_all()], [queues[0]["name"]])
+        self.assertEqual(self._monitor(queues[:1]), [])
+        stats = self.guardian.delete_limiter.stats()
+        self.assertEqual((stats["acquired"], stats["deferred"]), (2, 2))
+
+        self.guardian.delete_limiter._clock = lambda: 1
+        self.assertEqual(self._monitor(queues[:1]), [queues[0]["name"]])
+        self.assertEqual(Queue.get_all(), [])
+
+    def test_check_growing_queues(self):
+        self.guardian.scheduler._clock = clock = Mock(return_value=0)
+        growing = self._queue_data("growing", 0)
+        idle = self._queue_data("idle", 0)
+        self._monitor([growing, idle])
+
+        clock.return_value = 10
+        growing["messages"] = growing["messages_ready"] = TEST_DELETE_SIZE // 2
+        self._monitor([growing, idle])
+        self.assertEqual(len(self.guardian.scheduler), 1)
+
+        # Only the growing queue is re-read, and deleted once overgrown.
+        clock.return_value = 1000
+        growing["messages"] = growing["messages_ready"] = TEST_DELETE_SIZE + 1
+        with patch.object(pulse_management, "queue", return_value=growing) as queue:
+            with patch.object(pulse_management, "delete_queue") as delete_queue:
+                self.guardian.check_growing_queues()
+        queue.assert_called_once_with(vhost=DEFAULT_RABBIT_VHOST, queue=growing["name"])
+        delete_queue.assert_called_once_with(
+            vhost=DEFAULT_RABBIT_VHOST, queue=growing["name"]
+        )
+        db_session.expire_all()
+        self.assertEqual([q.name for q in Queue.get_all()], [idle["name"]])
+        self.assertEqual(len(self.guardian.scheduler), 0)
+        self.assertNotIn(growing["name"], self.guardian.recent_sizes)
+        self.assertEqual(len(self.guardian.recent_sizes.get(idle["name"])), 2)
+
+    def test_size_history(self):
+        clock = Mock(return_value=0)
+        self.guardian.history = SizeHistory(
+            raw_retention=1000, rollup_interval=300, rollup_retention=1000, clock=clock
+        )
+        queue_data = self._queue_data("history", 1)
+
+        def observe(now, size):
+            clock.return_value = now
+            queue_data["messages"] = queue_data["messages_ready"] = size
+            self._monitor([queue_data])
+
+        # Raw samples are only written when the size changes.
+        observe(300, 1)
+        observe(305, 1)
+        observe(310, 7)
+        observe(600, 7)
+        self.assertEqual(
+            [tuple(row) for row in history.samples(queue_data["name"])],
+            [(300, 1), (310, 7)],
+        )
+        [rollup] = history.rollups(queue_data["name"])
+        self.assertEqual(
+            (rollup.period_start, rollup.min_size, rollup.max_size, rollup.avg_size),
+            (300, 1, 7, 3),
+        )
+
+        # Steady queues are sampled once per rollup period, and old samples
+        # and rollups are pruned.
+        observe(1400, 7)
+        self.assertEqual(
+            [tuple(row) for row in history.samples(queue_data["name"])], [(1400, 7)]
+        )
+        self.assertEqual(
+            [r.period_start for r in history.rollups(queue_data["name"])], [600]
+        )
+
+    def test_early_warning(self):
+        on_warn = Mock()
+        self.guardian.on_warn = on_warn
+        clock = Mock()
+        self.guardian.recent_sizes = RecentSizes(capacity=10, clock=clock)
+        queue_data = self._queue_data("fast", 0)
+
+        # 1 message every 30 seconds, 810 seconds away from the deletion
+        # size.
+        self.guardian.warn_horizon = 0
+        for now in range(3):
+            clock.return_value = 30 * now
+            queue_data["messages"] = queue_data["messages_ready"] = now
+            self._monitor([queue_data])
+        on_warn.assert_not_called()
+
+        self.guardian.warn_horizon = 900
+        clock.return_value = 90
+        queue_data["messages"] = queue_data["messages_ready"] = 3
+        self._monitor([queue_data])
+        on_warn.assert_called_once_with(queue_data["name"])
+        self.assertTrue(Queue.get_by(name=queue_data["name"]).warned)
+
+    def test_digest(self):
+        on_warn = Mock()
+        guardian = PulseGuardian(
+            warn_queue_size=TEST_WARN_SIZE,
+            del_queue_size=TEST_DELETE_SIZE,
+            on_warn=on_warn,
+            digest=True,
+        )
+        queues = [
+            self._queue_data("digest{}".format(i), TEST_WARN_SIZE + 1) for i in range(3)
+        ]
+        with patch.object(pulse_management, "delete_queue"):
+            guardian.monitor_queues(queues, [])
+        self.assertEqual(on_warn.call_count, 3)
+        self.assertEqual(OutboxEmail.get_all(), [])
+
+        # One email for all of the owner's queues.
+        guardian.flush_digests()
+        emails = OutboxEmail.get_all()
+        self.assertEqual(len(emails), 1)
+        self.assertEqual(emails[0].recipients, [CONSUMER_EMAIL])
+        for queue_data in queues:
+            self.assertIn(queue_data["name"], emails[0].text_data)
+
+    def test_byte_thresholds(self):
+        guardian = PulseGuardian(
+            warn_queue_size=TEST_WARN_SIZE,
+            del_queue_size=TEST_DELETE_SIZE,
+            warn_queue_bytes=1000,
+            del_queue_bytes=2000,
+            emails=False,
+        )
+        queue_data = dict(
+            self._queue_data("large", 2),
+            message_bytes=1500,
+            message_bytes_ram=500,
+            memory=3000,
+        )
+        with patch.object(pulse_management, "delete_queue") as delete_queue:
+            guardian.monitor_queues([queue_data], [])
+        db_session.expire_all()
+        queue = Queue.get_by(name=queue_data["name"])
+        self.assertTrue(queue.warned)
+        self.assertEqual(
+            (queue.message_bytes, queue.message_bytes_ram, queue.memory),
+            (1500, 500, 3000),
+        )
+
+        queue_data.update(message_bytes=2500, message_bytes_ram=2500, memory=4000)
+        with patch.object(pulse_management, "delete_queue") as delete_queue:
+            guardian.monitor_queues([queue_data], [])
+        self.assertEqual(delete_queue.call_count, 1)
+
+        guardian.emails = True
+        with patch.object(guardian, "_sendemail") as sendemail:
+            guardian.deletion_email(
+                [CONSUMER_EMAIL],
+                pulse_management.QueueRecord.from_json(queue_data),
+            )
+        text_data = sendemail.call_args.kwargs["text_data"]
+        self.assertIn("2 messages, 2.4 KB in the queue", text_data)
+        self.assertIn("out of a maximum 30 messages or 2.0 KB", text_data)
+
+    def test_broker_pressure(self):
+        on_delete = Mock()
+        self.guardian.on_delete = on_delete
+        self.guardian.emergency_deletions = 2
+        queues = [
+            dict(self._queue_data(name, size), message_bytes=size * message_bytes)
+            for name, size, message_bytes in (
+                ("small", 5, 1000),
+                ("medium", 16, 10),
+                ("large", 21, 10),
+                ("heavy", 22, 1000),
+                ("huge", 23, 10),
+            )
+        ]
+        unbounded = self._queue_data("unbounded", 25)
+        self._monitor(queues + [unbounded])
+        Queue.get_by(name=unbounded["name"]).unbounded = True
+        db_session.commit()
+        self.guardian.load_state()
+
+        def node(mem_used, mem_alarm=False):
+            return pulse_management.NodeRecord(
+                "rabbit@a", True, mem_used, 100, mem_alarm, 10**9, 10**6, False
+            )
+
+        # Deletion thresholds are halved under high pressure.
+        with patch.object(pulse_management, "nodes", return_value=[node(85)]):
+            self.assertEqual(self.guardian.check_pressure().level, pressure.HIGH)
+        deleted = self._monitor(queues + [unbounded])
+        self.assertCountEqual(deleted, [q["name"] for q in queues[1:]])
+
+        # In an emergency, the biggest queues over their warning threshold
+        # are deleted too, by bytes of messages.
+        with patch.object(
+            pulse_management, "nodes", return_value=[node(90, mem_alarm=True)]
+        ):
+            self.assertEqual(self.guardian.check_pressure().level, pressure.EMERGENCY)
+        self.guardian.del_queue_size = 1000
+        self.guardian.load_state()
+        with patch.object(
+            self.guardian, "_notify", wraps=self.guardian._notify
+        ) as notify:
+            deleted = self._monitor(queues + [unbounded])
+        self.assertCountEqual(deleted, [queues[3]["name"], queues[4]["name"]])
+        self.assertEqual(on_delete.call_count, 6)
+        # Shed queues aren't warned about before being deleted.
+        events = [call.args[0] for call in notify.call_args_list]
+        self.assertCountEqual(
+            [(e.kind, e.queue.name) for e in events if e.queue.name in deleted],
+            [(SHED, name) for name in deleted],
+        )
+
+        # The last known pressure is kept if the nodes can't be polled.
+        with patch.object(
+            pulse_management,
+            "nodes",
+            side_effect=pulse_management.PulseManagementException,
+        ):
+            self.assertEqual(self.guardian.check_pressure().level, pressure.EMERGENCY)
+
+    def _set_thresholds(self, url, warn_size, del_size):
+        with web.app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess["fake_account"] = True
+            return c.put(
+                url, json={"warnQueueSize": warn_size, "delQueueSize": del_size}
+            )
+
+    def test_threshold_overrides(self):
+        self.user.set_admin(True)
+        custom = self._queue_data("custom", 1)
+        default = self._queue_data("default", 1)
+        self._monitor([custom, default])
+
+        account_url = "/rabbitmq-account/{}/thresholds".format(CONSUMER_USER)
+        queue_url = "/queue/{}/thresholds".format(custom["name"])
+        self.assertTrue(self._set_thresholds(account_url, 4, 8).json["ok"])
+        self.assertTrue(self._set_thresholds(queue_url, None, 100).json["ok"])
+        # The queue's warning threshold would be above its owner's deletion
+        # threshold.
+        self.assertFalse(self._set_thresholds(queue_url, 50, None).json["ok"])
+        self.assertEqual(self._set_thresholds(queue_url, "50", 100).status_code, 400)
+        db_session.expire_all()
+        self.assertEqual(
+            Queue.get_by(name=custom["name"]).effective_thresholds(), (4, 100)
+        )
+
+        self.guardian.load_state()
+        new = self._queue_data("new", 5)
+        for queue_data in (custom, default):
+            queue_data["messages"] = queue_data["messages_ready"] = 9
+        deleted = self._monitor([custom, default, new])
+        self.assertEqual(deleted, [default["name"]])
+        self.assertTrue(Queue.get_by(name=custom["name"]).warned)
+        # New queues get their owner's thresholds right away.
+        self.assertTrue(Queue.get_by(name=new["name"]).warned)
+
+        # Overrides are reloaded on every sweep.
+        self._set_thresholds(account_url, None, None)
+        custom["messages"] = custom["messages_ready"] = TEST_DELETE_SIZE + 1
+        with patch.object(
+            self.guardian, "fetch_snapshot", return_value=([custom, new], {}, False)
+        ), patch.object(pulse_management, "nodes", return_value=[]), patch.object(
+            pulse_management, "delete_queue"
+        ) as delete_queue:
+            self.guardian.sweep()
+        db_session.expire_all()
+        delete_queue.assert_not_called()
+        self.assertTrue(Queue.get_by(name=custom["name"]).warned)
+        self.assertFalse(Queue.get_by(name=new["name"]).warned)
+
+
+class QueueSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.scheduler = QueueScheduler(
+            (100, 1000), min_interval=5, max_interval=60, clock=lambda: self.now
+        )
+
+    def test_growing_queues_are_scheduled(self):
+        self.scheduler.observe("fast", "/", 0)
+        self.scheduler.observe("slow", "/", 0)
+        self.scheduler.observe("idle", "/", 50)
+
+        self.now = 10
+        self.scheduler.observe("fast", "/", 80)
+        self.scheduler.observe("slow", "/", 1)
+        self.scheduler.observe("idle", "/", 50)
+        self.assertEqual(len(self.scheduler), 2)
+
+        # The fast queue, 20 messages away from the warning threshold at 4
+        # messages per second, is checked at the minimum interval; the slow
+        # one at the maximum interval.
+        self.assertEqual(self.scheduler.next_due(), 15)
+        self.now = 15
+        self.assertEqual(self.scheduler.pop_due(), [("fast", "/")])
+        self.assertEqual(self.scheduler.pop_due(), [])
+
+        self.now = 20
+        self.scheduler.observe("fast", "/", 600)
+        self.assertEqual(self.scheduler.next_due(), 20 + 0.5 * 400 / 28)
+
+        self.scheduler.forget(["fast"])
+        self.scheduler.retain([])
+        self.assertEqual(len(self.scheduler), 0)
+        self.assertIsNone(self.scheduler.next_due())
+
+
+class ForecastTest(unittest.TestCase):
+    def test_growth_rates(self):
+        times = np.array([[0, 100, 200, 300], [50, 0, 100, 0], [0, 100, 0, 0]])
+        sizes = np.array([[0, 200, 400, 600], [500, 600, 400, 0], [0, 9, 0, 0]])
+        rates = forecast.growth_rates(times, sizes, [4, 3, 2])
+        np.testing.assert_allclose(rates, [2, -2, 0])
+
+    def test_burst_isnt_growth(self):
+        # A single burst, over less than the minimum span of the samples.
+        times = np.array([[0, 10, 20], [0, 30, 60]])
+        sizes = np.array([[0, 0, 300], [0, 0, 300]])
+        rates = forecast.growth_rates(times, sizes, [3, 3])
+        self.assertEqual(rates[0], 0)
+        self.assertGreater(rates[1], 0)
+
+    def test_forecast_history(self):
+        from pulseguardian.model.base import init_db
+
+        init_db()
+        for obj in QueueSizeSample.get_all():
+            db_session.delete(obj)
+        for i, size in enumerate([10, 40, 70]):
+            db_session.add(
+                QueueSizeSample(
+                    queue_name="growing", sampled_at=100 + 30 * i, size=size
+                )
+            )
+            db_session.add(
+                QueueSizeSample(
+                    queue_name="draining", sampled_at=100 + 30 * i, size=20 - i
+                )
+            )
+        db_session.commit()
+
+        forecasts = forecast.forecast_history(
+            ["growing", "draining", "unknown"], limit=100, since=100
+        )
+        self.assertEqual(forecasts, {"growing": forecast.Forecast(1.0, 30.0)})
+        # Limits may be given per queue, in the order of the names.
+        forecasts = forecast.forecast_history(
+            ["unknown", "growing", "draining"], limit=[100, 110, 100], since=100
+        )
+        self.assertEqual(forecasts, {"growing": forecast.Forecast(1.0, 40.0)})
+
+
+class QueueColumnsTest(unittest.TestCase):
+    def test_transitions(self):
+        def queue(name, size, warned=None, unbounded=False, stored_size=None):
+            return (
+                pulse_management.QueueRecord(
+                    name, "/", size, size, True, None, None, None
+                ),
+                QueueState(name, None, stored_size, True, warned, unbounded, None),
+            )
+
+        queues, rows = zip(
+            queue("small", 1, stored_size=1),
+            queue("warn", 21),
+            queue("warned", 21, warned=True),
+            queue("recovered", 20, warned=True),
+            queue("predicted", 5),
+            queue("overgrown", 31, warned=True),
+            queue("unbounded", 31, unbounded=True),
+        )
+        columns = QueueColumns(
+            queues, rows, 20, [30] * 7, {"predicted": forecast.Forecast(1, 25)}
+        )
+        self.assertEqual(columns.size_changed().tolist(), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(columns.durable_changed().tolist(), [])
+
+        overgrown, overgrowing, recovered = columns.transitions(horizon=0)
+        self.assertEqual(overgrown.tolist(), [5])
+        self.assertEqual(overgrowing.tolist(), [1, 6])
+        self.assertEqual(recovered.tolist(), [3])
+        self.assertEqual(
+            columns.transitions(horizon=30).overgrowing.tolist(), [1, 4, 6]
+        )
+
+    def test_prediction_hysteresis(self):
+        queues = [
+            pulse_management.QueueRecord(name, "/", 5, 5, True, None, None, None)
+            for name in ("near", "far", "steady")
+        ]
+        rows = [QueueState(q.name, None, 5, True, True, False, None) for q in queues]
+        forecasts = {
+            "near": forecast.Forecast(1, 45),
+            "far": forecast.Forecast(1, 65),
+        }
+        columns = QueueColumns(queues, rows, 20, 30, forecasts)
+        # Warned queues no longer predicted to overflow within the horizon
+        # only recover once they're well beyond it.
+        self.assertEqual(columns.transitions(horizon=30).recovered.tolist(), [1, 2])
+        self.assertEqual(columns.transitions().recovered.tolist(), [0, 1, 2])
+
+    def test_byte_thresholds(self):
+        queues = [
+            pulse_management.QueueRecord(name, "/", 1, 1, True, size, size, size)
+            for name, size in (("small", 10), ("large", 150), ("huge", 250), ("", None))
+        ]
+        rows = [QueueState(q.name, None, 1, True, None, False, 10) for q in queues]
+        columns = QueueColumns(queues, rows, 20, 30, warn_bytes=100, del_bytes=200)
+        self.assertEqual(columns.bytes_changed().tolist(), [1, 2])
+
+        overgrown, overgrowing, recovered = columns.transitions()
+        self.assertEqual(overgrown.tolist(), [2])
+        self.assertEqual(overgrowing.tolist(), [1])
+        self.assertEqual(recovered.tolist(), [])
+
+        # Byte thresholds are disabled by default.
+        self.assertEqual(
+            QueueColumns(queues, rows, 20, 30).transitions().overgrown.tolist(), []
+        )
+
+    def test_stored_columns(self):
+        stored = StoredColumns()
+        rows = [QueueState(name, 1, 5, True, None, False, None) for name in "abc"]
+        self.assertEqual(stored.update(["a", "b", "c"], rows).sizes.tolist(), [5] * 3)
+
+        # Records replaced since the last update are read again.
+        rows[1] = rows[1]._replace(size=7, warned=True)
+        state = stored.update(["c", "b", "a"], rows[::-1])
+        self.assertEqual(state.sizes.tolist(), [5, 7, 5])
+        self.assertEqual(state.warned.tolist(), [False, True, False])
+        self.assertEqual(state.message_bytes.tolist(), [-1] * 3)
+
+
+class RecentSizesTest(unittest.TestCase):
+    def test_ring_keeps_latest_samples(self):
+        clock = Mock(return_value=0)
+        recent = RecentSizes(capacity=3, clock=clock)
+        for now in range(5):
+            clock.return_value = now
+            recent.record("queue", now * 10)
+        recent.record("other", 1)
+
+        ring = recent.get("queue")
+        self.assertEqual(ring.samples(), [(2, 20), (3, 30), (4, 40)])
+        self.assertEqual(ring.latest(), (4, 40))
+        self.assertEqual(len(ring.sizes), 3)
+
+        recent.retain(["other"])
+        self.assertIsNone(recent.get("queue"))
+        self.assertEqual(len(recent), 1)
+
+    def test_record_all(self):
+        clock = Mock(return_value=0)
+        recent = RecentSizes(capacity=3, clock=clock)
+        names = ["queue%d" % i for i in range(100)]
+        for now in range(0, 120, 30):
+            clock.return_value = now
+            recent.record_all(names, [0] * 99 + [now])
+
+        self.assertEqual(len(recent), 100)
+        self.assertEqual(
+            recent.get("queue99").samples(), [(30, 30), (60, 60), (90, 90)]
+        )
+        # Only the queues whose size changed are worth a forecast.
+        self.assertEqual(
+            forecast.forecast(recent, names, 100),
+            {"queue99": forecast.Forecast(1, 10)},
+        )
+
+
+class PressureTest(unittest.TestCase):
+    def test_assess(self):
+        def node(name, mem_used, disk_free=10**9, running=True, disk_alarm=False):
+            return pulse_management.NodeRecord(
+                name, running, mem_used, 100, False, disk_free, 10**6, disk_alarm
+            )
+
+        self.assertEqual(pressure.assess([], 0.8, 0.95), pressure.NO_PRESSURE)
+        self.assertEqual(
+            pressure.assess([node("a", 50), node("b", 85)], 0.8, 0.95),
+            pressure.Pressure(0.85, pressure.HIGH, "b", ()),
+        )
+        # Stopped nodes are ignored.
+        self.assertEqual(
+            pressure.assess([node("a", 50), node("b", 99, running=False)], 0.8, 0.95),
+            pressure.Pressure(0.5, pressure.NORMAL, "a", ()),
+        )
+        self.assertEqual(
+            pressure.assess([node("a", 10, disk_free=10**6 + 1)], 0.8, 0.95).level,
+            pressure.EMERGENCY,
+        )
+        self.assertEqual(
+            pressure.assess([node("a", 10, disk_alarm=True)], 0.8, 0.95),
+            pressure.Pressure(1.0, pressure.EMERGENCY, "a", ("a: disk",)),
+        )
+
+
+class FakeManagementAPI(object):
+    """Serves canned RabbitMQ management API responses over keep-alive
+    HTTP/1.1 connections.
+
+    ``responses`` maps API paths (e.g. ``"queues/%2F"``) to JSON-serializable
+    bodies, or to callables taking the parsed query string and returning one.
+    """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _respond(self):
+                length = int(self.headers.get("Content-Length", 0))
+                self.rfile.read(length)
+                api.requests.append((self.command, self.path))
+
+                url = urlparse(self.path)
+                body = api.responses.get(url.path[len("/api/") :])
+                if callable(body):
+                    body = body(parse_qs(url.query))
+                data = json.dumps(body).encode("utf8") if body is not None else b""
+
+                self.send_response(200 if body is not None else 404)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_PUT = do_DELETE = _respond
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+
+    @staticmethod
+    def paginated(items):
+        """Serve ``items`` the way the management plugin serves paginated,
+        column-filtered listings.
+        """
+
+        def respond(query):
+            page = int(query["page"][0])
+            page_size = int(query["page_size"][0])
+            columns = query["columns"][0].split(",")
+            page_items = items[(page - 1) * page_size : page * page_size]
+            return {
+                "filtered_count": len(items),
+                "item_count": len(page_items),
+                "items": [
+                    {k: v for k, v in item.items() if k in columns}
+                    for item in page_items
+                ],
+                "page": page,
+                "page_count": max(1, -(-len(items) // page_size)),
+                "page_size": page_size,
+                "total_count": len(items),
+            }
+
+        return respond
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self._original_url = config.rabbit_management_url
+        config.rabbit_management_url = "http://127.0.0.1:{}/api/".format(
+            self.server.server_port
+        )
+        pulse_management.reset_client()
+        return self
+
+    def __exit__(self, *exc_info):
+        pulse_management.reset_client()
+        config.rabbit_management_url = self._original_url
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ManagementClientTest(unittest.TestCase):
+    """Tests the management API's HTTP client (no RabbitMQ required)."""
+
+    def test_connections_are_reused(self):
+        queues = [{"name": "queue/{}/a".format(CONSUMER_USER), "messages": 0}]
+        with FakeManagementAPI({"queues/%2F": queues}):
+            for i in range(5):
+                self.assertEqual(pulse_management.queues(vhost="/"), queues)
+            stats = pulse_management.client_stats()
+
+        self.assertEqual(stats["requests"], 5)
+        self.assertEqual(stats["connections"], 1)
+        self.assertEqual(stats["reused"], 4)
+
+    def test_queue_snapshot_pages(self):
+        queues = [
+            {
+                "name": "queue/{}/{:03}".format(CONSUMER_USER, i),
+                "vhost": DEFAULT_RABBIT_VHOST,
+                "messages": i,
+                "messages_ready": i,
+                "durable": True,
+                "message_stats": {"publish": i},
+            }
+            for i in range(25)
+        ]
+        with FakeManagementAPI({"queues/%2F": FakeManagementAPI.paginated(queues)}):
+            snapshot = pulse_management.QueueSnapshot(vhost="/", page_size=10)
+            items = list(snapshot)
+
+        self.assertTrue(snapshot.consistent)
+        self.assertEqual([q.name for q in items], [q["name"] for q in queues])
+        self.assertEqual(items[3].messages, 3)
+        self.assertEqual(items[0]._fields, pulse_management.QUEUE_SNAPSHOT_COLUMNS)
+
+    def test_queue_snapshot_drift(self):
+        queues = [
+            {"name": "queue/{}/{:03}".format(CONSUMER_USER, i), "messages": i}
+            for i in range(25)
+        ]
+        expected = [q["name"] for q in queues]
+        paginated = FakeManagementAPI.paginated(queues)
+
+        def respond(query):
+            if "page" not in query:
+                return queues
+            page = paginated(query)
+            if query["page"] == ["1"]:
+                # A queue of the first page is deleted once it's fetched,
+                # shifting the next pages.
+                del queues[0]
+            return page
+
+        with FakeManagementAPI({"queues/%2F": respond}) as api:
+            snapshot = pulse_management.QueueSnapshot(vhost="/", page_size=10)
+            names = [q.name for q in snapshot]
+
+        # The queue shifted into the first page is only seen by a single
+        # unpaged request.
+        self.assertTrue(snapshot.consistent)
+        self.assertEqual(sorted(names), expected)
+        self.assertEqual(len(api.requests), 4)
+
+    def test_nodes(self):
+        def respond(query):
+            columns = query["columns"][0].split(",")
+            node = {"name": "rabbit@a", "mem_used": 1, "mem_limit": 2, "uptime": 3}
+            return [{k: v for k, v in node.items() if k in columns}]
+
+        with FakeManagementAPI({"nodes": respond}):
+            nodes = pulse_management.nodes()
+
+        self.assertEqual(len(nodes), 1)
+        self.assertEqual((nodes[0].name, nodes[0].mem_used), ("rabbit@a", 1))
+        self.assertIsNone(nodes[0].mem_alarm)
+
+    def test_streamed_json_array(self):
+        items = [
+            {"source": "exchange/{}".format(i), "arguments": {"x": [i, "]"]}}
+            for i in range(50)
+        ]
+        text = json.dumps(items, indent=1)
+        # Split the document in chunks cutting through items and strings.
+        chunks = [text[i : i + 7] for i in range(0, len(text), 7)]
+        self.assertEqual(list(pulse_management._iter_json_array(chunks)), items)
+        self.assertEqual(list(pulse_management._iter_json_array([" [ ] "])), [])
+        with self.assertRaises(ValueError):
+            list(pulse_management._iter_json_array(chunks[:-3]))
+
+    def test_fetch_snapshot_deadline(self):
+        from pulseguardian.guardian import SnapshotTimeout
+
+        queue_name = "queue/{}/a".format(CONSUMER_USER)
+        binding = {
+            "source": "exchange/pulse/test",
+            "destination": queue_name,
+            "destination_type": "queue",
+            "routing_key": "#",
+        }
+
+        def slow_bindings(query):
+            time.sleep(1)
+            return [binding]
+
+        guardian = PulseGuardian(emails=False)
+        responses = {
+            "queues/%2F": FakeManagementAPI.paginated([{"name": queue_name}]),
+            "bindings/%2F": [binding],
+        }
+        with FakeManagementAPI(responses):
+            queues, bindings, complete = guardian.fetch_snapshot()
+            self.assertEqual([q.name for q in queues], [queue_name])
+            self.assertTrue(complete)
+            self.assertEqual(
+                guardian.get_queue_bindings(bindings, queue_name),
+                [("exchange/pulse/test", "#")],
+            )
+
+            responses["bindings/%2F"] = slow_bindings
+            with patch.object(config, "snapshot_deadline", 0.2):
+                self.assertRaises(SnapshotTimeout, guardian.fetch_snapshot)
+
+    def test_abandoned_snapshot_is_cancelled(self):
+        from pulseguardian.guardian import SnapshotTimeout
+
+        queues = [{"name": "queue/{}/{}".format(CONSUMER_USER, i)} for i in range(5)]
+        paginated = FakeManagementAPI.paginated(queues)
+
+        def slow_pages(query):
+            if query["page"] != ["1"]:
+                time.sleep(0.3)
+            return paginated(query)
+
+        guardian = PulseGuardian(emails=False)
+        responses = {"queues/%2F": slow_pages, "bindings/%2F": []}
+        with FakeManagementAPI(responses) as api, patch.object(
+            config, "rabbit_page_size", 1
+        ), patch.object(config, "rabbit_page_workers", 1), patch.object(
+            config, "snapshot_deadline", 0.2
+        ):
+            self.assertRaises(SnapshotTimeout, guardian.fetch_snapshot)
+            time.sleep(1.5)
+            # Paging stopped once the snapshot was abandoned.
+            pages = [path for _, path in api.requests if "queues" in path]
+            self.assertLessEqual(len(pages), 3)
+
+            cancel = threading.Event()
+            cancel.set()
+            with self.assertRaises(pulse_management.FetchCancelled):
+                list(pulse_management.iter_bindings("/", cancel))
+
+
+class FakeSMTPServer(object):
+    """A minimal SMTP server recording the messages it receives.
+
+    Messages are rejected with a temporary error while ``fail`` is True.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.connections = 0
+        self.fail = False
+        smtp = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line.encode("ascii") + b"\r\n")
+
+            def handle(self):
+                smtp.connections += 1
+                self.reply("220 localhost")
+                recipients = []
+                for line in self.rfile:
+                    command = line.decode("ascii").rstrip("\r\n")
+                    verb = command.split(" ", 1)[0].upper()
+                    if verb in ("HELO", "EHLO", "RSET", "NOOP"):
+                        self.reply("250 OK")
+                    elif verb == "MAIL":
+                        recipients = []
+                        self.reply("451 Try again later" if smtp.fail else "250 OK")
+                    elif verb == "RCPT":
+                        recipients.append(command.split(":", 1)[1].strip("<> "))
+                        self.reply("250 OK")
+                    elif verb == "DATA":
+                        self.reply("354 End data with <CR><LF>.<CR><LF>")
+                        data = []
+                        for data_line in self.rfile:
+                            if data_line.rstrip(b"\r\n") == b".":
+                                break
+                            data.append(data_line.decode("utf8"))
+                        smtp.messages.append((recipients, "".join(data)))
+                        self.reply("250 OK")
+                    elif verb == "QUIT":
+                        self.reply("221 Bye")
+                        break
+                    else:
+                        self.reply("502 Command not implemented")
+
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self._patches = [
+            patch.object(config, "email_smtp_server", "127.0.0.1"),
+            patch.object(config, "email_smtp_port", self.server.server_address[1]),
+            patch.object(config, "email_ssl", False),
+            patch.object(config, "email_password", None),
+        ]
+        for p in self._patches:
+            p.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        for p in self._patches:
+            p.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class OutboxTest(unittest.TestCase):
+    """Tests the email outbox against a local SMTP server."""
+
+    def setUp(self):
+        from pulseguardian.model.base import init_db
+
+        init_db()
+        for email in OutboxEmail.get_all():
+            db_session.delete(email)
+        db_session.commit()
+
+        self.guardian = PulseGuardian(
+            warn_queue_size=TEST_WARN_SIZE,
+            del_queue_size=TEST_DELETE_SIZE,
+            emails=True,
+        )
+
+    def test_emails_are_queued_then_delivered(self):
+        with FakeSMTPServer() as smtp:
+            worker = outbox.OutboxWorker()
+            self.guardian._sendemail([CONSUMER_EMAIL], "Test subject", "Test body")
+            self.assertEqual(smtp.messages, [])
+            self.assertEqual(worker.stats()["depth"], 1)
+
+            self.assertEqual(worker.deliver(), 1)
+
+        ((recipients, data),) = smtp.messages
+        self.assertEqual(recipients, [CONSUMER_EMAIL])
+        self.assertIn("Subject: Test subject", data)
+        self.assertIn("Test body", data)
+        (email,) = OutboxEmail.get_all()
+        self.assertEqual(email.state, outbox_model.SENT)
+        self.assertEqual(email.attempts, 1)
+        stats = worker.stats()
+        self.assertEqual((stats["depth"], stats["sent"]), (0, 1))
+
+    def test_old_emails_are_pruned(self):
+        now = outbox_model.utcnow()
+        old = now - timedelta(days=8)
+        for subject, state, sent_at, created_at in (
+            ("Old sent", outbox_model.SENT, old, old),
+            ("Old failed", outbox_model.FAILED, None, old),
+            ("Old pending", outbox_model.PENDING, None, old),
+            ("Recent sent", outbox_model.SENT, now, old),
+        ):
+            db_session.add(
+                OutboxEmail(
+                    to_addrs=CONSUMER_EMAIL,
+                    subject=subject,
+                    text_data="Body",
+                    state=state,
+                    sent_at=sent_at,
+                    created_at=created_at,
+                    next_attempt_at=now + timedelta(hours=1),
+                )
+            )
+        db_session.commit()
+
+        mailer = Mock(**{"stats.return_value": {}})
+        worker = outbox.OutboxWorker(retention=7, mailer=mailer)
+        self.assertEqual(worker.deliver(), 0)
+        self.assertCountEqual(
+            [email.subject for email in OutboxEmail.get_all()],
+            ["Old pending", "Recent sent"],
+        )
+        self.assertEqual(worker.stats()["pruned"], 2)
+
+    def test_batch_shares_one_connection(self):
+        with FakeSMTPServer() as smtp:
+            worker = outbox.OutboxWorker()
+            for i in range(3):
+                self.guardian._sendemail([CONSUMER_EMAIL], "Test {}".format(i), "Body")
+            self.assertEqual(worker.deliver(), 3)
+
+        self.assertEqual(len(smtp.messages), 3)
+        self.assertEqual(smtp.connections, 1)
+        stats = worker.stats()
+        self.assertEqual((stats["smtp_sent"], stats["smtp_connections"]), (3, 1))
+        self.assertGreater(stats["smtp_total_send_seconds"], 0)
+
+    def test_sent_emails_are_committed_one_by_one(self):
+        for subject in ("One", "Two"):
+            self.guardian._sendemail([CONSUMER_EMAIL], subject, "Body")
+        # The worker dies while sending the second email.
+        mailer = Mock(**{"send.side_effect": [None, SystemExit]})
+        worker = outbox.OutboxWorker(mailer=mailer)
+        with self.assertRaises(SystemExit):
+            worker.deliver()
+        db_session.rollback()
+
+        self.assertEqual(
+            [(email.subject, email.state) for email in OutboxEmail.get_all()],
+            [("One", outbox_model.SENT), ("Two", outbox_model.PENDING)],
+        )
+
+    def test_mailer_reconnects(self):
+        with FakeSMTPServer() as smtp, outbox.default_mailer() as mailer:
+            mailer.send([CONSUMER_EMAIL], "One", "Body")
+            # The idle session gets dropped.
+            mailer._smtp.sock.shutdown(socket.SHUT_RDWR)
+            mailer.send([CONSUMER_EMAIL], "Two", "Body")
+
+        self.assertEqual(len(smtp.messages), 2)
+        self.assertEqual(mailer.stats()["connections"], 2)
+
+    def test_failed_emails_are_retried(self):
+        with FakeSMTPServer() as smtp:
+            worker = outbox.OutboxWorker(retry_delay=0, max_attempts=2)
+            smtp.fail = True
+            self.guardian._sendemail([CONSUMER_EMAIL], "Test subject", "Test body")
+
+            self.assertEqual(worker.deliver(), 0)
+            (email,) = OutboxEmail.get_all()
+            self.assertEqual((email.state, email.attempts), (outbox_model.PENDING, 1))
+            self.assertIn("SMTPSenderRefused", email.last_error)
+
+            # Out of attempts.
+            self.assertEqual(worker.deliver(), 0)
+            self.assertEqual((email.state, email.attempts), (outbox_model.FAILED, 2))
+
+            # Retries back off.
+            worker = outbox.OutboxWorker(retry_delay=60)
+            self.guardian._sendemail([CONSUMER_EMAIL], "Test subject", "Test body")
+            worker.deliver()
+            smtp.fail = False
+            self.assertEqual(worker.deliver(), 0)
+            self.assertEqual(worker.stats()["depth"], 1)
+        self.assertEqual(smtp.messages, [])
+
+
 class AuthTest(unittest.TestCase):
     """Tests for OIDC/authlib authentication flow."""
 